@@ -33,12 +33,14 @@ __all__ = ['provision_pymoo', 'ArchOptNSGA2', 'get_nsga2', 'initialize_from_prev
 log = logging.getLogger('sb_arch_opt.pymoo')
 
 
-def provision_pymoo(algorithm: Algorithm, set_init=True, results_folder=None, enable_extreme_barrier=True):
+def provision_pymoo(algorithm: Algorithm, set_init=True, results_folder=None, enable_extreme_barrier=True,
+                    append_storage=False):
     """
     Provisions a pymoo Algorithm to work correctly for architecture optimization:
     - Sets initializer using a repaired sampler (if `set_init = True`)
     - Sets a repair operator
-    - Optionally stores intermediate and final results in some results folder
+    - Optionally stores intermediate and final results in some results folder (`append_storage = True` only writes
+      newly evaluated points instead of rewriting the population every time)
     - Optionally enables extreme-barrier for dealing with hidden constraints (replace NaN with Inf)
     """
     capture_log()
@@ -50,10 +52,11 @@ def provision_pymoo(algorithm: Algorithm, set_init=True, results_folder=None, en
         algorithm.repair = ArchOptRepair()
 
     if results_folder is not None:
-        algorithm.callback = ResultsStorageCallback(results_folder, callback=algorithm.callback)
+        algorithm.callback = ResultsStorageCallback(results_folder, callback=algorithm.callback, append=append_storage)
 
     if results_folder is not None or enable_extreme_barrier:
-        algorithm.evaluator = ArchOptEvaluator(extreme_barrier=enable_extreme_barrier, results_folder=results_folder)
+        algorithm.evaluator = ArchOptEvaluator(extreme_barrier=enable_extreme_barrier, results_folder=results_folder,
+                                               append=append_storage)
 
     return algorithm
 
@@ -70,10 +73,12 @@ class ArchOptNSGA2(NSGA2):
                  survival=RankAndCrowdingSurvival(),
                  output=EHVMultiObjectiveOutput(),
                  results_folder=None,
+                 append_storage=False,
                  **kwargs):
 
-        evaluator = ArchOptEvaluator(extreme_barrier=True, results_folder=results_folder)
-        callback = ResultsStorageCallback(results_folder) if results_folder is not None else None
+        evaluator = ArchOptEvaluator(extreme_barrier=True, results_folder=results_folder, append=append_storage)
+        callback = ResultsStorageCallback(results_folder, append=append_storage) \
+            if results_folder is not None else None
 
         super().__init__(pop_size=pop_size, sampling=sampling, repair=repair, mating=mating,
                          eliminate_duplicates=eliminate_duplicates, survival=survival, output=output,
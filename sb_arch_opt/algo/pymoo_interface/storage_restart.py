@@ -15,13 +15,17 @@ Copyright: (c) 2023, Deutsches Zentrum fuer Luft- und Raumfahrt e.V.
 Contact: jasper.bussemaker@dlr.de
 """
 import os
+import copy
 import pickle
+import shutil
 import logging
+import concurrent.futures
 
 import numpy as np
 import pandas as pd
-from typing import Optional
+from typing import Optional, List, Tuple
 from pymoo.core.result import Result
+from pymoo.core.problem import Problem
 from pymoo.core.callback import Callback
 from pymoo.core.algorithm import Algorithm
 from pymoo.core.evaluator import Evaluator
@@ -83,12 +87,25 @@ class ResultsStorageCallback(Callback):
     - intermediate and final Population in pymoo_population.pkl
     - final Result object in pymoo_results.pkl
     - any problem-specific intermediate and final results
+
+    In append mode, the population is not rewritten completely every time: evaluated points are added as chunks in the
+    pymoo_population_chunks folder, and as rows to pymoo_population.csv (see `append_pop`). The stored population
+    then contains all evaluated points, and the populations stored by the algorithm itself are skipped. Chunks are
+    compacted in tiers: as soon as the last `n_chunks_compact` chunks have a similar size (within a factor
+    `n_chunks_compact`), they are merged into one chunk, so that each point is only rewritten a logarithmic nr of times.
+    All chunks are merged when storing the final results. If a complete population was stored previously in the results
+    folder, it is used as the first chunk. Use this mode together with an ArchOptEvaluator in append mode.
     """
 
-    def __init__(self, results_folder: str, callback=None):
+    _chunks_folder = 'pymoo_population_chunks'
+
+    def __init__(self, results_folder: str, callback=None, append=False, n_chunks_compact=10):
         self.results_folder = results_folder
         os.makedirs(results_folder, exist_ok=True)
         self.callback = callback
+        self.append = append
+        self.n_chunks_compact = n_chunks_compact
+        self._n_csv_rows = None
         super().__init__()
 
     def initialize(self, algorithm: Algorithm):
@@ -123,11 +140,15 @@ class ResultsStorageCallback(Callback):
         self.store_intermediate(algorithm)
 
     def store_intermediate(self, algorithm: Algorithm, final=False):
-        # Store pymoo population
-        if not hasattr(algorithm, 'pop'):
-            raise RuntimeError(f'Algorithm has no population (pop property): {algorithm!r}')
-        pop: Population = algorithm.pop
-        self.store_pop(pop)
+        # Store pymoo population (in append mode, evaluated points have already been stored by the evaluator)
+        if self.append:
+            if final:
+                self.compact_chunks()
+        else:
+            if not hasattr(algorithm, 'pop'):
+                raise RuntimeError(f'Algorithm has no population (pop property): {algorithm!r}')
+            pop: Population = algorithm.pop
+            self.store_pop(pop)
 
         # Store problem-specific results
         self.store_intermediate_problem(algorithm.problem, final=final)
@@ -136,8 +157,118 @@ class ResultsStorageCallback(Callback):
         with open(self._get_pop_file_path(self.results_folder), 'wb') as fp:
             pickle.dump(pop, fp)
 
+        # Previously appended chunks are superseded by the stored population
+        chunks_folder = self._get_chunks_folder(self.results_folder)
+        if os.path.exists(chunks_folder):
+            shutil.rmtree(chunks_folder)
+        self._n_csv_rows = None
+
         if len(pop) > 0:
-            self.get_pop_as_df(pop).to_csv(os.path.join(self.results_folder, 'pymoo_population.csv'))
+            self.get_pop_as_df(pop).to_csv(self._get_csv_file_path(self.results_folder))
+
+    def append_pop(self, pop: Population):
+        """Append newly-evaluated points to the stored population, without rewriting previously-stored points"""
+        if len(pop) == 0:
+            return
+
+        chunks_folder = self._get_chunks_folder(self.results_folder)
+        os.makedirs(chunks_folder, exist_ok=True)
+        chunk_paths = self._get_chunk_paths(self.results_folder, remove_covered=True)
+        if len(chunk_paths) == 0:
+            chunk_paths = self._seed_chunks()
+        i_chunk = self._get_chunk_idx(chunk_paths[-1])+1 if len(chunk_paths) > 0 else 0
+        self._write_chunk(pop, os.path.join(chunks_folder, self._get_chunk_filename(i_chunk, len(pop))))
+
+        csv_path = self._get_csv_file_path(self.results_folder)
+        if self._n_csv_rows is None:
+            self._n_csv_rows = 0
+            if os.path.exists(csv_path):
+                with open(csv_path, 'r') as fp:
+                    self._n_csv_rows = max(0, sum(1 for _ in fp)-1)
+
+        df = self.get_pop_as_df(pop)
+        df.index += self._n_csv_rows
+        df.to_csv(csv_path, mode='a', header=self._n_csv_rows == 0 or not os.path.exists(csv_path))
+        self._n_csv_rows += len(df)
+
+        if self.n_chunks_compact is not None:
+            self._compact_chunks_tiered()
+
+    def _seed_chunks(self) -> List[str]:
+        """Start appending from the complete population stored previously (if any): it is stored as the first chunk,
+        and the csv file is rewritten to correspond to it"""
+        self._n_csv_rows = None
+        csv_path = self._get_csv_file_path(self.results_folder)
+        pop = self.load_pop(self.results_folder)
+        if pop is None or len(pop) == 0:
+            if os.path.exists(csv_path):
+                os.remove(csv_path)
+            return []
+
+        chunk_path = os.path.join(self._get_chunks_folder(self.results_folder), self._get_chunk_filename(0, len(pop)))
+        self._write_chunk(pop, chunk_path)
+        self.get_pop_as_df(pop).to_csv(csv_path)
+        self._n_csv_rows = len(pop)
+        return [chunk_path]
+
+    def _compact_chunks_tiered(self):
+        """Merge the last chunks as long as there are `n_chunks_compact` of them with similar sizes"""
+        n_compact = max(2, self.n_chunks_compact)
+        chunk_paths = self._get_chunk_paths(self.results_folder)
+        chunk_sizes = [self._get_chunk_size(chunk_path) for chunk_path in chunk_paths]
+        while len(chunk_paths) >= n_compact:
+            tail_sizes = chunk_sizes[-n_compact:]
+            if max(tail_sizes) >= n_compact*min(tail_sizes):
+                break
+
+            merged_path = self._replace_chunks(chunk_paths[-n_compact:])
+            chunk_paths = chunk_paths[:-n_compact]+[merged_path]
+            chunk_sizes = chunk_sizes[:-n_compact]+[sum(tail_sizes)]
+
+    def compact_chunks(self):
+        """Merge all stored population chunks into one chunk"""
+        chunk_paths = self._get_chunk_paths(self.results_folder)
+        if len(chunk_paths) <= 1:
+            return
+        self._replace_chunks(chunk_paths)
+
+    @classmethod
+    def _replace_chunks(cls, chunk_paths: List[str]) -> str:
+        # Write the merged population recording the range of merged chunk indices, and then remove the merged chunks:
+        # if this process is interrupted before all merged chunks are removed, they are ignored as they are covered by
+        # the merged chunk
+        pop = cls._merge_chunks(chunk_paths)
+        i_first, i_last = cls._get_chunk_range(chunk_paths[0])[0], cls._get_chunk_idx(chunk_paths[-1])
+        merged_filename = cls._get_chunk_filename(i_last, len(pop), i_first=i_first)
+        merged_path = os.path.join(os.path.dirname(chunk_paths[-1]), merged_filename)
+        cls._write_chunk(pop, merged_path)
+        for chunk_path in chunk_paths:
+            if chunk_path != merged_path:
+                os.remove(chunk_path)
+        return merged_path
+
+    @staticmethod
+    def _write_chunk(pop: Population, chunk_path: str):
+        tmp_path = chunk_path+'.tmp'
+        with open(tmp_path, 'wb') as fp:
+            pickle.dump(pop, fp)
+        os.replace(tmp_path, chunk_path)
+
+    @classmethod
+    def _merge_chunks(cls, chunk_paths) -> Population:
+        pops = [pop for pop in cls._iter_chunks(chunk_paths) if len(pop) > 0]
+        if len(pops) == 0:
+            return Population.new()
+        return np.concatenate(pops).view(Population)
+
+    @classmethod
+    def _iter_chunks(cls, chunk_paths):
+        for chunk_path in chunk_paths:
+            with open(chunk_path, 'rb') as fp:
+                pop = pickle.load(fp)
+            if not isinstance(pop, Population):
+                raise ValueError(f'Loaded population not of type Population ({chunk_path}): {pop!r}')
+            yield pop
 
     @staticmethod
     def get_pop_as_df(pop: Population) -> pd.DataFrame:
@@ -160,7 +291,14 @@ class ResultsStorageCallback(Callback):
 
     @classmethod
     def load_pop(cls, results_folder: str) -> Optional[Population]:
+        # Load from appended chunks if available: they are removed when a complete population is stored, and if
+        # appending starts from a complete population, it is stored as the first chunk
+        chunk_paths = cls._get_chunk_paths(results_folder)
+        if len(chunk_paths) > 0:
+            return cls._merge_chunks(chunk_paths)
+
         pop_path = cls._get_pop_file_path(results_folder)
+
         if not os.path.exists(pop_path):
             return
 
@@ -175,6 +313,60 @@ class ResultsStorageCallback(Callback):
     def _get_pop_file_path(results_folder) -> str:
         return os.path.join(results_folder, 'pymoo_population.pkl')
 
+    @staticmethod
+    def _get_csv_file_path(results_folder) -> str:
+        return os.path.join(results_folder, 'pymoo_population.csv')
+
+    @classmethod
+    def _get_chunks_folder(cls, results_folder) -> str:
+        return os.path.join(results_folder, cls._chunks_folder)
+
+    @classmethod
+    def _get_chunk_paths(cls, results_folder, remove_covered=False) -> List[str]:
+        """Get chunk paths ordered by chunk index, skipping chunks covered by a merged chunk (left behind if merging
+        was interrupted)"""
+        chunks_folder = cls._get_chunks_folder(results_folder)
+        if not os.path.exists(chunks_folder):
+            return []
+        chunk_paths = [os.path.join(chunks_folder, filename) for filename in os.listdir(chunks_folder)
+                       if filename.startswith('chunk_') and filename.endswith('.pkl')]
+
+        # Larger (merged) chunks come before the chunks they cover
+        chunk_ranges = {chunk_path: cls._get_chunk_range(chunk_path) for chunk_path in chunk_paths}
+        uncovered_chunk_paths = []
+        i_covered = -1
+        for chunk_path in sorted(chunk_paths, key=lambda path: (chunk_ranges[path][0], -chunk_ranges[path][1])):
+            if chunk_ranges[chunk_path][1] > i_covered:
+                uncovered_chunk_paths.append(chunk_path)
+                i_covered = chunk_ranges[chunk_path][1]
+            elif remove_covered:
+                os.remove(chunk_path)
+        return uncovered_chunk_paths
+
+    @staticmethod
+    def _get_chunk_filename(i_chunk: int, n_points: int, i_first: int = None) -> str:
+        if i_first is not None and i_first != i_chunk:
+            return f'chunk_{i_chunk:08d}_{n_points}_{i_first:08d}.pkl'
+        return f'chunk_{i_chunk:08d}_{n_points}.pkl'
+
+    @classmethod
+    def _get_chunk_idx(cls, chunk_path: str) -> int:
+        return cls._get_chunk_range(chunk_path)[1]
+
+    @staticmethod
+    def _get_chunk_range(chunk_path: str) -> Tuple[int, int]:
+        """First and last chunk index covered by a chunk"""
+        parts = os.path.basename(chunk_path)[6:-4].split('_')
+        i_last = int(parts[0])
+        return (int(parts[2]) if len(parts) > 2 else i_last), i_last
+
+    @classmethod
+    def _get_chunk_size(cls, chunk_path: str) -> int:
+        parts = os.path.basename(chunk_path)[6:-4].split('_')
+        if len(parts) > 1:
+            return int(parts[1])
+        return len(next(cls._iter_chunks([chunk_path])))
+
     def __call__(self, *args, **kwargs):
         super().__call__(*args, **kwargs)
         if self.callback is not None:
@@ -189,36 +381,67 @@ class ArchOptEvaluator(Evaluator):
       example, instead of only when an algorithm makes a new iteration
 
     Batch process size is determined using `get_n_batch_evaluate` if not specified explicitly!
+    In append mode, only the newly evaluated points are written after each batch, instead of the complete population.
+
+    Optionally, batches can be evaluated asynchronously by some `concurrent.futures.Executor` (e.g. a process pool, or
+    an executor submitting jobs to some job queue): at most `n_parallel` batches (default: all) are submitted at the
+    same time, and results are processed and stored in the order they complete. Note that the problem is then
+    evaluated in copies of the problem object (when using a process pool), so any evaluation state is not kept.
 
     Also using the ResultsStorageCallback ensures that also final problem-specific results are stored.
     """
 
-    def __init__(self, *args, extreme_barrier=True, results_folder: str = None, n_batch=None, **kwargs):
+    def __init__(self, *args, extreme_barrier=True, results_folder: str = None, n_batch=None, append=False,
+                 executor: concurrent.futures.Executor = None, n_parallel: int = None, **kwargs):
         self.extreme_barrier = extreme_barrier
         self.results_folder = results_folder
         self.n_batch = n_batch
+        self.append = append
+        self.executor = executor
+        self.n_parallel = n_parallel
+        self._callback = None
         super().__init__(*args, **kwargs)
 
+    def __deepcopy__(self, memo):
+        # The executor is shared, as it cannot (and should not) be copied
+        obj = self.__class__.__new__(self.__class__)
+        memo[id(self)] = obj
+        for key, value in self.__dict__.items():
+            setattr(obj, key, value if key == 'executor' else copy.deepcopy(value, memo))
+        return obj
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['executor'] = None
+        return state
+
+    def _get_storage_callback(self) -> ResultsStorageCallback:
+        if self._callback is None or self._callback.results_folder != self.results_folder:
+            self._callback = ResultsStorageCallback(self.results_folder, append=self.append)
+        return self._callback
+
+    def _get_n_batch(self, problem) -> int:
+        n_batch = self.n_batch
+        if n_batch is None and isinstance(problem, ArchOptProblemBase):
+            n_batch = problem.get_n_batch_evaluate()
+        if n_batch is None:
+            n_batch = 1  # Assume there is no batch processing, and we want to save after every evaluation
+        return n_batch
+
     def _eval(self, problem, pop, evaluate_values_of, **kwargs):
-        if self.results_folder is None:
+        if self.executor is not None:
+            self._eval_async(problem, pop, evaluate_values_of, **kwargs)
+
+        elif self.results_folder is None:
             super()._eval(problem, pop, evaluate_values_of, **kwargs)
 
         else:
             # Evaluate in batch and store intermediate results
-            callback = ResultsStorageCallback(self.results_folder)
-
-            n_batch = self.n_batch
-            if n_batch is None and isinstance(problem, ArchOptProblemBase):
-                n_batch = problem.get_n_batch_evaluate()
-            if n_batch is None:
-                n_batch = 1  # Assume there is no batch processing, and we want to save after every evaluation
-
+            n_batch = self._get_n_batch(problem)
             for i_batch in range(0, len(pop), n_batch):
                 batch_pop = pop[i_batch:i_batch+n_batch]
                 super()._eval(problem, batch_pop, evaluate_values_of, **kwargs)
-
-                callback.store_pop(self._normalize_pop(pop, evaluate_values_of))
-                callback.store_intermediate_problem(problem)
+                self._store_batch(problem, pop, batch_pop, evaluate_values_of)
 
         # Apply extreme barrier: replace NaN with Inf
         if self.extreme_barrier:
@@ -229,6 +452,49 @@ class ArchOptEvaluator(Evaluator):
 
         return pop
 
+    def _eval_async(self, problem, pop, evaluate_values_of, **kwargs):
+        n_batch = self._get_n_batch(problem)
+        batches = [pop[i_batch:i_batch+n_batch] for i_batch in range(0, len(pop), n_batch)]
+        n_parallel = self.n_parallel or len(batches)
+
+        # Keep n_parallel batches in flight, and process them in the order they complete
+        i_next = 0
+        futures = {}
+        try:
+            while i_next < len(batches) or len(futures) > 0:
+                while i_next < len(batches) and len(futures) < n_parallel:
+                    x_batch = batches[i_next].get('X')
+                    future = self.executor.submit(_evaluate_batch, problem, x_batch, evaluate_values_of, **kwargs)
+                    futures[future] = batches[i_next]
+                    i_next += 1
+
+                done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    batch_pop = futures.pop(future)
+                    out = future.result()
+                    for key, val in out.items():
+                        if val is not None:
+                            batch_pop.set(key, val)
+                    batch_pop.apply(lambda ind: ind.evaluated.update(out.keys()))
+
+                    if self.results_folder is not None:
+                        self._store_batch(problem, pop, batch_pop, evaluate_values_of)
+
+        finally:
+            # If an evaluation failed, cancel the pending evaluations and wait for the running ones to finish
+            if len(futures) > 0:
+                for future in futures:
+                    future.cancel()
+                concurrent.futures.wait(futures)
+
+    def _store_batch(self, problem, pop: Population, batch_pop: Population, evaluate_values_of):
+        callback = self._get_storage_callback()
+        if self.append:
+            callback.append_pop(self._normalize_pop(batch_pop, evaluate_values_of))
+        else:
+            callback.store_pop(self._normalize_pop(pop, evaluate_values_of))
+        callback.store_intermediate_problem(problem)
+
     @staticmethod
     def _normalize_pop(pop: Population, evaluate_values_of, nan_as_inf=True) -> Population:
         """Ensure that the matrices in a Population are two-dimensional"""
@@ -248,3 +514,7 @@ class ArchOptEvaluator(Evaluator):
 
             pop_data[key] = data
         return Population.new(**pop_data)
+
+
+def _evaluate_batch(problem: Problem, x: np.ndarray, evaluate_values_of, **kwargs) -> dict:
+    return problem.evaluate(x, return_values_of=evaluate_values_of, return_as_dictionary=True, **kwargs)
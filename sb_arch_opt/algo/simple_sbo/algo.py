@@ -19,6 +19,7 @@ import timeit
 import logging
 import numpy as np
 from typing import *
+from scipy.spatial import cKDTree
 from sb_arch_opt.sampling import *
 from sb_arch_opt.algo.pymoo_interface import *
 from sb_arch_opt.problem import ArchOptProblemBase
@@ -43,6 +44,7 @@ from pymoo.optimize import minimize
 try:
     from smt.surrogate_models.surrogate_model import SurrogateModel
     from sb_arch_opt.algo.simple_sbo.infill import *
+    from sb_arch_opt.algo.simple_sbo.krg_update import *
 except ImportError:
     pass
 
@@ -99,10 +101,10 @@ class InfillAlgorithm(Algorithm):
         if self.survival is not None:
             self.pop = self.survival.do(self.problem, self.pop, self.init_size, algorithm=self)
 
-    def store_intermediate_results(self, results_folder: str):
+    def store_intermediate_results(self, results_folder: str, append=False):
         """Enable intermediate results storage to support restarting"""
-        self.evaluator = ArchOptEvaluator(extreme_barrier=False, results_folder=results_folder)
-        self.callback = ResultsStorageCallback(results_folder, callback=self.callback)
+        self.evaluator = ArchOptEvaluator(extreme_barrier=False, results_folder=results_folder, append=append)
+        self.callback = ResultsStorageCallback(results_folder, callback=self.callback, append=append)
 
     def initialize_from_previous_results(self, problem: ArchOptProblemBase, result_folder: str) -> bool:
         """Initialize the SBO algorithm from previously stored results"""
@@ -110,13 +112,33 @@ class InfillAlgorithm(Algorithm):
 
 
 class SBOInfill(InfillCriterion):
-    """The main implementation of the SBO infill search"""
+    """
+    The main implementation of the SBO infill search.
+
+    If a full_retrain_interval is given, the surrogate model is only fully retrained (including its hyperparameters)
+    every so many infill iterations; in between, new points are added to the model incrementally (only supported for
+    Kriging models). The normalization of the outputs is then kept the same as for the last full retrain. A full retrain
+    also happens if previous training points change (e.g. the values of failed points).
+
+    If a batch_strategy is given, batches of infill points are selected sequentially: after each selected point, the
+    model is updated with a fantasized observation at that point (without retraining it), so that the next point is
+    selected elsewhere. Strategies (only supported for Kriging models):
+    - kriging_believer: the fantasized observation is the model prediction
+    - constant_liar: the fantasized objective values are the minimum of the training values (constraint values are
+      predicted)
+    """
+
+    batch_strategies = ['kriging_believer', 'constant_liar']
 
     _exclude = ['_surrogate_model', 'opt_results']
 
     def __init__(self, surrogate_model: 'SurrogateModel', infill: SurrogateInfill, pop_size=None,
                  termination: Union[Termination, int] = None, verbose=False, repair: Repair = None,
-                 eliminate_duplicates: DuplicateElimination = None, force_new_points: bool = True, **kwargs):
+                 eliminate_duplicates: DuplicateElimination = None, force_new_points: bool = True,
+                 full_retrain_interval: int = None, batch_strategy: str = None, **kwargs):
+
+        if batch_strategy is not None and batch_strategy not in self.batch_strategies:
+            raise ValueError(f'Unknown batch strategy: {batch_strategy!r}')
 
         if eliminate_duplicates is None:
             eliminate_duplicates = LargeDuplicateElimination()
@@ -137,7 +159,11 @@ class SBOInfill(InfillCriterion):
         self.y_train_max = None
         self.y_train_centered = None
         self.n_train = 0
+        self.n_train_update = 0
         self.time_train = None
+        self.full_retrain_interval = full_retrain_interval
+        self._n_since_full_train = 0
+        self.batch_strategy = batch_strategy
         self.pf_estimate = None
 
         self.pop_size = pop_size or 100
@@ -233,27 +259,37 @@ class SBOInfill(InfillCriterion):
         x, y = self._get_xy_train(x, y)
 
         # Normalize training values
-        x_norm = self._normalize(x)
+        x_train_prev, y_train_prev = self.x_train, self.y_train
+        self.x_train = self._normalize(x)
+        self.pf_estimate = None
+
+        # Add the new points to the model, normalized the same way as the previous training points
+        if self._can_update_model(x_train_prev):
+            self.y_train = self._normalize_y_train(y, y_min=self.y_train_min, y_max=self.y_train_max)[0]
+            if self._update_model(x_train_prev, y_train_prev):
+                return
+
+        # Train the model
+        self.y_train, self.y_train_min, self.y_train_max, self.y_train_centered = self._normalize_y_train(y)
+        self._train_model()
 
+    def _normalize_y_train(self, y: np.ndarray, y_min=None, y_max=None):
         n_obj = self.problem.n_obj
-        f_norm, self.y_train_min, self.y_train_max = self._normalize_y(y[:, :n_obj])
-        self.y_train_centered = [False]*f_norm.shape[1]
+        f_norm, f_min, f_max = self._normalize_y(
+            y[:, :n_obj], y_min=None if y_min is None else y_min[:n_obj], y_max=None if y_max is None else y_max[:n_obj])
+        y_train_centered = [False]*f_norm.shape[1]
         y_norm = f_norm
 
         if self.problem.n_ieq_constr > 0:
-            g_norm, g_min, g_max = self._normalize_y(y[:, n_obj:], keep_centered=True)
+            g_norm, g_min, g_max = self._normalize_y(
+                y[:, n_obj:], keep_centered=True, y_min=None if y_min is None else y_min[n_obj:],
+                y_max=None if y_max is None else y_max[n_obj:])
             y_norm = np.column_stack([y_norm, g_norm])
 
-            self.y_train_min = np.append(self.y_train_min, g_min)
-            self.y_train_max = np.append(self.y_train_max, g_max)
-            self.y_train_centered += [True]*g_norm.shape[1]
+            f_min, f_max = np.append(f_min, g_min), np.append(f_max, g_max)
+            y_train_centered += [True]*g_norm.shape[1]
 
-        # Train the model
-        self.x_train = x_norm
-        self.y_train = y_norm
-
-        self.pf_estimate = None
-        self._train_model()
+        return y_norm, f_min, f_max, y_train_centered
 
     def _get_xy_train(self, x: np.ndarray, y: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
         """Replace failed points with current worst values"""
@@ -272,12 +308,46 @@ class SBOInfill(InfillCriterion):
 
     def _train_model(self):
         s = timeit.default_timer()
+
+        # Use the previous hyperparameters as starting point if retraining periodically
+        if self.full_retrain_interval is not None and supports_krg_update(self.surrogate_model):
+            self.surrogate_model.options['theta0'] = np.array(self.surrogate_model.optimal_theta)
+
         self.surrogate_model.set_training_values(self.x_train, self.y_train)
         self.infill.set_samples(self.x_train, self.y_train)
 
         self.surrogate_model.train()
         self.n_train += 1
+        self._n_since_full_train = 0
+        self.time_train = timeit.default_timer()-s
+
+    def _can_update_model(self, x_train_prev: Optional[np.ndarray]) -> bool:
+        interval = self.full_retrain_interval
+        return interval is not None and self._n_since_full_train < interval-1 and x_train_prev is not None
+
+    def _update_model(self, x_train_prev: Optional[np.ndarray], y_train_prev: Optional[np.ndarray]) -> bool:
+        """Add new training points to the model without retraining it; only possible if the previous training points
+        (including their normalized outputs) did not change"""
+        if not self._can_update_model(x_train_prev):
+            return False
+
+        n_prev = x_train_prev.shape[0]
+        if self.x_train.shape[0] <= n_prev or not np.array_equal(self.x_train[:n_prev, :], x_train_prev) \
+                or not np.array_equal(self.y_train[:n_prev, :], y_train_prev):
+            return False
+        if not supports_krg_update(self.surrogate_model):
+            return False
+
+        s = timeit.default_timer()
+        if not update_krg(self.surrogate_model, self.x_train[n_prev:, :], self.y_train[n_prev:, :]):
+            return False
+        self.infill.set_samples(self.x_train, self.y_train)
+
+        self.n_train += 1
+        self.n_train_update += 1
+        self._n_since_full_train += 1
         self.time_train = timeit.default_timer()-s
+        return True
 
     def _normalize(self, x: np.ndarray) -> np.ndarray:
         return normalize(x, self.problem.xl, self.problem.xu)
@@ -309,8 +379,49 @@ class SBOInfill(InfillCriterion):
         return (y_norm*norm) + y_min
 
     def _generate_infill_points(self, n_infill: int) -> Population:
+        if self.batch_strategy is not None and n_infill > 1 and supports_krg_update(self.surrogate_model):
+            return self._generate_infill_batch(n_infill)
+        return self._search_infill_points(n_infill)
+
+    def _generate_infill_batch(self, n_infill: int) -> Population:
+        """Sequentially select infill points, updating a copy of the model with fantasized observations"""
+        model, x_train, y_train = self._surrogate_model, self.x_train, self.y_train
+        fantasy_model = copy.deepcopy(model)
+        self._surrogate_model = self.infill.surrogate_model = fantasy_model
+        n_obj = self.problem.n_obj
+        try:
+            x_selected = []
+            for _ in range(n_infill):
+                x_pending_norm = self._normalize(np.row_stack(x_selected)) if len(x_selected) > 0 else None
+                x = self._search_infill_points(1, x_pending_norm=x_pending_norm).get('X')
+                if x.shape[0] == 0:
+                    break
+                x_selected.append(x)
+
+                # Add the fantasized observations to the model: for the constant liar, only the objectives are lied
+                # about, constraints are predicted
+                x_norm = self._normalize(x)
+                y_fantasy = fantasy_model.predict_values(x_norm)
+                if self.batch_strategy == 'constant_liar':
+                    y_fantasy[:, :n_obj] = np.min(y_train[:, :n_obj], axis=0)
+
+                if not update_krg(fantasy_model, x_norm, y_fantasy):
+                    break
+                self.x_train = np.row_stack([self.x_train, x_norm])
+                self.y_train = np.row_stack([self.y_train, y_fantasy])
+                self.infill.set_samples(self.x_train, self.y_train)
+
+        finally:
+            self._surrogate_model = self.infill.surrogate_model = model
+            self.x_train, self.y_train = x_train, y_train
+            self.infill.set_samples(x_train, y_train)
+
+        x = np.row_stack(x_selected) if len(x_selected) > 0 else np.zeros((0, self.problem.n_var))
+        return Population.new(X=x)
+
+    def _search_infill_points(self, n_infill: int, x_pending_norm: np.ndarray = None) -> Population:
         # Create infill problem and algorithm
-        problem = self._get_infill_problem()
+        problem = self._get_infill_problem(x_pending_norm=x_pending_norm)
         algorithm = self._get_infill_algorithm()
         termination = self._get_termination(n_obj=problem.n_obj)
 
@@ -350,6 +461,7 @@ class SBOInfill(InfillCriterion):
         infill = FunctionEstimateInfill()
         infill.initialize(self.problem, self.surrogate_model)
         infill.set_samples(self.x_train, self.y_train)
+        infill.share_prediction_cache(self.infill)
 
         problem = self._get_infill_problem(infill, force_new_points=False)
         algorithm = self._get_infill_algorithm()
@@ -364,13 +476,16 @@ class SBOInfill(InfillCriterion):
         self.pf_estimate = self._denormalize_y(selected_pop.get('F'), y_min=f_min, y_max=f_max)
         return self.pf_estimate
 
-    def _get_infill_problem(self, infill: SurrogateInfill = None, force_new_points=None):
+    def _get_infill_problem(self, infill: SurrogateInfill = None, force_new_points=None,
+                            x_pending_norm: np.ndarray = None):
         if infill is None:
             infill = self.infill
         if force_new_points is None:
             force_new_points = self.force_new_points
 
         x_exist_norm = self._normalize(self.total_pop.get('X')) if force_new_points else None
+        if x_exist_norm is not None and x_pending_norm is not None:
+            x_exist_norm = np.row_stack([x_exist_norm, x_pending_norm])
         return SurrogateInfillOptimizationProblem(infill, self.problem, x_exist_norm=x_exist_norm)
 
     def _get_termination(self, n_obj):
@@ -432,6 +547,17 @@ class SurrogateInfillOptimizationProblem(Problem):
             n_constr += 1
         self.eliminate_duplicates = LargeDuplicateElimination()
 
+        # The existing points do not change during the infill search, so they are indexed once: a hash set of the
+        # design vectors if there are only discrete variables, a KD-tree otherwise
+        self._x_exist_hashes: Optional[set] = None
+        self._x_exist_tree: Optional[cKDTree] = None
+        if self.force_new_points:
+            is_cont_mask = getattr(problem, 'is_cont_mask', np.ones((n_var,), dtype=bool))
+            if np.any(is_cont_mask):
+                self._x_exist_tree = cKDTree(x_exist_norm)
+            else:
+                self._x_exist_hashes = set(self._get_row_hashes(x_exist_norm))
+
         super(SurrogateInfillOptimizationProblem, self).__init__(
             n_var=n_var, n_obj=n_obj, n_constr=n_constr, xl=xl, xu=xu)
 
@@ -451,8 +577,7 @@ class SurrogateInfillOptimizationProblem(Problem):
         # Add additional constraint to force the selection of new (discrete) points
         if self.force_new_points:
             g_force_new = np.zeros((x.shape[0],))
-            _, _, is_dup = self.eliminate_duplicates.do(Population.new(X=x), self.pop_exist_norm, return_indices=True)
-            g_force_new[is_dup] = 1.
+            g_force_new[self._get_is_duplicate(x)] = 1.
 
             g = np.column_stack([g, g_force_new])
 
@@ -460,6 +585,26 @@ class SurrogateInfillOptimizationProblem(Problem):
             raise RuntimeError(f'Wrong constraint results shape: {g.shape!r} != {(x.shape[0], self.n_constr)!r}')
         out['G'] = g
 
+    def _get_is_duplicate(self, x: np.ndarray) -> np.ndarray:
+        """Whether design vectors are duplicates of previous design vectors or of existing points"""
+        epsilon = self.eliminate_duplicates.epsilon
+        is_duplicate = self.eliminate_duplicates.eliminate(x, epsilon=epsilon)
+
+        if self._x_exist_hashes is not None:
+            x_exist_hashes = self._x_exist_hashes
+            is_duplicate |= np.array([row_hash in x_exist_hashes for row_hash in self._get_row_hashes(x)], dtype=bool)
+
+        elif self._x_exist_tree is not None:
+            dist, _ = self._x_exist_tree.query(x, k=1, p=1, distance_upper_bound=epsilon)
+            is_duplicate |= dist < epsilon
+
+        return is_duplicate
+
+    @staticmethod
+    def _get_row_hashes(x: np.ndarray) -> List[bytes]:
+        x = np.ascontiguousarray(np.asarray(x, dtype=float)+0.)  # Adding 0 replaces -0. by 0.
+        return [row.tobytes() for row in x]
+
 
 class NormalizedRepair(Repair):
     """Repair to be used during infill search: the infill search space is normalized compared to the original problem"""
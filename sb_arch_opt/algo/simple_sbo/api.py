@@ -56,7 +56,8 @@ def get_simple_sbo_rbf(init_size: int = 100, **kwargs):
     return _get_sbo(sm, FunctionEstimateInfill(), init_size=init_size, **kwargs)
 
 
-def get_simple_sbo_krg(init_size: int = 100, use_mvpf=True, use_ei=False, min_pof=.5, **kwargs):
+def get_simple_sbo_krg(init_size: int = 100, use_mvpf=True, use_ei=False, min_pof=.5, full_retrain_interval=None,
+                       batch_strategy=None, **kwargs):
     """
     Get a simple SBO algorithm using a Kriging model as its surrogate model.
     It can use one of the following infill strategies:
@@ -64,6 +65,10 @@ def get_simple_sbo_krg(init_size: int = 100, use_mvpf=True, use_ei=False, min_po
     - Minimum Variance of the Pareto Front (MVPF)
     - Directly optimizing on the mean prediction
     All strategies support constraints.
+
+    If full_retrain_interval is given, the Kriging hyperparameters are only retrained every so many infill iterations.
+    To select several infill points per iteration (infill_size), a batch_strategy (kriging_believer or constant_liar)
+    can be given, which selects diverse points by updating the model with fantasized observations.
     """
     _check_dependencies()
     sm = KRG(print_global=False)
@@ -71,13 +76,16 @@ def get_simple_sbo_krg(init_size: int = 100, use_mvpf=True, use_ei=False, min_po
         infill = ExpectedImprovementInfill(min_pof=min_pof)  # For single objective
     else:
         infill = MinVariancePFInfill(min_pof=min_pof) if use_mvpf else FunctionEstimatePoFInfill(min_pof=min_pof)
-    return _get_sbo(sm, infill, init_size=init_size, **kwargs)
+    return _get_sbo(sm, infill, init_size=init_size, full_retrain_interval=full_retrain_interval,
+                    batch_strategy=batch_strategy, **kwargs)
 
 
 def _get_sbo(sm: 'SurrogateModel', infill: 'SurrogateInfill', infill_size: int = 1, init_size: int = 100,
-             infill_pop_size: int = 100, infill_gens: int = 100, repair=None, **kwargs):
+             infill_pop_size: int = 100, infill_gens: int = 100, repair=None, full_retrain_interval=None,
+             batch_strategy=None, **kwargs):
     if repair is None:
         repair = ArchOptRepair()
 
-    return SBOInfill(sm, infill, pop_size=infill_pop_size, termination=infill_gens, repair=repair, verbose=True)\
+    return SBOInfill(sm, infill, pop_size=infill_pop_size, termination=infill_gens, repair=repair, verbose=True,
+                     full_retrain_interval=full_retrain_interval, batch_strategy=batch_strategy)\
         .algorithm(infill_size=infill_size, init_size=init_size, **kwargs)
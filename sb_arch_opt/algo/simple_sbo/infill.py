@@ -29,6 +29,9 @@ __all__ = ['SurrogateInfill', 'FunctionEstimateInfill', 'PoFInfill', 'FunctionEs
            'ExpectedImprovementInfill', 'MinVariancePFInfill', 'normalize', 'denormalize']
 
 try:
+    from scipy import linalg
+    from smt.utils.kriging_utils import differences
+    from smt.surrogate_models.krg_based import KrgBased
     from smt.surrogate_models.surrogate_model import SurrogateModel
 except ImportError:
     pass
@@ -37,7 +40,8 @@ except ImportError:
 class SurrogateInfill:
     """Base class for surrogate infill criteria"""
 
-    _exclude = ['surrogate_model']
+    _exclude = ['surrogate_model', '_prediction_cache']
+    _predict_chunk_max_elements = 2**22
 
     def __init__(self):
         self.problem: Optional[Problem] = None
@@ -49,6 +53,13 @@ class SurrogateInfill:
         self.x_train = None
         self.y_train = None
 
+        # Nr of points predicted at once; if not given, it is determined from the nr of training points
+        self.predict_chunk_size: Optional[int] = None
+
+        # Predictions (mean and variance) of the current training round, keyed by design vector
+        self.cache_predictions = True
+        self._prediction_cache: Optional[Dict[bytes, Tuple[np.ndarray, Optional[np.ndarray]]]] = {}
+
         self.f_infill_log = []
         self.g_infill_log = []
         self.n_eval_infill = 0
@@ -67,27 +78,101 @@ class SurrogateInfill:
     def set_samples(self, x_train: np.ndarray, y_train: np.ndarray):
         self.x_train = x_train
         self.y_train = y_train
+        self.reset_prediction_cache()
 
-    def predict(self, x: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
-        try:
-            y = self.surrogate_model.predict_values(x)
-        except FloatingPointError:
-            y = np.zeros((x.shape[0], self.surrogate_model.ny))*np.nan
+    def reset_prediction_cache(self):
+        """Reset cached predictions; should be called whenever the surrogate model changes"""
+        self._prediction_cache = {}
+
+    def share_prediction_cache(self, infill: 'SurrogateInfill'):
+        """Use the prediction cache of another infill criterion that uses the same surrogate model"""
+        if infill._prediction_cache is None:
+            infill.reset_prediction_cache()
+        self._prediction_cache = infill._prediction_cache
 
+    def predict(self, x: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        y, _ = self._predict_y(x, mean=True, variance=False)
         return self._split_f_g(y)
 
     def predict_variance(self, x: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
-
-        try:
-            y_var = np.zeros((x.shape[0], self.surrogate_model.ny))
-            for i in range(x.shape[0]):
-                y_var[i, :] = self.surrogate_model.predict_variances(x[[i], :])
-
-        except FloatingPointError:
-            y_var = np.zeros((x.shape[0], self.surrogate_model.ny))*np.nan
-
+        _, y_var = self._predict_y(x, mean=False, variance=True)
         return self._split_f_g(y_var)
 
+    def predict_mean_variance(self, x: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Predict mean and variance together (f, g, f_var, g_var): for Kriging models the correlation matrix between
+        the prediction and training points is then only computed once"""
+        y, y_var = self._predict_y(x, mean=True, variance=True)
+        return self._split_f_g(y) + self._split_f_g(y_var)
+
+    def _predict_y(self, x: np.ndarray, mean=True, variance=False) -> Tuple[np.ndarray, np.ndarray]:
+        """Predict mean and/or variance, reusing cached predictions: missing predictions are computed for both mean and
+        variance if the variance is needed by the infill criterion"""
+        if not self.cache_predictions:
+            return self._predict_y_chunked(x, mean=mean, variance=variance)
+
+        cache = self._prediction_cache
+        if cache is None:
+            cache = self._prediction_cache = {}
+
+        keys = [row.tobytes() for row in np.asarray(x, dtype=float)+0.]  # Adding 0 replaces -0. by 0.
+        i_missing = [i for i, key in enumerate(keys) if key not in cache or (variance and cache[key][1] is None)]
+        if len(i_missing) > 0:
+            y_missing, y_var_missing = self._predict_y_chunked(
+                x[i_missing, :], mean=True, variance=variance or self.needs_variance)
+            for i_row, i in enumerate(i_missing):
+                cache[keys[i]] = (y_missing[i_row, :], None if y_var_missing is None else y_var_missing[i_row, :])
+
+        ny = self.surrogate_model.ny
+        y = np.array([cache[key][0] for key in keys]).reshape((len(keys), ny)) if mean else None
+        y_var = np.array([cache[key][1] for key in keys]).reshape((len(keys), ny)) if variance else None
+        return y, y_var
+
+    def _predict_y_chunked(self, x: np.ndarray, mean=True, variance=False) -> Tuple[np.ndarray, np.ndarray]:
+        """Predict mean and/or variance in chunks of rows, limiting the size of the intermediate matrices"""
+        n_chunk = self._get_predict_chunk_size(x)
+        y = np.zeros((x.shape[0], self.surrogate_model.ny)) if mean else None
+        y_var = np.zeros((x.shape[0], self.surrogate_model.ny)) if variance else None
+
+        for i_start in range(0, x.shape[0], n_chunk):
+            i_chunk = slice(i_start, i_start+n_chunk)
+            y_chunk, y_var_chunk = self._predict_y_chunk(x[i_chunk, :], mean=mean, variance=variance)
+            if mean:
+                y[i_chunk, :] = y_chunk
+            if variance:
+                y_var[i_chunk, :] = y_var_chunk
+
+        return y, y_var
+
+    def _get_predict_chunk_size(self, x: np.ndarray) -> int:
+        if self.predict_chunk_size is not None:
+            return max(1, int(self.predict_chunk_size))
+
+        n_train = self.x_train.shape[0] if self.x_train is not None else 1
+        return max(1, int(self._predict_chunk_max_elements/(max(1, n_train)*max(1, x.shape[1]))))
+
+    def _predict_y_chunk(self, x: np.ndarray, mean=True, variance=False) -> Tuple[np.ndarray, np.ndarray]:
+        model = self.surrogate_model
+        if mean and variance and _supports_krg_mean_variance(model):
+            try:
+                return _predict_krg_mean_variance(model, x)
+            except FloatingPointError:
+                pass
+
+        y = y_var = None
+        if mean:
+            try:
+                y = model.predict_values(x)
+            except FloatingPointError:
+                y = np.zeros((x.shape[0], model.ny))*np.nan
+
+        if variance:
+            try:
+                y_var = model.predict_variances(x)
+            except FloatingPointError:
+                y_var = np.zeros((x.shape[0], model.ny))*np.nan
+
+        return y, y_var
+
     def _normalize(self, x) -> np.ndarray:
         return normalize(x, self.problem.xl, self.problem.xu)
 
@@ -190,8 +275,7 @@ class PoFInfill(SurrogateInfill):
         return self.problem.n_constr
 
     def _evaluate(self, x: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
-        f, g = self.predict(x)
-        f_var, g_var = self.predict_variance(x)
+        f, g, f_var, g_var = self.predict_mean_variance(x)
 
         # Calculate Probability of Feasibility and transform to constraint (g < 0 --> PoF(g) > PoF_min)
         g_pof = g
@@ -243,30 +327,61 @@ class ExpectedImprovementInfill(PoFInfill):
     Jones, D.R., "Efficient Global Optimization of Expensive Black-Box Functions", 1998, 10.1023/A:1008306431147
     """
 
+    _n_closest_max_elements = 2**22
+
+    def __init__(self, *args, **kwargs):
+        super(ExpectedImprovementInfill, self).__init__(*args, **kwargs)
+        self._pareto_norm = None
+
+    def set_samples(self, x_train: np.ndarray, y_train: np.ndarray):
+        super(ExpectedImprovementInfill, self).set_samples(x_train, y_train)
+        self._pareto_norm = None
+
     def get_n_infill_objectives(self) -> int:
         return self.problem.n_obj
 
     def _evaluate_f(self, f_predict: np.ndarray, f_var_predict: np.ndarray) -> np.ndarray:
-        return self._evaluate_f_ei(f_predict, f_var_predict, self.y_train[:, :f_predict.shape[1]])
+        # The normalized Pareto front only depends on the training points
+        if getattr(self, '_pareto_norm', None) is None:
+            self._pareto_norm = self._get_pareto_norm(self.y_train[:, :f_predict.shape[1]])
+
+        return self._evaluate_f_ei(f_predict, f_var_predict, self.y_train[:, :f_predict.shape[1]],
+                                   pareto_norm=self._pareto_norm)
 
     @classmethod
-    def _evaluate_f_ei(cls, f: np.ndarray, f_var: np.ndarray, f_current: np.ndarray) -> np.ndarray:
-        # Normalize current and predicted objectives
+    def _get_pareto_norm(cls, f_current: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Get the normalized Pareto front, and the nadir and ideal points used for normalization"""
         f_pareto = cls.get_pareto_front(f_current)
         nadir_point, ideal_point = np.max(f_pareto, axis=0), np.min(f_pareto, axis=0)
         f_pareto_norm = normalize(f_pareto, xu=nadir_point, xl=ideal_point)
+        return f_pareto_norm, nadir_point, ideal_point
+
+    @classmethod
+    def _evaluate_f_ei(cls, f: np.ndarray, f_var: np.ndarray, f_current: np.ndarray,
+                       pareto_norm: Tuple[np.ndarray, np.ndarray, np.ndarray] = None) -> np.ndarray:
+        # Normalize current and predicted objectives
+        if pareto_norm is None:
+            pareto_norm = cls._get_pareto_norm(f_current)
+        f_pareto_norm, nadir_point, ideal_point = pareto_norm
         f_norm, f_var_norm = cls._normalize_f_var(f, f_var, nadir_point, ideal_point)
 
         # Get EI for each point using closest point in the Pareto front
-        f_ei = np.empty(f.shape)
-        for i in range(f.shape[0]):
-            i_par_closest = np.argmin(np.sum((f_pareto_norm-f_norm[i, :])**2, axis=1))
-            f_par_min = f_pareto_norm[i_par_closest, :]
-            ei = cls._ei(f_par_min, f_norm[i, :], f_var_norm[i, :])
-            ei[ei < 0.] = 0.
-            f_ei[i, :] = 1.-ei
+        f_par_min = f_pareto_norm[cls._get_i_closest(f_norm, f_pareto_norm), :]
+        ei = cls._ei(f_par_min, f_norm, f_var_norm)
+        ei[ei < 0.] = 0.
+        return 1.-ei
 
-        return f_ei
+    @classmethod
+    def _get_i_closest(cls, f_norm: np.ndarray, f_pareto_norm: np.ndarray) -> np.ndarray:
+        """Get the index of the closest Pareto point for each point, in chunks to limit the size of the distance
+        matrix"""
+        n_chunk = max(1, int(cls._n_closest_max_elements/max(1, f_pareto_norm.size)))
+        i_closest = np.empty((f_norm.shape[0],), dtype=int)
+        for i_start in range(0, f_norm.shape[0], n_chunk):
+            f_chunk = f_norm[i_start:i_start+n_chunk, :]
+            dist_sq = np.sum((f_chunk[:, None, :]-f_pareto_norm[None, :, :])**2, axis=2)
+            i_closest[i_start:i_start+n_chunk] = np.argmin(dist_sq, axis=1)
+        return i_closest
 
     @staticmethod
     def _normalize_f_var(f: np.ndarray, f_var: np.ndarray, nadir_point, ideal_point):
@@ -329,3 +444,35 @@ def normalize(x: np.ndarray, xl, xu) -> np.ndarray:
 
 def denormalize(x_norm: np.ndarray, xl, xu) -> np.ndarray:
     return x_norm*(xu-xl)+xl
+
+
+def _supports_krg_mean_variance(model) -> bool:
+    """Whether mean and variance of a Kriging model can be predicted together (needs the default prediction routines
+    of continuous Kriging models)"""
+    try:
+        return isinstance(model, KrgBased) and model.options['categorical_kernel'] is None \
+            and type(model)._predict_values is KrgBased._predict_values \
+            and type(model)._predict_variances is KrgBased._predict_variances
+    except NameError:
+        return False
+
+
+def _predict_krg_mean_variance(model: 'KrgBased', x: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Predict values and variances of a Kriging model; follows KrgBased._predict_values and
+    KrgBased._predict_variances, but computes the correlation with the training points only once"""
+    n_eval = x.shape[0]
+    x_cont = (x - model.X_offset) / model.X_scale
+    d = model._componentwise_distance(differences(x_cont, Y=model.X_norma.copy()))
+    r = model._correlation_types[model.options['corr']](model.optimal_theta, d).reshape(n_eval, model.nt)
+    regression = model._regression_types[model.options['poly']]
+
+    par = model.optimal_par
+    y_ = np.dot(regression(x_cont), par['beta']) + np.dot(r, par['gamma'])
+    y = (model.y_mean + model.y_std * y_).reshape((n_eval, model.ny))
+
+    # Note: as in KrgBased._predict_variances, the regression is evaluated on the non-normalized inputs
+    rt = linalg.solve_triangular(par['C'], r.T, lower=True)
+    u = linalg.solve_triangular(par['G'].T, np.dot(par['Ft'].T, rt) - regression(x).T)
+    mse = np.einsum('i,j -> ji', par['sigma2'], 1. - (rt ** 2.).sum(axis=0) + (u ** 2.).sum(axis=0))
+    mse[mse < 0.] = 0.
+    return y, mse.reshape((n_eval, model.ny))
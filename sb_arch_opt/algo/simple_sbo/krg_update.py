@@ -0,0 +1,105 @@
+"""
+Licensed under the GNU General Public License, Version 3.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.gnu.org/licenses/gpl-3.0.html.en
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Copyright: (c) 2023, Deutsches Zentrum fuer Luft- und Raumfahrt e.V.
+Contact: jasper.bussemaker@dlr.de
+"""
+import numpy as np
+from scipy import linalg
+
+try:
+    from smt.utils.kriging_utils import differences
+    from smt.surrogate_models.krg_based import KrgBased
+except ImportError:
+    pass
+
+__all__ = ['supports_krg_update', 'update_krg']
+
+
+def supports_krg_update(model) -> bool:
+    """Whether training points can be added to a trained Kriging model without retraining it: supported for
+    continuous, noise-free Kriging models"""
+    try:
+        if not isinstance(model, KrgBased) or model.name != 'Kriging':
+            return False
+    except NameError:
+        return False
+
+    if model.options['categorical_kernel'] is not None or model.options['eval_noise'] \
+            or model.options['use_het_noise']:
+        return False
+
+    optimal_par = getattr(model, 'optimal_par', None)
+    return optimal_par is not None and 'C' in optimal_par
+
+
+def update_krg(model: 'KrgBased', x_add: np.ndarray, y_add: np.ndarray) -> bool:
+    """
+    Add training points to a trained Kriging model, keeping its hyperparameters and input/output standardization.
+    The Cholesky factor of the correlation matrix is extended with the rows of the new points (a rank-k update), after
+    which the regression and Gaussian process weights are recomputed as in KrgBased._reduced_likelihood_function.
+
+    Returns False (leaving the model unchanged) if the extended correlation matrix is numerically not positive definite.
+    """
+    x_add, y_add = np.atleast_2d(x_add), np.atleast_2d(y_add)
+    if x_add.shape[0] == 0:
+        return True
+
+    x_norma_add = (x_add - model.X_offset) / model.X_scale
+    y_norma_add = (y_add - model.y_mean) / model.y_std
+    x_norma = np.row_stack([model.X_norma, x_norma_add])
+    y_norma = np.row_stack([np.atleast_2d(model.y_norma.T).T, y_norma_add])
+    n_prev, n_add = model.X_norma.shape[0], x_add.shape[0]
+
+    # Correlation of the new points with the previous points and with each other
+    theta = model.optimal_theta
+    corr = model._correlation_types[model.options['corr']]
+    r_prev_add = corr(theta, model._componentwise_distance(differences(x_norma_add, Y=model.X_norma)))\
+        .reshape(n_add, n_prev).T
+    r_add = corr(theta, model._componentwise_distance(differences(x_norma_add, Y=x_norma_add)))\
+        .reshape(n_add, n_add)
+    r_add[np.diag_indices(n_add)] = 1. + model.options['nugget'] + np.sum(getattr(model, 'noise0', 0.))
+
+    # Extend the Cholesky factor: C = [[C_prev, 0], [L21, L22]]
+    par = model.optimal_par
+    l21 = linalg.solve_triangular(par['C'], r_prev_add, lower=True).T
+    try:
+        l22 = linalg.cholesky(r_add - np.dot(l21, l21.T), lower=True)
+    except (linalg.LinAlgError, ValueError):
+        return False
+
+    c = np.zeros((n_prev+n_add, n_prev+n_add))
+    c[:n_prev, :n_prev] = par['C']
+    c[n_prev:, :n_prev] = l21
+    c[n_prev:, n_prev:] = l22
+
+    # Recompute the generalized least squares solution
+    f = model._regression_types[model.options['poly']](x_norma)
+    ft = linalg.solve_triangular(c, f, lower=True)
+    q, g = linalg.qr(ft, mode='economic')
+    yt = linalg.solve_triangular(c, y_norma, lower=True)
+    beta = linalg.solve_triangular(g, np.dot(q.T, yt))
+    rho = yt - np.dot(ft, beta)
+    sigma2 = (rho ** 2.).sum(axis=0) / x_norma.shape[0]
+
+    model.optimal_par = {
+        'sigma2': sigma2 * model.y_std ** 2., 'beta': beta, 'gamma': linalg.solve_triangular(c.T, rho), 'C': c,
+        'Ft': ft, 'G': g, 'Q': q,
+    }
+
+    x_train, y_train = model.training_points[None][0]
+    model.training_points[None][0] = [np.row_stack([x_train, x_add]), np.row_stack([y_train, y_add])]
+    model.X_train = model.training_points[None][0][0]
+    model.X_norma, model.y_norma, model.F = x_norma, y_norma, f
+    model.nt = x_norma.shape[0]
+    return True
@@ -0,0 +1,177 @@
+"""
+Licensed under the GNU General Public License, Version 3.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.gnu.org/licenses/gpl-3.0.html.en
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Copyright: (c) 2023, Deutsches Zentrum fuer Luft- und Raumfahrt e.V.
+Contact: jasper.bussemaker@dlr.de
+"""
+import numpy as np
+from typing import Tuple, Iterator, Callable
+
+__all__ = ['CompactDiscreteX', 'IndexedDiscreteX']
+
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+class CompactDiscreteX:
+    """
+    Compact representation of a set of discrete design vectors and their activeness information:
+    - Discrete variable values are stored in the smallest integer dtype that fits them
+    - Activeness information is bit-packed (8 variables per byte)
+    - Continuous variables are not stored if their values only depend on whether they are active or not (which is the
+      case if they only contain imputed values), otherwise they are stored as-is
+
+    Rows are only expanded to float design vectors and boolean activeness matrices when requested using `get`.
+    """
+
+    def __init__(self, x_discrete: np.ndarray, is_active_packed: np.ndarray, is_cont_mask: np.ndarray,
+                 x_cont_active: np.ndarray, x_cont_inactive: np.ndarray, x_cont: np.ndarray = None):
+        self.x_discrete = x_discrete
+        self.is_active_packed = is_active_packed
+        self.is_cont_mask = is_cont_mask
+        self.x_cont_active = x_cont_active
+        self.x_cont_inactive = x_cont_inactive
+        self.x_cont = x_cont
+        self._n_active_groups = None
+
+    @classmethod
+    def from_x(cls, x: np.ndarray, is_active: np.ndarray, is_cont_mask: np.ndarray) -> 'CompactDiscreteX':
+        is_cont_mask = np.array(is_cont_mask, dtype=bool)
+        is_discrete_mask = ~is_cont_mask
+
+        x_discrete = x[:, is_discrete_mask]
+        x_discrete = x_discrete.astype(cls._get_int_dtype(x_discrete))
+        is_active_packed = np.packbits(is_active.astype(bool), axis=1)
+
+        # Check whether continuous values are determined by their activeness
+        x_cont, is_act_cont = x[:, is_cont_mask], is_active[:, is_cont_mask]
+        x_cont_active, x_cont_inactive = np.zeros((x_cont.shape[1],)), np.zeros((x_cont.shape[1],))
+        is_const = True
+        for i_cont in range(x_cont.shape[1]):
+            for is_act_values, x_template in [(is_act_cont[:, i_cont], x_cont_active),
+                                              (~is_act_cont[:, i_cont], x_cont_inactive)]:
+                x_values = x_cont[is_act_values, i_cont]
+                if len(x_values) > 0:
+                    x_template[i_cont] = x_values[0]
+                    is_const &= bool(np.all(x_values == x_values[0]))
+
+        return cls(x_discrete, is_active_packed, is_cont_mask, x_cont_active, x_cont_inactive,
+                   x_cont=None if is_const else x_cont.astype(float))
+
+    @staticmethod
+    def _get_int_dtype(x_discrete: np.ndarray):
+        if x_discrete.size == 0:
+            return np.int8
+        return np.result_type(np.min_scalar_type(int(np.min(x_discrete))), np.min_scalar_type(int(np.max(x_discrete))))
+
+    @property
+    def n_var(self) -> int:
+        return len(self.is_cont_mask)
+
+    @property
+    def nbytes(self) -> int:
+        nbytes_cont = 0 if self.x_cont is None else self.x_cont.nbytes
+        return self.x_discrete.nbytes + self.is_active_packed.nbytes + nbytes_cont
+
+    def __len__(self):
+        return self.x_discrete.shape[0]
+
+    def get(self, idx: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Expand (a selection of) rows to design vectors (float) and activeness information (bool)"""
+        if idx is None:
+            idx = slice(None)
+
+        is_active = np.unpackbits(self.is_active_packed[idx, :], axis=1, count=self.n_var).astype(bool)
+
+        x = np.empty(is_active.shape)
+        is_cont_mask = self.is_cont_mask
+        x[:, ~is_cont_mask] = self.x_discrete[idx, :]
+        if self.x_cont is not None:
+            x[:, is_cont_mask] = self.x_cont[idx, :]
+        else:
+            x[:, is_cont_mask] = np.where(is_active[:, is_cont_mask], self.x_cont_active, self.x_cont_inactive)
+
+        return x, is_active
+
+    def iter_chunks(self, n_chunk=10000, row_sizes: np.ndarray = None) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """Expand rows in chunks of n_chunk rows; if row sizes are given (e.g. the nr of rows each design vector is
+        expanded into later), chunks instead contain rows with a total size of at most n_chunk (at least one row)"""
+        if row_sizes is None:
+            row_sizes = np.ones((len(self),), dtype=int)
+        size_cumulative = np.cumsum(row_sizes)
+
+        i_start = 0
+        while i_start < len(self):
+            size_before = size_cumulative[i_start-1] if i_start > 0 else 0
+            i_end = max(i_start+1, int(np.searchsorted(size_cumulative, size_before+n_chunk, side='right')))
+            yield self.get(np.arange(i_start, i_end))
+            i_start = i_end
+
+    def get_n_active_discrete(self) -> np.ndarray:
+        """Get the nr of active discrete variables for each design vector, without unpacking the activeness bits"""
+        return self.get_n_active(~self.is_cont_mask)
+
+    def get_n_active(self, mask: np.ndarray) -> np.ndarray:
+        """Get the nr of active variables (of the variables selected by the mask) for each design vector"""
+        mask_packed = np.packbits(np.asarray(mask, dtype=bool))
+        return np.sum(_POPCOUNT[self.is_active_packed & mask_packed], axis=1, dtype=int)
+
+    def get_n_active_groups(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Get the indices of the design vectors sorted by nr of active discrete variables, and the offsets (in sorted
+        order) and sizes of the groups with equal nr of active discrete variables; only determined once"""
+        if self._n_active_groups is None:
+            n_active = self.get_n_active_discrete()
+            i_sorted = np.argsort(n_active, kind='stable')
+            if len(i_sorted) < np.iinfo(np.int32).max:
+                i_sorted = i_sorted.astype(np.int32)
+
+            _, group_offsets, group_sizes = np.unique(n_active[i_sorted], return_index=True, return_counts=True)
+            self._n_active_groups = i_sorted, group_offsets, group_sizes
+        return self._n_active_groups
+
+    def get_arrays(self) -> dict:
+        arrays = {'x_discrete': self.x_discrete, 'is_active_packed': self.is_active_packed,
+                  'is_cont_mask': self.is_cont_mask, 'x_cont_active': self.x_cont_active,
+                  'x_cont_inactive': self.x_cont_inactive}
+        if self.x_cont is not None:
+            arrays['x_cont'] = self.x_cont
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays: dict) -> 'CompactDiscreteX':
+        return cls(arrays['x_discrete'], arrays['is_active_packed'], np.asarray(arrays['is_cont_mask'], dtype=bool),
+                   arrays['x_cont_active'], arrays['x_cont_inactive'], x_cont=arrays.get('x_cont'))
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(n={len(self)}, n_var={self.n_var}, nbytes={self.nbytes})'
+
+
+class IndexedDiscreteX:
+    """
+    Discrete design vectors that are not stored, but generated from their index (rank) on demand. Design vectors are
+    divided into groups (e.g. by nr of active discrete variables) that occupy consecutive index ranges.
+    """
+
+    def __init__(self, group_sizes: np.ndarray, unrank: Callable[[np.ndarray], Tuple[np.ndarray, np.ndarray]]):
+        self.group_sizes = group_sizes = np.array(group_sizes, dtype=np.int64)
+        self.group_offsets = np.cumsum(group_sizes)-group_sizes
+        self.unrank = unrank
+
+    def __len__(self):
+        return int(np.sum(self.group_sizes))
+
+    def get(self, idx: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Generate the design vectors (float) and activeness information (bool) at the given indices"""
+        return self.unrank(np.asarray(idx, dtype=np.int64))
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(n={len(self)}, n_groups={len(self.group_sizes)})'
@@ -0,0 +1,141 @@
+"""
+Licensed under the GNU General Public License, Version 3.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.gnu.org/licenses/gpl-3.0.html.en
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Copyright: (c) 2023, Deutsches Zentrum fuer Luft- und Raumfahrt e.V.
+Contact: jasper.bussemaker@dlr.de
+"""
+import os
+import sqlite3
+import logging
+import numpy as np
+from typing import List, Optional, Tuple
+from pymoo.core.population import Population
+
+__all__ = ['EvaluationDatabase']
+
+log = logging.getLogger('sb_arch_opt.eval_db')
+
+
+class EvaluationDatabase:
+    """
+    Persistent append-only store of evaluation results, backed by an SQLite database file. Results are indexed by a key
+    identifying the imputed design vector (see `ArchOptProblemBase.get_eval_keys`), so that points evaluated in
+    previous runs or by other optimization algorithms can be reused instead of evaluating them again.
+
+    The database can be shared between processes: the connection is (re)opened lazily, and is not pickled.
+    Attach it to a problem using `ArchOptProblemBase.set_eval_database`, which also stores the problem id
+    (`ArchOptProblemBase.get_problem_id`) to prevent reusing results of another problem.
+    """
+
+    version = 2
+    _n_query_batch = 500  # SQLite limits the number of parameters in one query
+
+    def __init__(self, db_path: str, n_var: int, n_obj: int, n_ieq_constr=0, n_eq_constr=0, x_tol=1e-10,
+                 problem_id: str = None):
+        self.db_path = db_path
+        self.problem_id = problem_id
+        self.n_var = n_var
+        self.n_obj = n_obj
+        self.n_ieq_constr = n_ieq_constr
+        self.n_eq_constr = n_eq_constr
+        self.x_tol = x_tol
+        self._conn: Optional[sqlite3.Connection] = None
+        self._init_db()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, timeout=60)
+        return self._conn
+
+    def _init_db(self):
+        db_folder = os.path.dirname(self.db_path)
+        if db_folder:
+            os.makedirs(db_folder, exist_ok=True)
+
+        meta = {'version': self.version, 'n_var': self.n_var, 'n_obj': self.n_obj,
+                'n_ieq_constr': self.n_ieq_constr, 'n_eq_constr': self.n_eq_constr, 'x_tol': self.x_tol,
+                'problem_id': self.problem_id}
+        with self.conn as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+            conn.execute('CREATE TABLE IF NOT EXISTS evaluations (key BLOB PRIMARY KEY, x BLOB, is_active BLOB, '
+                         'f BLOB, g BLOB, h BLOB)')
+            conn.executemany('INSERT OR IGNORE INTO meta (name, value) VALUES (?, ?)',
+                             [(name, repr(value)) for name, value in meta.items()])
+
+            # Check whether an existing database is compatible
+            stored_meta = dict(conn.execute('SELECT name, value FROM meta').fetchall())
+            for name, value in meta.items():
+                if stored_meta.get(name) != repr(value):
+                    raise ValueError(f'Incompatible evaluation database ({self.db_path}), {name} is '
+                                     f'{stored_meta.get(name)} instead of {value!r}')
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM evaluations').fetchone()[0]
+
+    def get(self, keys: List[bytes]) -> List[Optional[Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray,
+                                                            np.ndarray]]]:
+        """Get stored results (x, is_active, f, g, h) for a list of design vector keys; None if not stored"""
+        results = {}
+        for i in range(0, len(keys), self._n_query_batch):
+            keys_batch = keys[i:i+self._n_query_batch]
+            rows = self.conn.execute(f'SELECT key, x, is_active, f, g, h FROM evaluations '
+                                     f'WHERE key IN ({",".join("?"*len(keys_batch))})', keys_batch).fetchall()
+            for row in rows:
+                results[row[0]] = self._from_row(row[1:])
+
+        return [results.get(key) for key in keys]
+
+    def put(self, keys: List[bytes], x: np.ndarray, is_active: np.ndarray, f: np.ndarray, g: np.ndarray,
+            h: np.ndarray):
+        """Store evaluation results; results of keys that have already been stored are not overwritten"""
+        x, f, g, h = [np.atleast_2d(values).astype(np.float64) for values in [x, f, g, h]]
+        is_active = np.atleast_2d(is_active).astype(bool)
+        with self.conn as conn:
+            conn.executemany(
+                'INSERT OR IGNORE INTO evaluations (key, x, is_active, f, g, h) VALUES (?, ?, ?, ?, ?, ?)',
+                [(key, x[i, :].tobytes(), is_active[i, :].tobytes(), f[i, :].tobytes(), g[i, :].tobytes(),
+                  h[i, :].tobytes()) for i, key in enumerate(keys)])
+
+    def get_population(self) -> Population:
+        """Get all stored results as a Population (with X, is_active, F, G and H)"""
+        x, is_active, f, g, h = [], [], [], [], []
+        for row in self.conn.execute('SELECT x, is_active, f, g, h FROM evaluations ORDER BY rowid'):
+            for values, data in zip([x, is_active, f, g, h], self._from_row(row)):
+                values.append(data)
+
+        def _stack(values, n, dtype=float):
+            return np.array(values, dtype=dtype) if len(values) > 0 else np.zeros((0, n), dtype=dtype)
+
+        return Population.new(
+            X=_stack(x, self.n_var), is_active=_stack(is_active, self.n_var, dtype=bool), F=_stack(f, self.n_obj),
+            G=_stack(g, self.n_ieq_constr), H=_stack(h, self.n_eq_constr))
+
+    @staticmethod
+    def _from_row(row) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        x, is_active, f, g, h = row
+        return np.frombuffer(x), np.frombuffer(is_active, dtype=bool), np.frombuffer(f), np.frombuffer(g), \
+            np.frombuffer(h)
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        return state
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.db_path!r})'
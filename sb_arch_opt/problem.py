@@ -14,16 +14,26 @@ limitations under the License.
 Copyright: (c) 2023, Deutsches Zentrum fuer Luft- und Raumfahrt e.V.
 Contact: jasper.bussemaker@dlr.de
 """
+import os
+import re
+import shutil
+import hashlib
+import logging
 import numpy as np
-from typing import List, Optional, Union, Tuple
+from collections import OrderedDict
+from typing import List, Optional, Union, Tuple, Sequence
 from cached_property import cached_property
 from pymoo.core.repair import Repair
 from pymoo.core.problem import Problem
 from pymoo.core.population import Population
 from pymoo.core.variable import Variable, Real, Integer, Choice, Binary
+from sb_arch_opt.discrete_x import CompactDiscreteX, IndexedDiscreteX
+from sb_arch_opt.evaluation_db import EvaluationDatabase
 
 __all__ = ['ArchOptProblemBase', 'ArchOptRepair']
 
+log = logging.getLogger('sb_arch_opt.problem')
+
 
 class ArchOptProblemBase(Problem):
     """
@@ -50,8 +60,22 @@ class ArchOptProblemBase(Problem):
     [suggested by pymoo](https://pymoo.org/customization/mixed.html), but rather keeping the design vectors in a matrix
     with all different variable types in there. To facilitate this, categorical variables are encoded as integers, and
     the mixed-variable operators have been rewritten in SBArchOpt.
+
+    Set `cache_all_discrete_x` (disabled by default) to persist the generated discrete design vectors (see
+    `all_discrete_x`) to disk, so that they are generated once and shared (memory-mapped) by all processes. This is
+    mainly useful for problems that generate them by trial and repair. The cache is keyed by the repr of the problem
+    and its design space definition, so make sure the repr identifies the problem (including settings) if enabled.
+
+    Set `all_discrete_x_n_parallel` to generate discrete design vectors by trial and repair (i.e. if the problem does
+    not implement `_gen_all_discrete_x`) in several processes (the problem should be picklable). This applies to all
+    samplers, unless the sampler specifies its own nr of processes.
     """
 
+    cache_all_discrete_x = False
+    all_discrete_x_n_parallel = None
+    all_discrete_x_cache_folder = os.path.join('~', '.arch_opt_x_cache')
+    _all_discrete_x_cache_version = 2
+
     def __init__(self, des_vars: List[Variable], n_obj=1, n_ieq_constr=0, n_eq_constr=0, **kwargs):
 
         # Harmonize the pymoo variable definition interface
@@ -91,6 +115,29 @@ class ArchOptProblemBase(Problem):
         self._is_cont_mask = ~self._is_discrete_mask
         self._x_cont_mid = .5*(xl[self._is_cont_mask]+xu[self._is_cont_mask])
 
+        # Precompute bounds and imputation values to be able to correct and impute design vectors without looping
+        self._xl_discrete = xl_discrete = xl[self._is_discrete_mask]
+        self._xu_discrete = xu_discrete = xu[self._is_discrete_mask]
+        diff_discrete = xu_discrete-xl_discrete
+        self._x_discrete_stretch = np.ones(diff_discrete.shape)
+        has_range = diff_discrete > 0
+        self._x_discrete_stretch[has_range] = (diff_discrete[has_range]+.99)/diff_discrete[has_range]
+
+        self._x_imputed = x_imputed = xl.copy()
+        x_imputed[self._is_cont_mask] = self._x_cont_mid
+
+        # Evaluation results cache (disabled by default)
+        self._eval_cache: Optional[OrderedDict] = None
+        self._eval_cache_max_size = 0
+        self._eval_cache_x_tol = 0.
+        self.eval_cache_hits = 0
+        self.eval_cache_misses = 0
+
+        # Persistent evaluation database (disabled by default)
+        self._eval_db: Optional[EvaluationDatabase] = None
+        self._eval_db_store_failed = False
+        self.eval_db_hits = 0
+
         super().__init__(n_var=n_var, xl=xl, xu=xu, vars=var_types,
                          n_obj=n_obj, n_ieq_constr=n_ieq_constr, n_eq_constr=n_eq_constr, **kwargs)
 
@@ -153,33 +200,27 @@ class ArchOptProblemBase(Problem):
         xs = x*((np.max(x)+.99)/np.max(x))-.5
         np.unique(np.abs(np.round(xs)).astype(int), return_counts=True) --> 34, 33, 33 (evenly distributed)
         """
-        x_discrete = x[:, self._is_discrete_mask].astype(np.float64)
-        xl, xu = self.xl[self._is_discrete_mask], self.xu[self._is_discrete_mask]
-        diff = xu-xl
+        if len(self._xl_discrete) == 0:
+            return
+        xl = self._xl_discrete
 
-        for ix in range(x_discrete.shape[1]):
-            x_discrete[x_discrete[:, ix] < xl[ix], ix] = xl[ix]
-            x_discrete[x_discrete[:, ix] > xu[ix], ix] = xu[ix]
+        x_discrete = x[:, self._is_discrete_mask].astype(np.float64, copy=False)
+        np.clip(x_discrete, xl, self._xu_discrete, out=x_discrete)
+        x_discrete -= xl
+        x_discrete *= self._x_discrete_stretch
+        x_discrete -= .5
+        np.round(x_discrete, out=x_discrete)
+        x_discrete += xl
 
-        x_stretched = (x_discrete-xl)*((diff+.99)/diff)-.5
-        x_rounded = (np.round(x_stretched)+xl).astype(np.int)
-
-        x[:, self._is_discrete_mask] = x_rounded
+        x[:, self._is_discrete_mask] = x_discrete
 
     def impute_x(self, x: np.ndarray, is_active: np.ndarray):
         """
         Applies the default imputation to design vectors:
-        - Sets inactive discrete design variables to 0
+        - Sets inactive discrete design variables to their lower bound
         - Sets inactive continuous design variables to the mid of their bounds
         """
-
-        # Impute inactive discrete design variables
-        for i_dv in np.where(self.is_discrete_mask)[0]:
-            x[~is_active[:, i_dv], i_dv] = self.xl[i_dv]
-
-        # Impute inactive continuous design variables
-        for i_cont, i_dv in enumerate(np.where(self.is_cont_mask)[0]):
-            x[~is_active[:, i_dv], i_dv] = self._x_cont_mid[i_cont]
+        np.copyto(x, self._x_imputed, where=~is_active, casting='unsafe')
 
     def get_n_valid_discrete(self) -> Optional[int]:
         """Return the number of valid discrete design points (ignoring continuous dimensions); enables calculation of
@@ -188,19 +229,38 @@ class ArchOptProblemBase(Problem):
         if n_valid is not None:
             return n_valid
 
-        x_discrete, _ = self.all_discrete_x
+        x_indexed = self.get_indexed_discrete_x()
+        if x_indexed is not None:
+            return len(x_indexed)
+
+        x_discrete = self.all_discrete_x_compact
         if x_discrete is not None:
-            return x_discrete.shape[0]
+            return len(x_discrete)
 
     @cached_property
     def all_discrete_x(self) -> Tuple[Optional[np.ndarray], Optional[np.ndarray]]:
         """Generate all possible discrete design vectors, if the problem provides this function. Returns both the design
-        vectors and activeness information. Continuous variables are initialized at the mid of their bounds."""
+        vectors and activeness information. Continuous variables are initialized at the mid of their bounds.
+        Note: use all_discrete_x_compact to prevent expanding all design vectors in memory."""
+        x_discrete = self.all_discrete_x_compact
+        if x_discrete is None:
+            return None, None
+        return x_discrete.get()
+
+    @cached_property
+    def all_discrete_x_compact(self) -> Optional[CompactDiscreteX]:
+        """All possible discrete design vectors and activeness information in compact form (see CompactDiscreteX), if
+        the problem provides a function to generate them"""
+
+        # Check if the design vectors have been generated before
+        x_discrete = self.load_all_discrete_x_cache()
+        if x_discrete is not None:
+            return x_discrete
 
         # Check if this problem implements discrete design vector generation
         discrete_x = self._gen_all_discrete_x()
         if discrete_x is None:
-            return None, None
+            return
 
         # Impute values (mostly for continuous dimensions)
         x, is_active = discrete_x
@@ -214,8 +274,99 @@ class ArchOptProblemBase(Problem):
         if n_valid is not None and (n_valid != x.shape[0] or n_valid != is_active.shape[0]):
             raise RuntimeError(f'Inconsistent estimation of nr of discrete design vectors: {n_valid} != {x.shape[0]}')
 
+        x_discrete = CompactDiscreteX.from_x(x, is_active, self.is_cont_mask)
+        self.store_all_discrete_x_cache(x_discrete)
+        return x_discrete
+
+    def get_indexed_discrete_x(self) -> Optional[IndexedDiscreteX]:
+        """Valid discrete design vectors generated from their index, if the problem implements unranking (see
+        `_get_n_discrete_x_groups` and `_unrank_discrete_x`); enables hierarchical sampling of large design spaces"""
+        group_sizes = self._get_n_discrete_x_groups()
+        if group_sizes is None:
+            return
+        return IndexedDiscreteX(group_sizes, self.unrank_discrete_x)
+
+    def unrank_discrete_x(self, i_x: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Generate the (imputed) discrete design vectors and activeness information at the given indices"""
+        x, is_active = self._unrank_discrete_x(np.asarray(i_x, dtype=np.int64))
+        x = x.astype(float)
+        self.impute_x(x, is_active)
         return x, is_active
 
+    def reset_all_discrete_x(self):
+        """Reset the in-memory discrete design vectors, so that they are regenerated or loaded from the cache"""
+        self.__dict__.pop('all_discrete_x', None)
+        self.__dict__.pop('all_discrete_x_compact', None)
+
+    def load_all_discrete_x_cache(self) -> Optional[CompactDiscreteX]:
+        """Load the stored discrete design vectors and activeness information (memory-mapped copy-on-write, so all
+        processes share the same read-only copy), if caching is enabled and available"""
+        cache_folder = self._all_discrete_x_cache_folder()
+        if cache_folder is None or not os.path.exists(cache_folder):
+            return
+
+        x_discrete = CompactDiscreteX.from_arrays({
+            os.path.splitext(filename)[0]: np.load(os.path.join(cache_folder, filename), mmap_mode='c')
+            for filename in os.listdir(cache_folder)})
+
+        n_valid = self._get_n_valid_discrete()
+        if x_discrete.n_var != self.n_var or np.any(x_discrete.is_cont_mask != self.is_cont_mask) or \
+                (n_valid is not None and n_valid != len(x_discrete)):
+            log.info(f'Ignoring inconsistent discrete design vectors cache: {cache_folder}')
+            return
+        return x_discrete
+
+    def store_all_discrete_x_cache(self, x_discrete: CompactDiscreteX):
+        """Store discrete design vectors and activeness information, if caching is enabled"""
+        cache_folder = self._all_discrete_x_cache_folder()
+        if cache_folder is None:
+            return
+
+        tmp_folder = f'{cache_folder}.{os.getpid()}.tmp'
+        os.makedirs(tmp_folder, exist_ok=True)
+        for name, values in x_discrete.get_arrays().items():
+            np.save(os.path.join(tmp_folder, f'{name}.npy'), values)
+
+        # Atomic, so other processes never read a partially-written cache
+        try:
+            os.replace(tmp_folder, cache_folder)
+        except OSError:  # Already stored by another process
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+
+    def __getstate__(self):
+        state = super().__getstate__().copy()
+
+        # If cached, other processes load the discrete design vectors from disk instead of receiving a copy
+        if self._all_discrete_x_cache_folder() is not None:
+            state.pop('all_discrete_x', None)
+            state.pop('all_discrete_x_compact', None)
+        return state
+
+    def _all_discrete_x_cache_folder(self) -> Optional[str]:
+        if not self.cache_all_discrete_x:
+            return
+
+        # The representation might not identify the problem configuration, so the folder also contains the problem id
+        if repr(self).startswith('<'):
+            return
+        class_str = re.sub('[^0-9a-z]', '_', self.__class__.__name__.lower())[:20]
+
+        return os.path.join(os.path.expanduser(self.all_discrete_x_cache_folder),
+                            f'v{self._all_discrete_x_cache_version}', f'{class_str}_{self.get_problem_id()[:20]}')
+
+    def get_problem_id(self) -> str:
+        """Get a hash identifying this problem (class, representation, bounds and variable types), used to make sure
+        that persisted data (evaluation database, discrete design vectors cache) belongs to this problem"""
+        cls = self.__class__
+        problem_str = repr(self)
+        if problem_str.startswith('<'):  # Default representation contains the memory address
+            problem_str = ''
+
+        id_parts = [f'{cls.__module__}.{cls.__qualname__}', problem_str, repr(self.xl.tolist()),
+                    repr(self.xu.tolist()), repr(self.is_discrete_mask.tolist()), repr(self.is_cat_mask.tolist()),
+                    repr((self.n_obj, self.n_ieq_constr, self.n_eq_constr))]
+        return hashlib.md5('|'.join(id_parts).encode('utf-8')).hexdigest()
+
     def _evaluate(self, x, out, *args, **kwargs):
         """
         Evaluates a set of design vectors (provided as matrix). Outputs:
@@ -235,7 +386,10 @@ class ArchOptProblemBase(Problem):
         h_out = np.zeros((x.shape[0], self.n_eq_constr))*np.nan
 
         # Call evaluation function
-        self._arch_evaluate(x_out, is_active_out, f_out, g_out, h_out, *args, **kwargs)
+        if self._eval_cache is not None or self._eval_db is not None:
+            self._arch_evaluate_cached(x_out, is_active_out, f_out, g_out, h_out, *args, **kwargs)
+        else:
+            self._arch_evaluate(x_out, is_active_out, f_out, g_out, h_out, *args, **kwargs)
 
         # Provide outputs to pymoo
         out['X'] = x_out
@@ -246,6 +400,134 @@ class ArchOptProblemBase(Problem):
         if self.n_eq_constr > 0:
             out['H'] = h_out
 
+    def set_eval_cache(self, enabled=True, max_size=10000, x_tol=1e-10):
+        """
+        Enable (or disable) memoization of evaluation results. Design vectors are first corrected and imputed, and then
+        identified by their discrete values and their continuous values rounded to `x_tol`. Only design vectors not
+        seen before are passed to `_arch_evaluate`; for others the cached X, is_active, F, G and H are returned.
+        At most `max_size` results are kept, the least recently used ones are removed first.
+        Note that failed evaluations (NaN outputs) are also cached.
+
+        Each evaluated row found in the cache counts as an `eval_cache_hits`. Of the remaining unique design vectors
+        (duplicates within a batch are not counted), the ones found in the evaluation database count as
+        `eval_db_hits` (see `set_eval_database`) and the ones passed to `_arch_evaluate` as `eval_cache_misses`.
+        So with a database attached, hits + misses does not add up to the number of lookups: DB hits are neither.
+        """
+        self._eval_cache = OrderedDict() if enabled else None
+        self._eval_cache_max_size = max_size
+        self._eval_cache_x_tol = x_tol
+        self.eval_cache_hits = 0
+        self.eval_cache_misses = 0
+
+    def reset_eval_cache(self):
+        """Clear all cached evaluation results and reset the hit/miss counters"""
+        if self._eval_cache is not None:
+            self._eval_cache.clear()
+        self.eval_cache_hits = 0
+        self.eval_cache_misses = 0
+
+    @property
+    def eval_cache_size(self) -> int:
+        return 0 if self._eval_cache is None else len(self._eval_cache)
+
+    def get_eval_keys(self, x_imputed: np.ndarray, x_tol=1e-10) -> List[bytes]:
+        """Get hashable keys identifying (corrected and imputed) design vectors: discrete variables are taken as-is,
+        continuous variables are rounded to some tolerance"""
+        x_key = x_imputed.astype(float)
+        if x_tol > 0:
+            x_key[:, self._is_cont_mask] = np.round(x_key[:, self._is_cont_mask]/x_tol)
+        x_key += 0.  # Normalize negative zeros
+        return [row.tobytes() for row in x_key]
+
+    def set_eval_database(self, db_path: Optional[str], x_tol=1e-10, store_failed=False):
+        """
+        Attach a persistent evaluation database (SQLite file) to this problem, or detach it by passing None. Before
+        evaluating, the database is queried for the imputed design vectors; only design vectors not found are
+        evaluated, and their results are appended to the database. As all optimization algorithm interfaces evaluate
+        through the problem, previous results are reused across runs and algorithms.
+        Failed evaluations (NaN outputs, see `get_failed_points`) are not stored, so that they are evaluated again in a
+        next run (failures might be transient), unless store_failed is set.
+        Design vectors found in the database are counted in `eval_db_hits`, and not in the cache hits or misses.
+        """
+        if self._eval_db is not None:
+            self._eval_db.close()
+        self._eval_db = None if db_path is None else EvaluationDatabase(
+            db_path, self.n_var, self.n_obj, n_ieq_constr=self.n_ieq_constr, n_eq_constr=self.n_eq_constr,
+            x_tol=x_tol, problem_id=self.get_problem_id())
+        self._eval_db_store_failed = store_failed
+        self.eval_db_hits = 0
+
+    @property
+    def eval_db(self) -> Optional[EvaluationDatabase]:
+        return self._eval_db
+
+    def _arch_evaluate_cached(self, x: np.ndarray, is_active_out: np.ndarray, f_out: np.ndarray, g_out: np.ndarray,
+                              h_out: np.ndarray, *args, **kwargs):
+        cache, db = self._eval_cache, self._eval_db
+        self._correct_x_impute(x, is_active_out)
+        cache_keys = self.get_eval_keys(x, x_tol=self._eval_cache_x_tol) if cache is not None else None
+        db_keys = self.get_eval_keys(x, x_tol=db.x_tol) if db is not None else None
+
+        outputs = [x, is_active_out, f_out, g_out, h_out]
+
+        def _set_results(i_set, results):
+            for output, value in zip(outputs, results):
+                output[i_set, :] = value
+
+        # Get results from the cache, and determine which (unique) design vectors are not cached
+        i_miss = []
+        i_miss_dup = []
+        i_miss_map = {}
+        for i, key in enumerate(cache_keys if cache_keys is not None else db_keys):
+            if cache is not None and key in cache:
+                cache.move_to_end(key)
+                _set_results(i, cache[key])
+                self.eval_cache_hits += 1
+
+            elif key in i_miss_map:
+                i_miss_dup.append((i, i_miss_map[key]))
+
+            else:
+                i_miss_map[key] = i
+                i_miss.append(i)
+
+        # Get results from the evaluation database
+        i_eval = i_miss
+        if db is not None and len(i_miss) > 0:
+            i_eval = []
+            for i, results in zip(i_miss, db.get([db_keys[i] for i in i_miss])):
+                if results is None:
+                    i_eval.append(i)
+                else:
+                    _set_results(i, results)
+                    self.eval_db_hits += 1
+
+        # Evaluate the remaining design vectors
+        if len(i_eval) > 0:
+            self.eval_cache_misses += len(i_eval)
+            i_eval = np.array(i_eval)
+            eval_outputs = [output[i_eval, :] for output in outputs]
+            self._arch_evaluate(*eval_outputs, *args, **kwargs)
+            _set_results(i_eval, eval_outputs)
+
+            if db is not None:
+                i_store = np.arange(len(i_eval))
+                if not self._eval_db_store_failed:
+                    _, _, f_eval, g_eval, h_eval = eval_outputs
+                    i_store = i_store[~self.get_failed_points({'F': f_eval, 'G': g_eval, 'H': h_eval})]
+                if len(i_store) > 0:
+                    db.put([db_keys[i] for i in i_eval[i_store]], *[output[i_store, :] for output in eval_outputs])
+
+        for i, i_src in i_miss_dup:
+            _set_results(i, [output[i_src, :] for output in outputs])
+
+        # Store in the cache and remove least-recently used results
+        if cache is not None:
+            for i in i_miss:
+                cache[cache_keys[i]] = tuple(output[i, :].copy() for output in outputs)
+            while len(cache) > self._eval_cache_max_size:
+                cache.popitem(last=False)
+
     @staticmethod
     def get_failed_points(pop_or_out: Union[dict, Population]):
         f = pop_or_out.get('F')
@@ -331,7 +613,7 @@ class ArchOptProblemBase(Problem):
         if len(n_opts_discrete) == 0:
             return 1
 
-        return int(np.prod(n_opts_discrete, dtype=np.float))
+        return int(np.prod(n_opts_discrete, dtype=float))
 
     """##############################
     ### IMPLEMENT FUNCTIONS BELOW ###
@@ -345,6 +627,16 @@ class ArchOptProblemBase(Problem):
         """Generate all possible discrete design vectors (if available). Returns design vectors and activeness
         information."""
 
+    def _get_n_discrete_x_groups(self) -> Optional[Sequence[int]]:
+        """If discrete design vectors can be generated from their index (see `_unrank_discrete_x`), return the number
+        of valid discrete design vectors in each group. Groups should contain design vectors with the same nr of active
+        discrete variables, as hierarchical sampling selects groups with equal probability."""
+
+    def _unrank_discrete_x(self, i_x: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Generate the discrete design vectors and activeness information at the given indices (0 <= i < nr of valid
+        discrete design vectors); groups (see `_get_n_discrete_x_groups`) occupy consecutive index ranges"""
+        raise NotImplementedError
+
     def store_results(self, results_folder, final=False):
         """Callback function to store intermediate or final results in some results folder"""
 
@@ -18,6 +18,8 @@ This test suite contains the discrete, hierarchical, multi-objective Guidance, N
 """
 import itertools
 import numpy as np
+from typing import *
+from scipy.special import comb
 from pymoo.core.variable import Integer, Choice
 from sb_arch_opt.problems.hierarchical import HierarchyProblemBase
 
@@ -51,6 +53,13 @@ class GNCProblemBase(HierarchyProblemBase):
         'A': {'A': .00008, 'B': .0002, 'C': .0001},
     }
 
+    _failure_scenarios = {}
+    _n_comb_conn = {}
+    _conn_matrices = {}
+    _n_conn_matrices_cache_max = 100e3
+    _n_gen_all_max = 100e3
+    _n_f_memo_max = 100000
+
     def __init__(self, choose_nr=True, n_max=3, choose_type=True, actuators=True):
         self.choose_nr = choose_nr
         self.n_max = n_max
@@ -63,69 +72,226 @@ class GNCProblemBase(HierarchyProblemBase):
         des_vars = self._get_des_vars()
         super().__init__(des_vars, n_obj=n_obj)
 
-    def _get_n_valid_discrete(self) -> int:
-        # Pre-count the number of possible connections, taking into account that each connector at least needs one
-        # We can ignore any combinations where there are either 1 sources or targets, as there there is only 1
-        # connection possibility (namely all-to-one or one-to-all)
-        def _iter_conns(n_src_, n_tgt_):
-            # Loop over the number of outgoing connections for the current source node (at least one)
-            for n_conn_src in range(1, n_tgt_+1):
-                # Loop over the combinations of target node selections
-                for i_conn_targets in itertools.combinations(list(range(n_tgt_)), n_conn_src):
-                    # Prepare connection matrix of size (n_src x n_tgt), where 1 denotes a made connection
-                    src_conn_matrix = np.zeros((n_src_, n_tgt_), dtype=int)
-                    src_conn_matrix[0, list(i_conn_targets)] = 1
-
-                    # If we only have 1 source node left, this is the final matrix
-                    if n_src_ == 1:
-                        yield src_conn_matrix
-                        continue
-
-                    # Otherwise, loop over possible connection matrices by the remaining source nodes
-                    for next_src_conn_matrix in _iter_conns(n_src_-1, n_tgt_):
-                        conn_matrix_ = src_conn_matrix.copy()
-                        conn_matrix_[1:, :] = next_src_conn_matrix
-                        yield conn_matrix_
-
-        n_comb_conn = {}
-        for n_src, n_tgt in itertools.product(list(range(2, self.n_max+1)), list(range(2, self.n_max+1))):
-
-            # Loop over connection matrices
-            n_combinations = 0
-            for conn_matrix in _iter_conns(n_src, n_tgt):
-                # Check if all nodes have at least one connection
-                if np.any(np.sum(conn_matrix, axis=0) == 0) or np.any(np.sum(conn_matrix, axis=1) == 0):
-                    continue
-                n_combinations += 1
+        # Evaluated (failure rate, mass) by architecture signature
+        self._f_memo = {}
+        self._discrete_x_ranking = None
 
-            n_comb_conn[n_src, n_tgt] = n_comb_conn[n_tgt, n_src] = n_combinations
+    def _get_n_valid_discrete(self) -> int:
+        # Get the number of possible connections, taking into account that each connector at least needs one
+        n_comb_conn = self._get_n_comb_conn(self.n_max)
 
         # Loop over the number of object instances
         n_node_exist = list(range(1, self.n_max+1)) if self.choose_nr else [self.n_max]
         n_actuators = n_node_exist if self.actuators else [0]
         n_valid = 0
         for n_objs in itertools.product(n_node_exist, n_node_exist, n_actuators):
-            # Count the number of possible type selections
+            # Count the number of possible type selections: unordered combinations of A, B, C
             n_inst_comb = 1
             if self.choose_type:
                 for n in n_objs:
                     if n > 0:
-                        n_inst_comb *= len(list(itertools.combinations_with_replacement('ABC', n)))
+                        n_inst_comb *= comb(n+2, n, exact=True)
 
             # Count the number of possible inter-object connections
             for n_src, n_tgt in zip(n_objs[:-1], n_objs[1:]):
-                # If there are no targets (actuators) to connect to, or there is only 1 of either type skip as there are
-                # no additional combinations possible
+                # If there are no targets (actuators) to connect to skip
                 if n_tgt == 0:
                     continue
-                if n_src == 1 or n_tgt == 1:
-                    continue
-
                 n_inst_comb *= n_comb_conn[n_src, n_tgt]
 
             n_valid += n_inst_comb
         return n_valid
 
+    @classmethod
+    def _get_n_comb_conn(cls, n_max: int) -> Dict[Tuple[int, int], int]:
+        """
+        Get the number of connection matrices (n_src x n_tgt) where each source and each target has at least one
+        connection, using inclusion-exclusion over the nr of unconnected sources:
+        sum_k (-1)^k C(n_src, k) (2^(n_src-k) - 1)^n_tgt
+        Note that if there is only 1 source or target, there is only 1 possibility (all-to-one or one-to-all).
+        """
+        if n_max not in cls._n_comb_conn:
+            cls._n_comb_conn[n_max] = {
+                (n_src, n_tgt): sum((-1)**k * comb(n_src, k, exact=True) * (2**(n_src-k)-1)**n_tgt
+                                    for k in range(n_src+1))
+                for n_src, n_tgt in itertools.product(range(1, n_max+1), range(1, n_max+1))}
+        return cls._n_comb_conn[n_max]
+
+    def _gen_all_discrete_x(self) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        # Only generate all design vectors if they fit in memory, otherwise iter_all_discrete_x can be used
+        if self._get_n_valid_discrete() > self._n_gen_all_max:
+            return
+
+        x_chunks, is_active_chunks = zip(*self.iter_all_discrete_x())
+        return np.row_stack(x_chunks), np.row_stack(is_active_chunks)
+
+    def iter_all_discrete_x(self, n_chunk=10000) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """Iterate over all valid discrete design vectors and activeness information, in chunks of at most n_chunk.
+        Design vectors are generated from the type-combination and connection-pattern enumerations, so no
+        trial-and-repair is needed."""
+        for n_inst in self._iter_n_inst():
+            dv_options = self._get_dv_options(n_inst)
+
+            # Generate the Cartesian product of the options in chunks
+            n_options = tuple(n for _, n, _, _ in dv_options)
+            n_total = int(np.prod(n_options))
+            for i_start in range(0, n_total, n_chunk):
+                i_options = np.unravel_index(np.arange(i_start, min(i_start+n_chunk, n_total)), n_options)
+                yield self._get_x_from_options(n_inst, dv_options, i_options)
+
+    def _get_n_discrete_x_groups(self) -> Optional[Sequence[int]]:
+        # Design vector indices should fit in a 64-bit integer
+        if self._get_n_valid_discrete() >= np.iinfo(np.int64).max:
+            return
+        return self._get_discrete_x_ranking()[2]
+
+    def _unrank_discrete_x(self, i_x: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        n_inst_ranked, i_start, _ = self._get_discrete_x_ranking()
+        i_n_inst = np.searchsorted(i_start, i_x, side='right')-1
+
+        x = np.empty((len(i_x), self.n_var))
+        is_active = np.empty((len(i_x), self.n_var), dtype=bool)
+        for i in np.unique(i_n_inst):
+            is_n_inst = i_n_inst == i
+            dv_options = self._get_dv_options(n_inst_ranked[i])
+            n_options = tuple(n for _, n, _, _ in dv_options)
+            i_options = np.unravel_index(i_x[is_n_inst]-i_start[i], n_options)
+            x[is_n_inst, :], is_active[is_n_inst, :] = \
+                self._get_x_from_options(n_inst_ranked[i], dv_options, i_options)
+        return x, is_active
+
+    def _get_discrete_x_ranking(self) -> Tuple[List[Tuple[int, ...]], np.ndarray, np.ndarray]:
+        """Get the object-instance combinations ordered by nr of active design variables, the rank of the first design
+        vector of each combination, and the nr of design vectors per group of equal nr of active design variables"""
+        if self._discrete_x_ranking is None:
+            n_comb_conn = self._get_n_comb_conn(self.n_max)
+            n_inst_all = list(self._iter_n_inst())
+            n_active = np.zeros((len(n_inst_all),), dtype=int)
+            n_x = np.ones((len(n_inst_all),), dtype=np.int64)
+            for i, n_inst in enumerate(n_inst_all):
+                n_active[i] = (len(n_inst) if self.choose_nr else 0)+(sum(n_inst) if self.choose_type else 0)
+                if self.choose_type:
+                    for n in n_inst:
+                        n_x[i] *= comb(n+2, n, exact=True)
+
+                for n_src, n_tgt in zip(n_inst[:-1], n_inst[1:]):
+                    n_active[i] += n_src*n_tgt
+                    n_x[i] *= n_comb_conn[n_src, n_tgt]
+
+            i_ranked = np.argsort(n_active, kind='stable')
+            n_x_ranked = n_x[i_ranked]
+            _, i_group_start = np.unique(n_active[i_ranked], return_index=True)
+            self._discrete_x_ranking = [n_inst_all[i] for i in i_ranked], np.cumsum(n_x_ranked)-n_x_ranked, \
+                np.add.reduceat(n_x_ranked, i_group_start)
+        return self._discrete_x_ranking
+
+    def _iter_n_inst(self) -> Iterator[Tuple[int, ...]]:
+        """Iterate over the possible nr of instantiated objects (sensors, computers, [actuators])"""
+        n_obj_types = 3 if self.actuators else 2
+        n_node_exist = list(range(1, self.n_max+1)) if self.choose_nr else [self.n_max]
+        yield from itertools.product(*[n_node_exist for _ in range(n_obj_types)])
+
+    def _get_dv_options(self, n_inst: Tuple[int, ...]) \
+            -> List[Tuple[int, int, Callable[[np.ndarray], np.ndarray], np.ndarray]]:
+        """Get the options of each group of design variables: (first design variable index, nr of options, function
+        getting x of selected options, is_active); connection options are generated on demand, as there can be many"""
+        n_max = self.n_max
+        n_x_conn = n_max*n_max
+        j_type, j_conn = self._get_x_offsets()
+        i_range = np.arange(n_max)
+        n_comb_conn = self._get_n_comb_conn(n_max)
+
+        dv_options = []
+        if self.choose_type:
+            for i_obj, n in enumerate(n_inst):
+                type_combinations = np.array(list(itertools.combinations_with_replacement(range(3), n)))
+                x_types = np.zeros((type_combinations.shape[0], n_max))
+                x_types[:, :n] = type_combinations
+                dv_options.append((j_type+i_obj*n_max, x_types.shape[0], x_types.__getitem__, i_range < n))
+
+        def _get_x_conns_getter(n_src_, n_tgt_):
+            def _get_x_conns(i_opt):
+                x_conns = np.zeros((len(i_opt), n_max, n_max))
+                x_conns[:, :n_src_, :n_tgt_] = self._get_conn_matrices(n_src_, n_tgt_, i_opt)
+                return x_conns.reshape((-1, n_x_conn))
+            return _get_x_conns
+
+        for i_conn in range(len(n_inst)-1):
+            n_src, n_tgt = n_inst[i_conn], n_inst[i_conn+1]
+            is_active_conn = (i_range[:, None] < n_src) & (i_range[None, :] < n_tgt)
+            dv_options.append((j_conn+i_conn*n_x_conn, n_comb_conn[n_src, n_tgt], _get_x_conns_getter(n_src, n_tgt),
+                               is_active_conn.ravel()))
+        return dv_options
+
+    def _get_x_from_options(self, n_inst: Tuple[int, ...], dv_options, i_options) -> Tuple[np.ndarray, np.ndarray]:
+        """Get design vectors and activeness information from the selected option indices of each design variable
+        group"""
+        n_obj_types = len(n_inst)
+        n = len(i_options[0])
+        x = np.zeros((n, self.n_var))
+        is_active = np.ones((n, self.n_var), dtype=bool)
+        if self.choose_nr:
+            x[:, :n_obj_types] = n_inst
+
+        # The last block of connection design variables is not used
+        _, j_conn = self._get_x_offsets()
+        is_active[:, j_conn+(n_obj_types-1)*self.n_max*self.n_max:] = False
+
+        for (j, _, get_x_options, is_active_options), i_opt in zip(dv_options, i_options):
+            x_options = get_x_options(i_opt)
+            x[:, j:j+x_options.shape[1]] = x_options
+            is_active[:, j:j+x_options.shape[1]] = is_active_options
+        return x, is_active
+
+    @classmethod
+    def _get_conn_matrices(cls, n_src: int, n_tgt: int, i_matrix: np.ndarray = None) -> np.ndarray:
+        """Get connection matrices where each source and each target has at least one connection, ordered
+        lexicographically (by the flattened matrix); either all or the ones at the given indices. Matrices are only
+        kept in memory if there are not too many of them."""
+        n_matrices = cls._get_n_cover(n_src, n_tgt, n_tgt)
+        if n_matrices > cls._n_conn_matrices_cache_max:
+            return cls._unrank_conn_matrices(n_src, n_tgt, np.arange(n_matrices) if i_matrix is None else i_matrix)
+
+        if (n_src, n_tgt) not in cls._conn_matrices:
+            cls._conn_matrices[n_src, n_tgt] = cls._unrank_conn_matrices(n_src, n_tgt, np.arange(n_matrices))
+        matrices = cls._conn_matrices[n_src, n_tgt]
+        return matrices if i_matrix is None else matrices[i_matrix]
+
+    @classmethod
+    def _unrank_conn_matrices(cls, n_src: int, n_tgt: int, i_matrix: np.ndarray) -> np.ndarray:
+        """Get connection matrices from their index, by selecting (non-empty) rows one by one: the nr of matrices
+        starting with some rows is the nr of ways to complete them such that all targets are covered"""
+        rank = np.array(i_matrix, dtype=np.int64)
+        n = len(rank)
+        row_values = np.arange(1, 2**n_tgt)
+        row_bits = (row_values[:, None] >> np.arange(n_tgt-1, -1, -1)[None, :]) & 1  # First target is the MSB
+        n_covered = np.array([bin(value).count('1') for value in range(2**n_tgt)])
+        n_complete = np.array([[cls._get_n_cover(n_rows, n_tgt, n_uncovered) for n_uncovered in range(n_tgt+1)]
+                               for n_rows in range(n_src)], dtype=np.int64)
+
+        matrices = np.zeros((n, n_src, n_tgt), dtype=int)
+        covered = np.zeros((n,), dtype=np.int64)
+        for i_row in range(n_src):
+            n_rows_left = n_src-i_row-1
+            is_selected = np.zeros((n,), dtype=bool)
+            for value, bits in zip(row_values, row_bits):
+                covered_next = covered | value
+                n_next = n_complete[n_rows_left, n_tgt-n_covered[covered_next]]
+
+                select = ~is_selected & (rank < n_next)
+                matrices[select, i_row, :] = bits
+                covered[select] = covered_next[select]
+                is_selected |= select
+                rank[~is_selected] -= n_next[~is_selected]
+        return matrices
+
+    @staticmethod
+    def _get_n_cover(n_rows: int, n_tgt: int, n_uncovered: int) -> int:
+        """Nr of ways to select n_rows non-empty rows (of n_tgt connections) that together cover n_uncovered given
+        targets, using inclusion-exclusion over the nr of targets left uncovered"""
+        return sum((-1)**j * comb(n_uncovered, j, exact=True) * (2**(n_tgt-j)-1)**n_rows
+                   for j in range(n_uncovered+1))
+
     def _get_des_vars(self):
         des_vars = []
 
@@ -160,120 +326,119 @@ class GNCProblemBase(HierarchyProblemBase):
 
     def _correct_x(self, x: np.ndarray, is_active: np.ndarray):
         n_obj_types = 3 if self.actuators else 2
-        n_x_conn = self.n_max*self.n_max
-        for i, x_i in enumerate(x):
-            j = 0
-
-            # Get the number of instantiated objects
-            if self.choose_nr:
-                n_inst = x_i[j:j+n_obj_types].astype(int)
-                j += n_obj_types
-            else:
-                n_inst = np.ones((n_obj_types,), dtype=int)*self.n_max
-
-            # Correct the object types
-            if self.choose_type:
-                for n_obj in n_inst:
-                    x_obj_type = x_i[j:j+self.n_max]
-
-                    # Set type selections for non-instantiated objects to inactive
-                    is_active[j+n_obj:j+self.n_max] = False
-
-                    # Correct types for instantiated objects to only select unordered combinations: subsequent variables
-                    # cannot have a lower value than prior ones
-                    last_type_sel = x_obj_type[0]
-                    for dj in range(1, n_obj):
-                        if x_obj_type[dj] < last_type_sel:
-                            x_i[j+dj] = last_type_sel
-                        else:
-                            last_type_sel = x_obj_type[dj]
-
-                    j += self.n_max
-
-            # Correct the connections
-            for i_conn in range(n_obj_types-1):
-                x_conn = x_i[j:j+n_x_conn].reshape((self.n_max, self.n_max))
-                is_active_conn = x_i[j:j+n_x_conn].reshape((self.n_max, self.n_max))
-
-                # Deactivate connections for non-instantiated objects
-                n_src, n_tgt = n_inst[i_conn], n_inst[i_conn+1]
-                is_active_conn[n_src:, :] = False
-                is_active_conn[:, n_tgt:] = False
-
-                # Ensure that each connector has at least one connection
-                x_conn_active = x_conn[:n_src, :n_tgt]
-                for i_src, n_conn_src in enumerate(np.sum(x_conn_active, axis=1)):
-                    if n_conn_src == 0:
-                        # Select the same target as the source to make a connection, or the last available
-                        i_tgt = min(i_src, n_tgt-1)
-                        x_conn_active[i_src, i_tgt] = 1
-
-                for i_tgt, n_conn_tgt in enumerate(np.sum(x_conn_active, axis=0)):
-                    if n_conn_tgt == 0:
-                        i_src = min(i_tgt, n_src-1)
-                        x_conn_active[i_src, i_tgt] = 1
-
-                j += n_x_conn
+        n_max = self.n_max
+        n_x_conn = n_max*n_max
+        j_type, j_conn = self._get_x_offsets()
+        n_inst = self._get_n_inst(x)
+        i_range = np.arange(n_max)
+
+        # Correct the object types
+        if self.choose_type:
+            for i_obj in range(n_obj_types):
+                j = j_type+i_obj*n_max
+                x_obj_type = x[:, j:j+n_max]
+
+                # Set type selections for non-instantiated objects to inactive
+                is_inst = i_range[None, :] < n_inst[:, [i_obj]]
+                is_active[:, j:j+n_max] = is_inst
+
+                # Correct types for instantiated objects to only select unordered combinations: subsequent variables
+                # cannot have a lower value than prior ones
+                x[:, j:j+n_max] = np.where(is_inst, np.maximum.accumulate(x_obj_type, axis=1), x_obj_type)
+
+        # Correct the connections
+        for i_conn in range(n_obj_types-1):
+            j = j_conn+i_conn*n_x_conn
+            x_conn = x[:, j:j+n_x_conn].reshape((x.shape[0], n_max, n_max)).copy()
+
+            # Deactivate connections for non-instantiated objects
+            n_src, n_tgt = n_inst[:, i_conn], n_inst[:, i_conn+1]
+            is_active_conn = (i_range[None, :, None] < n_src[:, None, None]) & \
+                             (i_range[None, None, :] < n_tgt[:, None, None])
+            x_conn[~is_active_conn] = 0
+            is_active[:, j:j+n_x_conn] = is_active_conn.reshape((x.shape[0], n_x_conn))
+
+            # Ensure that each connector has at least one connection: select the same target as the source to make a
+            # connection, or the last available
+            i_x, i_src = np.where((np.sum(x_conn, axis=2) == 0) & (i_range[None, :] < n_src[:, None]))
+            x_conn[i_x, i_src, np.minimum(i_src, n_tgt[i_x]-1)] = 1
+
+            i_x, i_tgt = np.where((np.sum(x_conn, axis=1) == 0) & (i_range[None, :] < n_tgt[:, None]))
+            x_conn[i_x, np.minimum(i_tgt, n_src[i_x]-1), i_tgt] = 1
+
+            x[:, j:j+n_x_conn] = x_conn.reshape((x.shape[0], n_x_conn))
+
+        # The last block of connection design variables is not used
+        j = j_conn+(n_obj_types-1)*n_x_conn
+        is_active[:, j:j+n_x_conn] = False
+
+    def _get_x_offsets(self) -> Tuple[int, int]:
+        """Get the indices of the first object type and the first connection design variables"""
+        n_obj_types = 3 if self.actuators else 2
+        j_type = n_obj_types if self.choose_nr else 0
+        j_conn = j_type+(n_obj_types*self.n_max if self.choose_type else 0)
+        return j_type, j_conn
+
+    def _get_n_inst(self, x: np.ndarray) -> np.ndarray:
+        """Get the number of instantiated objects (sensors, computers, [actuators])"""
+        n_obj_types = 3 if self.actuators else 2
+        if self.choose_nr:
+            return x[:, :n_obj_types].astype(int)
+        return np.ones((x.shape[0], n_obj_types), dtype=int)*self.n_max
 
     def _arch_evaluate(self, x: np.ndarray, is_active_out: np.ndarray, f_out: np.ndarray, g_out: np.ndarray,
                        h_out: np.ndarray, *args, **kwargs):
         # First correct the design variable so that only valid architectures are evaluated
         self._correct_x_impute(x, is_active_out)
 
-        # Get object-type labels
+        # Get object types (indices into A, B, C) and connection matrices
         n_obj_types = 3 if self.actuators else 2
-        j = n_obj_types if self.choose_nr else 0
-        obj_type_cat_values = [[self.get_categorical_values(x, j+i_obj*self.n_max+dj) for dj in range(self.n_max)]
-                               for i_obj in range(n_obj_types)]
-
-        # Loop over architectures
-        n_x_conn = self.n_max*self.n_max
-        for i, x_i in enumerate(x):
-            j = 0
-
-            # Get the number of instantiated objects
-            if self.choose_nr:
-                n_inst = x_i[j:j+n_obj_types].astype(int)
-                j += n_obj_types
-            else:
-                n_inst = np.ones((n_obj_types,), dtype=int)*self.n_max
-
-            # Get the object types
-            obj_types = []
-            if self.choose_type:
-                for i_obj, n_obj in enumerate(n_inst):
-                    obj_types.append([obj_type_cat_values[i_obj][dj][i] for dj in range(n_obj)])
-                    j += self.n_max
-            else:
-                types = ['A', 'B', 'C']
-                for n in n_inst:
-                    type_cycle = itertools.cycle(types)
-                    obj_types.append([next(type_cycle) for _ in range(n)])
-
-            # Get the connections
-            conn_edges = []
-            for i_conn in range(n_obj_types-1):
-                x_conn = x_i[j:j+n_x_conn].reshape((self.n_max, self.n_max)).astype(bool)
-
-                edges = []
-                n_src, n_tgt = n_inst[i_conn], n_inst[i_conn+1]
-                for i_src in range(n_src):
-                    for i_tgt in range(n_tgt):
-                        if x_conn[i_src, i_tgt]:
-                            edges.append((i_src, i_tgt))
-
-                conn_edges.append(edges)
-                j += n_x_conn
-
-            # Calculate metrics
-            mass = self._calc_mass(obj_types[0], obj_types[1], actuator_types=obj_types[2] if self.actuators else None)
-            failure_rate = self._calc_failure_rate(obj_types[0], obj_types[1], conn_edges[0],
-                                                   actuator_types=obj_types[2] if self.actuators else None,
-                                                   act_conns=conn_edges[1] if self.actuators else None)
-
-            f_out[i, 0] = failure_rate
-            if f_out.shape[1] > 1:
-                f_out[i, 1] = mass
+        n_max = self.n_max
+        j_type, j_conn = self._get_x_offsets()
+        n_inst = self._get_n_inst(x)
+        if self.choose_type:
+            obj_types = x[:, j_type:j_type+n_obj_types*n_max].astype(int).reshape((x.shape[0], n_obj_types, n_max))
+            obj_types[np.arange(n_max)[None, None, :] >= n_inst[:, :, None]] = 0
+        else:
+            obj_types = np.tile(np.arange(n_max) % 3, (x.shape[0], n_obj_types, 1))
+        conns = x[:, j_conn:j_conn+(n_obj_types-1)*n_max*n_max].astype(bool)
+        conns = conns.reshape((x.shape[0], n_obj_types-1, n_max, n_max))
+
+        # Only evaluate unique architectures that have not been evaluated before
+        signatures = np.column_stack([n_inst, obj_types.reshape((x.shape[0], -1)),
+                                      conns.reshape((x.shape[0], -1))]).astype(np.int8)
+        signatures_unique, i_unique, inverse = np.unique(signatures, axis=0, return_index=True, return_inverse=True)
+        keys = [signature.tobytes() for signature in signatures_unique]
+
+        f_unique = np.zeros((len(keys), 2))
+        is_memo = np.zeros((len(keys),), dtype=bool)
+        for i, key in enumerate(keys):
+            if key in self._f_memo:
+                f_unique[i, :] = self._f_memo[key]
+                is_memo[i] = True
+
+        i_eval = i_unique[~is_memo]
+        if len(i_eval) > 0:
+            f_unique[~is_memo, :] = f_eval = self._calc_f_batch(n_inst[i_eval], obj_types[i_eval], conns[i_eval])
+            if len(self._f_memo) < self._n_f_memo_max:
+                for i, key in enumerate(np.array(keys, dtype=object)[~is_memo]):
+                    self._f_memo[key] = f_eval[i, :]
+
+        f_out[:, :] = f_unique[inverse, :f_out.shape[1]]
+
+    def _calc_f_batch(self, n_inst: np.ndarray, obj_types: np.ndarray, conns: np.ndarray) -> np.ndarray:
+        """Calculate failure rate and mass of architectures; architectures are grouped by their nr of instances"""
+        f = np.zeros((n_inst.shape[0], 2))
+        n_inst_groups, i_group = np.unique(n_inst, axis=0, return_inverse=True)
+        for i, n_inst_group in enumerate(n_inst_groups):
+            idx = np.where(i_group == i)[0]
+            obj_types_group = [obj_types[idx, i_obj, :n] for i_obj, n in enumerate(n_inst_group)]
+            conns_group = [conns[idx, i_conn, :n_inst_group[i_conn], :n_inst_group[i_conn+1]]
+                           for i_conn in range(len(n_inst_group)-1)]
+
+            f[idx, 0] = self._calc_failure_rate_batch(obj_types_group, conns_group)
+            f[idx, 1] = self._calc_mass_batch(obj_types_group)
+        return f
 
     @classmethod
     def _calc_mass(cls, sensor_types, computer_types, actuator_types=None):
@@ -354,6 +519,67 @@ class GNCProblemBase(HierarchyProblemBase):
         failure_rate = _branch_failures()
         return np.log10(failure_rate)
 
+    @classmethod
+    def _calc_mass_batch(cls, obj_types: List[np.ndarray]) -> np.ndarray:
+        """Calculate the mass of a group of architectures, obj_types contains type indices (A, B, C) per object type"""
+        mass_table = cls._get_table(cls.mass)
+        return sum(np.sum(mass_table[i_obj, types], axis=1) for i_obj, types in enumerate(obj_types))
+
+    @classmethod
+    def _calc_failure_rate_batch(cls, obj_types: List[np.ndarray], conn_matrices: List[np.ndarray]) -> np.ndarray:
+        """
+        Batch version of `_calc_failure_rate` for a group of architectures with the same nr of object instances:
+        failure scenarios are enumerated as arrays instead of evaluating them one-by-one.
+        """
+        rate_table = cls._get_table(cls.failure_rate)
+        failure_rates = [rate_table[i_obj, types] for i_obj, types in enumerate(obj_types)]
+
+        def _branch_failures(i_rates, idx, src_connected_mask) -> np.ndarray:
+            rates, tgt_rates = failure_rates[i_rates][idx, :], failure_rates[i_rates+1][idx, :]
+            conn_mat = conn_matrices[i_rates][idx, :, :]
+
+            # Get failure scenarios (ok sources) that can occur: non-connected sources are never ok
+            ok_sources = cls._get_failure_scenarios(rates.shape[1])
+            is_possible = ~np.any(ok_sources[None, :, :] & ~src_connected_mask[:, None, :], axis=2)
+            if i_rates > 0:
+                is_possible &= np.any(ok_sources, axis=1)[None, :]
+
+            # Calculate probability of each scenario occurring
+            occurrence_prob = np.where(ok_sources[None, :, :], 1-rates[:, None, :], rates[:, None, :])
+            occurrence_prob = np.prod(np.where(src_connected_mask[:, None, :], occurrence_prob, 1.), axis=2)
+
+            # Check which targets are still connected in each scenario
+            connected_targets = np.einsum('ks,nst->nkt', ok_sources.astype(int), conn_mat.astype(int)) > 0
+
+            # Calculate the probability that the system fails because all remaining connected targets fail (if no
+            # connected targets are available the system fails too)
+            all_tgt_fail_prob = np.prod(np.where(connected_targets, tgt_rates[:, None, :], 1.), axis=2)
+            scenario_rates = np.where(is_possible, occurrence_prob*all_tgt_fail_prob, 0.)
+
+            # Calculate the probability that the system fails because remaining downstream connected targets fail
+            if i_rates < len(conn_matrices)-1:
+                i_branch, i_scenario = np.where(is_possible & np.any(connected_targets, axis=2))
+                if len(i_branch) > 0:
+                    scenario_rates[i_branch, i_scenario] += occurrence_prob[i_branch, i_scenario]*_branch_failures(
+                        i_rates+1, idx[i_branch], connected_targets[i_branch, i_scenario, :])
+
+            return np.sum(scenario_rates, axis=1)
+
+        n = failure_rates[0].shape[0]
+        failure_rate = _branch_failures(0, np.arange(n), np.ones(failure_rates[0].shape, dtype=bool))
+        return np.log10(failure_rate)
+
+    @classmethod
+    def _get_failure_scenarios(cls, n_src: int) -> np.ndarray:
+        """Get all combinations of ok (True) and failed (False) sources, cached per nr of sources"""
+        if n_src not in cls._failure_scenarios:
+            cls._failure_scenarios[n_src] = np.array(list(itertools.product([False, True], repeat=n_src)), dtype=bool)
+        return cls._failure_scenarios[n_src]
+
+    @staticmethod
+    def _get_table(values: dict) -> np.ndarray:
+        return np.array([[values[obj][type_] for type_ in 'ABC'] for obj in 'SCA'])
+
     def __repr__(self):
         return f'{self.__class__.__name__}(choose_nr={self.choose_nr}, n_max={self.n_max}, ' \
                f'choose_type={self.choose_type}, actuators={self.actuators})'
@@ -820,8 +820,68 @@ class CombinatorialHierarchicalMetaProblem(HierarchyProblemBase):
         super().__init__(des_vars, n_obj=problem.n_obj, n_ieq_constr=problem.n_ieq_constr,
                          n_eq_constr=problem.n_eq_constr)
 
+        # Precompile the selection tree and part mappings to be able to correct and map design vectors in batch
+        self._sel_tree_children, self._sel_tree_part = self._compile_selection_tree(x_sel, self.xu[:x_sel.shape[1]])
+        self._parts_opt_values, self._parts_bounds = self._compile_part_mappings(parts, n_opts_max)
+
         self.__correct_output = {}
 
+    @staticmethod
+    def _compile_selection_tree(x_sel: np.ndarray, xu_sel: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Compiles the selection design vectors into a tree that reproduces the sequential matching procedure: at each
+        node the next selection variable is matched against the remaining candidates; if no candidate has that value,
+        the value of the last candidate is used. Returns:
+        - the child node index for each node and selection value (last column: unknown values)
+        - for each node the selected part index (-1 if the node is not a leaf)
+        """
+        n_values = int(max(np.max(x_sel) if x_sel.size > 0 else 0, np.max(xu_sel) if len(xu_sel) > 0 else 0))+1
+        children = []
+        node_part = []
+
+        def _add_node(idx_match, i_sel):
+            i_node = len(node_part)
+            node_part.append(-1)
+            children.append(None)
+            if len(idx_match) == 1:
+                node_part[i_node] = idx_match[0]
+                return i_node
+            if i_sel >= x_sel.shape[1]:
+                raise RuntimeError(f'Selection design vectors are not unique: {x_sel[idx_match, :]}')
+
+            values = x_sel[idx_match, i_sel]
+            child_nodes = {value: _add_node(idx_match[values == value], i_sel+1) for value in np.unique(values)}
+
+            node_children = np.zeros((n_values+1,), dtype=int)
+            node_children[:] = child_nodes[values[-1]]
+            for value, i_child in child_nodes.items():
+                node_children[value] = i_child
+            children[i_node] = node_children
+            return i_node
+
+        _add_node(np.arange(x_sel.shape[0]), 0)
+
+        children_table = -np.ones((len(children), n_values+1), dtype=int)
+        for i_node, node_children in enumerate(children):
+            if node_children is not None:
+                children_table[i_node, :] = node_children
+        return children_table, np.array(node_part, dtype=int)
+
+    @staticmethod
+    def _compile_part_mappings(parts, n_opts_max: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Get for each part the underlying discrete values (padded with the last value) and continuous bounds"""
+        n_dv = len(parts[0]) if len(parts) > 0 else 0
+        opt_values = np.zeros((len(parts), n_dv, max(1, int(np.max(n_opts_max)) if n_dv > 0 else 1)))
+        bounds = np.zeros((len(parts), n_dv, 2))
+        for i_part, part in enumerate(parts):
+            for i_dv, (is_discrete, settings) in enumerate(part):
+                if is_discrete:
+                    opt_values[i_part, i_dv, :] = settings[-1]
+                    opt_values[i_part, i_dv, :len(settings)] = settings
+                else:
+                    bounds[i_part, i_dv, :] = settings
+        return opt_values, bounds
+
     def _get_n_valid_discrete(self) -> int:
         # Sum the nr of combinations for the parts
         return int(np.sum(np.prod(self._parts_n_opts, axis=1)))
@@ -872,29 +932,26 @@ class CombinatorialHierarchicalMetaProblem(HierarchyProblemBase):
         self._correct_x_impute(x, is_active_out)
         i_part_selected = self.__correct_output['i_part_sel']
 
-        parts = self._parts
-        parts_is_active = self._parts_is_active
         n_dv_map = self._x_sel.shape[1]
         xl, xu = self._problem.xl, self._problem.xu
+        is_active = self._parts_is_active[i_part_selected, :]
+        is_discrete = self._parts_is_discrete[i_part_selected, :]
+        is_cont = ~is_discrete
 
         # Map design variables to underlying problem
         x_underlying = x[:, n_dv_map:].copy()
-        for i, i_part in enumerate(i_part_selected):
-            is_active_i = parts_is_active[i_part, :]
-            x_part = x_underlying[i, :]
-            for i_dv, (is_discrete, settings) in enumerate(parts[i_part]):
-                if is_discrete:
-                    if is_active_i[i_dv]:
-                        i_x_mapped = int(x_part[i_dv])
-                        x_part[i_dv] = settings[i_x_mapped] if i_x_mapped < len(settings) else settings[-1]
-                    else:
-                        x_part[i_dv] = 0
-                else:
-                    bnd = settings
-                    if is_active_i[i_dv]:
-                        x_part[i_dv] = bnd[0]+(bnd[1]-bnd[0])*((x_part[i_dv]-xl[i_dv])/(xu[i_dv]-xl[i_dv]))
-                    else:
-                        x_part[i_dv] = .5*np.sum(bnd)
+
+        opt_values = self._parts_opt_values
+        i_x_mapped = np.clip(x_underlying.astype(int), 0, opt_values.shape[2]-1)
+        x_discrete = opt_values[i_part_selected[:, None], np.arange(x_underlying.shape[1])[None, :], i_x_mapped]
+        x_underlying[is_discrete] = np.where(is_active, x_discrete, 0)[is_discrete]
+
+        bounds = self._parts_bounds[i_part_selected, :, :]
+        bnd_lower, bnd_upper = bounds[:, :, 0], bounds[:, :, 1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cont_active = bnd_lower+(bnd_upper-bnd_lower)*((x_underlying-xl)/(xu-xl))
+        x_cont = np.where(is_active, x_cont_active, .5*(bnd_lower+bnd_upper))
+        x_underlying[is_cont] = x_cont[is_cont]
 
         # Evaluate underlying problem
         out = self._problem.evaluate(x_underlying, return_as_dictionary=True)
@@ -908,54 +965,38 @@ class CombinatorialHierarchicalMetaProblem(HierarchyProblemBase):
             h_out[:, :] = out['H']
 
     def _correct_x(self, x: np.ndarray, is_active: np.ndarray):
-        # Match to selection design vector
+        # Match to selection design vector by traversing the selection tree
         x_sel = self._x_sel
-        is_act_sel = self._is_active_sel
         n_dv_sel = x_sel.shape[1]
-        i_part_selected = np.zeros((x.shape[0],), dtype=int)
-        for i, xi in enumerate(x):
+        children, node_part = self._sel_tree_children, self._sel_tree_part
+        i_unknown = children.shape[1]-1
 
-            # Recursively select design vectors matching ours
-            idx_match = np.arange(x_sel.shape[0], dtype=int)
-            for i_sel in range(n_dv_sel):
-                idx_match_i = idx_match[x_sel[idx_match, i_sel] == xi[i_sel]]
-
-                # If none found, we impute
-                if len(idx_match_i) == 0:
-                    xi[i_sel] = imp_dv_value = x_sel[idx_match[-1], i_sel]
-                    idx_match_i = idx_match[x_sel[idx_match, i_sel] == imp_dv_value]
-
-                # If one found, we have a match!
-                if len(idx_match_i) == 1:
-                    i_part = idx_match_i[0]
-                    i_part_selected[i] = i_part
-                    xi[:n_dv_sel] = x_sel[i_part, :]
-                    is_active[i, :n_dv_sel] = is_act_sel[i_part, :]
-                    break
-
-                # Otherwise, we continue searching
-                idx_match = idx_match_i
-            else:
-                raise RuntimeError(f'Could not match design vectors: {xi[:n_dv_sel]}')
+        i_node = np.zeros((x.shape[0],), dtype=int)
+        for i_sel in range(n_dv_sel):
+            is_branch = node_part[i_node] == -1
+            if not np.any(is_branch):
+                break
+
+            values = x[is_branch, i_sel].astype(int)
+            values[(values < 0) | (values >= i_unknown)] = i_unknown
+            i_node[is_branch] = children[i_node[is_branch], values]
+
+        i_part_selected = node_part[i_node]
+        if np.any(i_part_selected == -1):
+            raise RuntimeError(f'Could not match design vectors: {x[i_part_selected == -1, :n_dv_sel]}')
+
+        x[:, :n_dv_sel] = x_sel[i_part_selected, :]
+        is_active[:, :n_dv_sel] = self._is_active_sel[i_part_selected, :]
 
         # Correct DVs of underlying problem and set activeness
-        n_dv_map = x_sel.shape[1]
-        part_is_active = self._parts_is_active
-        part_is_discrete = self._parts_is_discrete
-        part_n_opts = self._parts_n_opts
-        for i, i_part in enumerate(i_part_selected):
-            is_active[i, n_dv_map:] = part_is_active[i_part, :]
-
-            # Correct upper bounds of discrete variables
-            is_discrete = part_is_discrete[i_part, :]
-            n_opts = part_n_opts[i_part, is_discrete]
-            i_x_discrete = np.where(is_discrete)[0]+n_dv_map
-            x_discrete_part = x[i, i_x_discrete]
-            for i_opt, n_opt in enumerate(n_opts):
-                if x_discrete_part[i_opt] >= n_opt:
-                    x_discrete_part[i_opt] = n_opt-1
-
-            x[i, i_x_discrete] = x_discrete_part
+        is_active[:, n_dv_sel:] = self._parts_is_active[i_part_selected, :]
+
+        # Correct upper bounds of discrete variables
+        x_underlying = x[:, n_dv_sel:]
+        n_opts = self._parts_n_opts[i_part_selected, :]
+        is_out_of_bounds = self._parts_is_discrete[i_part_selected, :] & (x_underlying >= n_opts)
+        x_underlying[is_out_of_bounds] = n_opts[is_out_of_bounds]-1
+        x[:, n_dv_sel:] = x_underlying
 
         self.__correct_output = {'i_part_sel': i_part_selected}
 
@@ -52,16 +52,21 @@ class OpenTurbArchProblemWrapper(HierarchyProblemBase):
 
     Available here:
     https://www.researchgate.net/publication/353530868_System_Architecture_Optimization_An_Open_Source_Multidisciplinary_Aircraft_Jet_Engine_Architecting_Problem
+
+    If `n_parallel` is given, design vectors are evaluated in a pool of `n_parallel` worker processes, submitted in
+    chunks of `n_chunk` design vectors. The pool is kept alive between evaluations; use `shutdown` to stop it.
     """
 
     default_enable_pf_calc = False
 
-    def __init__(self, open_turb_arch_problem: 'ArchitectingProblem', n_parallel=None):
+    def __init__(self, open_turb_arch_problem: 'ArchitectingProblem', n_parallel=None, n_chunk=1):
         check_dependency()
         self._problem = open_turb_arch_problem
         self.n_parallel = n_parallel
+        self.n_chunk = n_chunk
         self.verbose = False
         self.results_folder = None
+        self._executor: Optional[concurrent.futures.ProcessPoolExecutor] = None
 
         # open_turb_arch_problem.max_iter = 10  # Leads to a high failure rate: ~88% for the simple problem
         open_turb_arch_problem.max_iter = 30  # Used for the paper
@@ -110,19 +115,53 @@ class OpenTurbArchProblemWrapper(HierarchyProblemBase):
     def _arch_evaluate(self, x: np.ndarray, is_active_out: np.ndarray, f_out: np.ndarray, g_out: np.ndarray,
                        h_out: np.ndarray, *args, **kwargs):
 
+        def _set_results(i_x, x_imputed, f, g, is_act):
+            x[i_x, :] = x_imputed
+            is_active_out[i_x, :] = is_act
+            f_out[i_x, :] = np.array(f)*self._obj_factors
+            g_out[i_x, :] = (np.array(g)-self._con_offsets)*self._con_factors
+
         if self.n_parallel is None:
-            results = [self._arch_evaluate_x(x[i, :]) for i in range(x.shape[0])]
-        else:
-            with concurrent.futures.ProcessPoolExecutor(max_workers=self.n_parallel) as executor:
-                futures = [executor.submit(self._arch_evaluate_x, x[i, :]) for i in range(x.shape[0])]
-                concurrent.futures.wait(futures)
-                results = [fut.result() for fut in futures]
-
-        for i, (x_imputed, f, g, is_act) in enumerate(results):
-            x[i, :] = x_imputed
-            is_active_out[i, :] = is_act
-            f_out[i, :] = np.array(f)*self._obj_factors
-            g_out[i, :] = (np.array(g)-self._con_offsets)*self._con_factors
+            for i in range(x.shape[0]):
+                _set_results(i, *self._arch_evaluate_x(x[i, :]))
+            return
+
+        # Submit chunks of design vectors to the worker pool, and process the results as soon as they are available
+        executor = self._get_executor()
+        n_chunk = max(1, self.n_chunk)
+        futures = {executor.submit(_evaluate_in_worker, x[i:i+n_chunk, :], self.verbose, self.results_folder): i
+                   for i in range(0, x.shape[0], n_chunk)}
+        for future in concurrent.futures.as_completed(futures):
+            i_chunk = futures[future]
+            for i, results in enumerate(future.result()):
+                _set_results(i_chunk+i, *results)
+
+    def _get_executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        """The worker pool is created once: each worker receives a copy of this problem and warms up its model"""
+        if self._executor is None:
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.n_parallel, initializer=_init_worker, initargs=(self,))
+        return self._executor
+
+    def shutdown(self):
+        """Shut down the worker pool (it is recreated when needed)"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _warm_up(self):
+        # Generating an architecture loads all model-related modules
+        self._problem.generate_architecture(self._convert_x(self.xl))
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['_executor'] = None
+        return state
+
+    def __del__(self):
+        executor = getattr(self, '_executor', None)
+        if executor is not None:
+            executor.shutdown(wait=False)
 
     def _arch_evaluate_x(self, x: np.ndarray):
         self._problem.verbose = self.verbose
@@ -143,6 +182,22 @@ class OpenTurbArchProblemWrapper(HierarchyProblemBase):
         return [int(value) if mask[i] else float(value) for i, value in enumerate(x)]
 
 
+_worker_problem: Optional[OpenTurbArchProblemWrapper] = None
+
+
+def _init_worker(problem: OpenTurbArchProblemWrapper):
+    global _worker_problem
+    _worker_problem = problem
+    problem._warm_up()
+
+
+def _evaluate_in_worker(x: np.ndarray, verbose: bool, results_folder: Optional[str]):
+    problem = _worker_problem
+    problem.verbose = verbose
+    problem.results_folder = results_folder
+    return [problem._arch_evaluate_x(x[i, :]) for i in range(x.shape[0])]
+
+
 class SimpleTurbofanArch(OpenTurbArchProblemWrapper):
     """
     Instantiation of the simple jet engine architecting problem:
@@ -155,9 +210,9 @@ class SimpleTurbofanArch(OpenTurbArchProblemWrapper):
     https://www.researchgate.net/publication/353530868_System_Architecture_Optimization_An_Open_Source_Multidisciplinary_Aircraft_Jet_Engine_Architecting_Problem
     """
 
-    def __init__(self, n_parallel=None):
+    def __init__(self, n_parallel=None, n_chunk=1):
         check_dependency()
-        super().__init__(get_simple_architecting_problem(), n_parallel=n_parallel)
+        super().__init__(get_simple_architecting_problem(), n_parallel=n_parallel, n_chunk=n_chunk)
 
     def _get_n_valid_discrete(self) -> int:
         n_valid_no_fan = 1
@@ -194,9 +249,9 @@ class RealisticTurbofanArch(OpenTurbArchProblemWrapper):
     https://www.researchgate.net/publication/353530868_System_Architecture_Optimization_An_Open_Source_Multidisciplinary_Aircraft_Jet_Engine_Architecting_Problem
     """
 
-    def __init__(self, n_parallel=None):
+    def __init__(self, n_parallel=None, n_chunk=1):
         check_dependency()
-        super().__init__(get_architecting_problem(), n_parallel=n_parallel)
+        super().__init__(get_architecting_problem(), n_parallel=n_parallel, n_chunk=n_chunk)
 
     def _get_n_valid_discrete(self) -> int:
         n_valid_no_fan = 1
@@ -16,9 +16,9 @@ Contact: jasper.bussemaker@dlr.de
 """
 import logging
 import warnings
-import itertools
+import concurrent.futures
 import numpy as np
-from typing import Optional, Tuple, List
+from typing import Optional, Tuple, List, Union
 from scipy.stats.qmc import Sobol
 from scipy.spatial import distance
 
@@ -32,6 +32,7 @@ from pymoo.core.duplicate import DefaultDuplicateElimination
 from pymoo.operators.sampling.lhs import LatinHypercubeSampling, sampling_lhs_unit
 
 from sb_arch_opt.problem import ArchOptProblemBase, ArchOptRepair
+from sb_arch_opt.discrete_x import CompactDiscreteX, IndexedDiscreteX
 
 __all__ = ['HierarchicalExhaustiveSampling', 'HierarchicalLatinHypercubeSampling', 'HierarchicalRandomSampling',
            'get_init_sampler', 'LargeDuplicateElimination', 'TrailRepairWarning']
@@ -58,106 +59,117 @@ class TrailRepairWarning(RuntimeWarning):
 class HierarchicalExhaustiveSampling(Sampling):
     """Exhaustively samples the design space, taking n_cont samples for each continuous variable.
     Can take a long time if the design space is large and the problem doesn't provide a way to generate all discrete
-    design vectors, and doesn't work well for purely continuous problems."""
+    design vectors, and doesn't work well for purely continuous problems.
+    Set n_parallel to run trial-and-repair enumeration in several processes (the problem should be picklable); if not
+    given, `all_discrete_x_n_parallel` of the problem is used."""
 
-    def __init__(self, repair: Repair = None, n_cont=5):
+    _n_shards_per_worker = 4
+    _n_chunk_expand = 2000
+
+    def __init__(self, repair: Repair = None, n_cont=5, n_parallel=None):
         super().__init__()
         if repair is None:
             repair = ArchOptRepair()
         self._repair = repair
         self._n_cont = n_cont
+        self.n_parallel = n_parallel
 
     def _do(self, problem: Problem, n_samples, **kwargs):
         return self.do_sample(problem)
 
     def do_sample(self, problem: Problem):
         # First sample only discrete dimensions
-        x_discr, is_act_discr = self.get_all_x_discrete(problem)
+        x_discrete = self.get_all_x_discrete_compact(problem)
 
-        # Expand along continuous dimensions
+        # Determine the nr of samples per discrete design vector: n_cont for each active continuous variable
         n_cont = self._n_cont
         is_cont_mask = self.get_is_cont_mask(problem)
-        if n_cont > 1 and np.any(is_cont_mask):
-            x = x_discr
-            is_act = is_act_discr
-            for i_dv in np.where(is_cont_mask)[0]:
-                # Expand when continuous variable is active
-                is_act_i = is_act[:, i_dv]
-                n_repeat = np.ones(len(is_act_i), dtype=int)
-                n_repeat[is_act_i] = n_cont
-
-                x = np.repeat(x, n_repeat, axis=0)
-                is_act = np.repeat(is_act, n_repeat, axis=0)
-
-                # Fill sampled values
-                rep_idx = np.cumsum([0]+list(n_repeat))[:-1]
-                dv_sampled = np.linspace(problem.xl[i_dv], problem.xu[i_dv], n_cont)
-                for i in np.where(is_act_i)[0]:
-                    x[rep_idx[i]:rep_idx[i]+n_cont, i_dv] = dv_sampled
+        expand_cont = n_cont > 1 and np.any(is_cont_mask)
+        n_expand = n_cont**x_discrete.get_n_active(is_cont_mask) if expand_cont else np.ones((len(x_discrete),), int)
+
+        # Expand along continuous dimensions in chunks, so that the expanded discrete design vectors are never copied
+        # completely
+        x = np.empty((int(np.sum(n_expand)), problem.n_var))
+        i_x = 0
+        for x_discr, is_act_discr in x_discrete.iter_chunks(n_chunk=self._n_chunk_expand, row_sizes=n_expand):
+            if expand_cont:
+                x_discr = self._expand_continuous(problem, x_discr, is_act_discr)
+            x[i_x:i_x+x_discr.shape[0], :] = x_discr
+            i_x += x_discr.shape[0]
 
-        else:
-            x = x_discr
+        return x
 
+    def _expand_continuous(self, problem: Problem, x: np.ndarray, is_act: np.ndarray) -> np.ndarray:
+        n_cont = self._n_cont
+        for i_dv in np.where(self.get_is_cont_mask(problem))[0]:
+            # Expand when continuous variable is active
+            is_act_i = is_act[:, i_dv]
+            n_repeat = np.ones(len(is_act_i), dtype=int)
+            n_repeat[is_act_i] = n_cont
+
+            x = np.repeat(x, n_repeat, axis=0)
+            is_act = np.repeat(is_act, n_repeat, axis=0)
+
+            # Fill sampled values
+            rep_idx = np.cumsum([0]+list(n_repeat))[:-1]
+            dv_sampled = np.linspace(problem.xl[i_dv], problem.xu[i_dv], n_cont)
+            for i in np.where(is_act_i)[0]:
+                x[rep_idx[i]:rep_idx[i]+n_cont, i_dv] = dv_sampled
         return x
 
     @staticmethod
     def has_cheap_all_x_discrete(problem: Problem):
         if isinstance(problem, ArchOptProblemBase):
             # Check if the problem itself provides all discrete design vectors
-            x_discrete, _ = problem.all_discrete_x
-            if x_discrete is not None:
+            if problem.all_discrete_x_compact is not None:
                 return True
 
         return False
 
     def get_all_x_discrete(self, problem: Problem):
+        return self.get_all_x_discrete_compact(problem).get()
+
+    def get_all_x_discrete_compact(self, problem: Problem) -> CompactDiscreteX:
         # Check if the problem itself can provide all discrete design vectors
         if isinstance(problem, ArchOptProblemBase):
-            x_discr, is_act_discr = problem.all_discrete_x
-            if x_discr is not None:
-                return x_discr, is_act_discr
+            x_discrete = problem.all_discrete_x_compact
+            if x_discrete is not None:
+                return x_discrete
 
         # Otherwise, use trail and repair (costly!)
         warnings.warn(f'Generating hierarchical discrete samples by trial and repair for {problem!r}! '
                       f'Consider implementing `_gen_all_discrete_x`', TrailRepairWarning)
-        return self.get_all_x_discrete_by_trial_and_repair(problem)
+        x_discr, is_act_discr = self.get_all_x_discrete_by_trial_and_repair(problem)
+        x_discrete = CompactDiscreteX.from_x(x_discr, is_act_discr, self.get_is_cont_mask(problem))
 
-    def get_all_x_discrete_by_trial_and_repair(self, problem: Problem):
-        # First sample only discrete dimensions
-        opt_values = self.get_exhaustive_sample_values(problem, 1)
-        x = np.array(list(itertools.product(*opt_values)))
+        # Store in the cache, so that next time (or in other processes) all_discrete_x can be loaded from there
+        if isinstance(problem, ArchOptProblemBase) and problem.cache_all_discrete_x:
+            problem.store_all_discrete_x_cache(x_discrete)
+            problem.reset_all_discrete_x()
 
-        is_cont_mask = self.get_is_cont_mask(problem)
-        is_discrete_mask = ~is_cont_mask
-
-        # Create and repair the sampled design vectors in batches
-        n_batch = 1000
-        x_later = x
-        x_repaired = x[:0, :]
-        is_active_repaired = np.zeros(x_repaired.shape, dtype=bool)
-        while x_later.shape[0] > 0:
-            # Repair current batch
-            x_repair = x_later[:n_batch, :]
-            x_later = x_later[x_repair.shape[0]:, :]
-            # print(f'Sampling {x_repair.shape[0]} ({x_later.shape[0]} to go; {x_repaired.shape[0]} sampled)')
-
-            x_repair_input = x_repair
-            x_repair = self._repair.do(problem, x_repair)
-            if isinstance(self._repair, ArchOptRepair):
-                is_active = self._repair.latest_is_active
-            else:
-                is_active = np.ones(x_repair.shape, dtype=bool)
+        return x_discrete
 
-            # Remove repaired points
-            is_not_repaired = ~np.any(x_repair[:, is_discrete_mask] != x_repair_input[:, is_discrete_mask], axis=1)
-            x_repair = x_repair[is_not_repaired, :]
-            is_active = is_active[is_not_repaired, :]
-
-            x_repaired = np.row_stack([x_repaired, x_repair])
-            is_active_repaired = np.row_stack([is_active_repaired, is_active.astype(bool)])
-
-        x_discr = np.row_stack(x_repaired)
-        is_act_discr = np.row_stack(is_active_repaired)
+    def get_all_x_discrete_by_trial_and_repair(self, problem: Problem, n_batch=10000):
+        # Sample only discrete dimensions: the Cartesian product is generated and repaired in chunks, and only the
+        # valid (not repaired) design vectors are kept
+        opt_values = self.get_exhaustive_sample_values(problem, 1)
+        n_total = int(np.prod([len(values) for values in opt_values], dtype=object))
+
+        # Split the product index range into shards repaired in parallel, results are merged in order
+        n_parallel = self.n_parallel
+        if n_parallel is None and isinstance(problem, ArchOptProblemBase):
+            n_parallel = problem.all_discrete_x_n_parallel
+        if n_parallel is not None and n_parallel > 1 and n_total > n_batch:
+            n_shard = max(n_batch, int(np.ceil(n_total/(n_parallel*self._n_shards_per_worker))))
+            i_shards = list(range(0, n_total, n_shard))
+            with concurrent.futures.ProcessPoolExecutor(max_workers=n_parallel) as executor:
+                futures = [executor.submit(_trial_and_repair_shard, self, problem, opt_values, i_start,
+                                           min(i_start+n_shard, n_total), n_batch) for i_start in i_shards]
+                results = [future.result() for future in futures]
+            x_discr = np.row_stack([x for x, _ in results])
+            is_act_discr = np.row_stack([is_active for _, is_active in results])
+        else:
+            x_discr, is_act_discr = self._trial_and_repair(problem, opt_values, 0, n_total, n_batch)
 
         # Impute continuous values
         if isinstance(problem, ArchOptProblemBase):
@@ -165,6 +177,56 @@ class HierarchicalExhaustiveSampling(Sampling):
 
         return x_discr, is_act_discr
 
+    def _trial_and_repair(self, problem: Problem, opt_values: List[np.ndarray], i_start: int, i_end: int,
+                          n_batch: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Repair a range of the Cartesian product in chunks, storing the valid vectors in geometrically growing
+        buffers"""
+        x_buffer = np.zeros((min(i_end-i_start, n_batch), problem.n_var))
+        is_active_buffer = np.zeros(x_buffer.shape, dtype=bool)
+        n_valid = 0
+        for i_chunk in range(i_start, i_end, n_batch):
+            x_chunk = self.get_cartesian_product_chunk(opt_values, i_chunk, min(i_chunk+n_batch, i_end))
+            x_valid, is_active_valid = self._repair_and_filter(problem, x_chunk)
+
+            # Grow the buffers if needed
+            n_valid_next = n_valid+x_valid.shape[0]
+            if n_valid_next > x_buffer.shape[0]:
+                n_buffer = max(n_valid_next, 2*x_buffer.shape[0])
+                x_buffer = np.row_stack([x_buffer[:n_valid, :], np.zeros((n_buffer-n_valid, problem.n_var))])
+                is_active_buffer = np.row_stack([is_active_buffer[:n_valid, :],
+                                                 np.zeros((n_buffer-n_valid, problem.n_var), dtype=bool)])
+
+            x_buffer[n_valid:n_valid_next, :] = x_valid
+            is_active_buffer[n_valid:n_valid_next, :] = is_active_valid
+            n_valid = n_valid_next
+
+        return x_buffer[:n_valid, :].copy(), is_active_buffer[:n_valid, :].copy()
+
+    def _repair_and_filter(self, problem: Problem, x: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Repair design vectors and only return the ones that were not modified (i.e. valid) by the repair"""
+        is_discrete_mask = ~self.get_is_cont_mask(problem)
+
+        x_repaired = self._repair.do(problem, x)
+        if isinstance(self._repair, ArchOptRepair):
+            is_active = self._repair.latest_is_active
+        else:
+            is_active = np.ones(x_repaired.shape, dtype=bool)
+
+        is_not_repaired = ~np.any(x_repaired[:, is_discrete_mask] != x[:, is_discrete_mask], axis=1)
+        return x_repaired[is_not_repaired, :], is_active[is_not_repaired, :].astype(bool)
+
+    @staticmethod
+    def get_cartesian_product_chunk(opt_values: List[np.ndarray], i_start: int, i_end: int) -> np.ndarray:
+        """Get part of the Cartesian product of option values (same order as itertools.product) by decoding the
+        product indices as mixed-radix numbers"""
+        x = np.zeros((i_end-i_start, len(opt_values)))
+        idx = np.arange(i_start, i_end, dtype=np.int64)
+        for i_dv in reversed(range(len(opt_values))):
+            values = opt_values[i_dv]
+            idx, i_value = np.divmod(idx, len(values))
+            x[:, i_dv] = values[i_value]
+        return x
+
     @classmethod
     def get_exhaustive_sample_values(cls, problem: Problem, n_cont=5):
         # Determine bounds and which design variables are discrete
@@ -189,38 +251,82 @@ class HierarchicalExhaustiveSampling(Sampling):
     @classmethod
     def get_n_sample_exhaustive(cls, problem: Problem, n_cont=5):
         values = cls.get_exhaustive_sample_values(problem, n_cont=n_cont)
-        return int(np.prod([len(opts) for opts in values], dtype=np.float))
+        return int(np.prod([len(opts) for opts in values], dtype=float))
 
     def __repr__(self):
         return f'{self.__class__.__name__}()'
 
 
+def _trial_and_repair_shard(sampling: HierarchicalExhaustiveSampling, problem: Problem, opt_values, i_start, i_end,
+                            n_batch):
+    return sampling._trial_and_repair(problem, opt_values, i_start, i_end, n_batch)
+
+
 class HierarchicalLatinHypercubeSampling(LatinHypercubeSampling):
     """
     Latin hypercube sampling only returning repaired samples. Additionally, the hierarchical random sampling procedure
     is used to get the best distribution corresponding to the real distribution of hierarchical variables.
+
+    By default, sampling is repeated `iterations` times and the best-scored sample according to `criterion` is kept.
+    Set ese to True to instead sample once and then optimize the continuous variables using the Enhanced Stochastic
+    Evolutionary (ESE) algorithm, minimizing the phi_p criterion (a smooth version of the maximin distance criterion):
+    this gives better space-filling designs, however takes longer. Note that with ESE, the `criterion` is not used.
+    Only values of continuous variables that are active in both design vectors are exchanged, so the discrete design
+    vectors and imputed values are kept.
+    Jin et al., "An efficient algorithm for constructing optimal design of computer experiments", 2005.
+    DOI: 10.1016/j.jspi.2004.02.014
+
+    Set n_parallel to run several ESE optimizations (from different initial samples) in parallel processes and keep the
+    best one (the problem should be picklable).
     """
 
-    def __init__(self, repair: Repair = None, **kwargs):
+    _ese_p = 10
+    _ese_n_inner_max = 100
+    _ese_n_candidates_max = 50
+    _ese_tol = 1e-3
+    _ese_n_no_improve_max = 2
+
+    def __init__(self, repair: Repair = None, ese=False, n_parallel=None, **kwargs):
         super().__init__(**kwargs)
         if repair is None:
             repair = ArchOptRepair()
         self._repair = repair
+        self._random_sampling = HierarchicalRandomSampling(repair=repair, sobol=False)
+        self.ese = ese
+        self.n_parallel = n_parallel
 
     def _do(self, problem: Problem, n_samples, **kwargs):
         if self._repair is None:
             return super()._do(problem, n_samples, **kwargs)
 
         # Prepare sampling
-        x_all, is_act = HierarchicalRandomSampling.get_hierarchical_cartesian_product(problem, self._repair)
+        x_all = HierarchicalRandomSampling.get_hierarchical_cartesian_product(problem, self._repair)
+
+        if self.criterion is None:
+            return self._random_sampling.randomly_sample(problem, n_samples, x_all, lhs=True)
+        if not self.ese or not np.any(HierarchicalExhaustiveSampling.get_is_cont_mask(problem)):
+            return self._sample_best_scored(problem, n_samples, x_all)
+
+        # Optimize the continuous variables, optionally in parallel from several initial samples
+        if self.n_parallel is None:
+            x, _ = self._sample_optimized(problem, n_samples, x_all)
+            return x
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.n_parallel) as executor:
+            futures = [executor.submit(_optimized_lhs_shard, self, problem, n_samples, x_all, np.random.randint(2**31))
+                       for _ in range(self.n_parallel)]
+            results = [future.result() for future in futures]
+
+        x, _ = min(results, key=lambda result: result[1])
+        return x
+
+    def _sample_best_scored(self, problem: Problem, n_samples, x_all):
         xl, xu = problem.bounds()
 
         # Sample several times to find the best-scored samples
         best_x = best_score = None
         for _ in range(self.iterations):
-            x = HierarchicalRandomSampling.randomly_sample(problem, n_samples, self._repair, x_all, is_act, lhs=True)
-            if self.criterion is None:
-                return x
+            x = self._random_sampling.randomly_sample(problem, n_samples, x_all, lhs=True)
 
             x_unit = (x-xl)/(xu-xl)
             score = self.criterion(x_unit)
@@ -230,10 +336,162 @@ class HierarchicalLatinHypercubeSampling(LatinHypercubeSampling):
 
         return best_x
 
+    def _sample_optimized(self, problem: Problem, n_samples, x_all, seed=None) -> Tuple[np.ndarray, float]:
+        x = self._random_sampling.randomly_sample(problem, n_samples, x_all, lhs=True)
+        is_cont_mask = HierarchicalExhaustiveSampling.get_is_cont_mask(problem)
+
+        # Continuous values can only be exchanged if they are active
+        is_swappable = np.zeros(x.shape, dtype=bool)
+        if isinstance(problem, ArchOptProblemBase):
+            _, is_active = problem.correct_x(x)
+            is_swappable[:, is_cont_mask] = is_active[:, is_cont_mask]
+        else:
+            is_swappable[:, is_cont_mask] = True
+
+        xl, xu = problem.bounds()
+        dx = np.where(xu > xl, xu-xl, 1)
+        x_unit = (x-xl)/dx
+
+        rng = np.random.default_rng(np.random.randint(2**31) if seed is None else seed)
+        x_unit, phi_p = self._optimize_ese(x_unit, is_swappable, self.iterations, rng)
+
+        x[:, is_cont_mask] = x_unit[:, is_cont_mask]*dx[is_cont_mask]+xl[is_cont_mask]
+        return x, phi_p
+
+    @classmethod
+    def _optimize_ese(cls, x: np.ndarray, is_swappable: np.ndarray, n_outer: int, rng: np.random.Generator) \
+            -> Tuple[np.ndarray, float]:
+        """Minimize the phi_p criterion by exchanging values within columns of x, only between swappable elements"""
+        n, nx = x.shape
+        cols = [i_col for i_col in range(nx) if np.sum(is_swappable[:, i_col]) >= 2]
+        if len(cols) == 0:
+            return x, cls._get_phi_p(x)
+        i_rows = {i_col: np.where(is_swappable[:, i_col])[0] for i_col in cols}
+        x = x.copy()
+
+        n_cand = max(1, min(cls._ese_n_candidates_max, n//5))
+        n_inner = max(1, min(cls._ese_n_inner_max, (2*n*len(cols))//n_cand))
+
+        # Pairwise phi_p terms (d^-p), normalized by the smallest distance for numerical stability
+        d2 = distance.squareform(distance.pdist(x, 'sqeuclidean'))
+        d2_ref = cls._get_d2_ref(d2)
+
+        def _get_terms(d2_):
+            return cls._get_phi_p_terms(d2_, d2_ref)
+
+        terms = _get_terms(d2)
+        np.fill_diagonal(terms, 0)
+        terms_sum = np.sum(terms, axis=1)
+        phi = np.sum(terms_sum)/2
+
+        x_best, phi_best = x.copy(), phi
+        threshold = .005*phi
+        i_cand = np.arange(n_cand)
+        n_no_improve = 0
+        for _ in range(n_outer):
+            phi_best_prev = phi_best
+            n_accept = n_improve = 0
+
+            for i_inner in range(n_inner):
+                # Generate candidate exchanges of two values within a column
+                i_col = cols[i_inner % len(cols)]
+                rows = i_rows[i_col]
+                i_rows1 = rng.integers(len(rows), size=n_cand)
+                i1 = rows[i_rows1]
+                i2 = rows[(i_rows1+rng.integers(1, len(rows), size=n_cand)) % len(rows)]
+
+                # Update distances of the exchanged rows to all other rows: (x-x2)^2-(x-x1)^2 = (x1-x2)(2x-x1-x2)
+                x_col = x[:, i_col]
+                x1, x2 = x_col[i1, None], x_col[i2, None]
+                d2_delta = (x1-x2)*(2*x_col[None, :]-x1-x2)
+                terms1, terms2 = _get_terms(d2[i1, :]+d2_delta), _get_terms(d2[i2, :]-d2_delta)
+                for terms_new in [terms1, terms2]:
+                    terms_new[i_cand, i1] = 0
+                    terms_new[i_cand, i2] = 0
+
+                terms12 = terms[i1, i2]
+                phi_cand = phi-terms_sum[i1]-terms_sum[i2]+2*terms12+np.sum(terms1, axis=1)+np.sum(terms2, axis=1)
+
+                # Accept the best candidate if it is not worse than the threshold
+                i_best = np.argmin(phi_cand)
+                if phi_cand[i_best]-phi > threshold*rng.random():
+                    continue
+                n_accept += 1
+
+                j1, j2 = i1[i_best], i2[i_best]
+                x[j1, i_col], x[j2, i_col] = x[j2, i_col], x[j1, i_col]
+                for j, terms_new in [(j1, terms1[i_best, :]), (j2, terms2[i_best, :])]:
+                    terms_sum += terms_new-terms[j, :]
+                    terms_new[j] = 0
+                    terms[j, :] = terms[:, j] = terms_new
+                    d2[j, :] = d2[:, j] = np.sum((x-x[j, :])**2, axis=1)
+                terms[j1, j2] = terms[j2, j1] = terms12[i_best]
+                terms_sum[j1] = np.sum(terms[j1, :])
+                terms_sum[j2] = np.sum(terms[j2, :])
+                phi = phi_cand[i_best]
+
+                if phi < phi_best:
+                    x_best, phi_best = x.copy(), phi
+                    n_improve += 1
+
+            # Prevent drift of incrementally-updated values
+            terms_sum = np.sum(terms, axis=1)
+            phi = np.sum(terms_sum)/2
+
+            # Stop if the criterion did not improve significantly for several iterations (phi^(1/p) is compared)
+            if (phi_best_prev/phi_best)**(1/cls._ese_p)-1 < cls._ese_tol:
+                n_no_improve += 1
+                if n_no_improve >= cls._ese_n_no_improve_max:
+                    break
+            else:
+                n_no_improve = 0
+
+            # Update the acceptance threshold: lower if improving, otherwise increase to explore
+            f_accept = n_accept/n_inner
+            if phi_best < phi_best_prev:
+                if f_accept > .1 and n_improve < n_accept:
+                    threshold *= .8
+                elif f_accept <= .1:
+                    threshold /= .8
+            elif f_accept < .1:
+                threshold /= .7
+            elif f_accept > .8:
+                threshold *= .9
+
+        return x_best, cls._get_phi_p(x_best)
+
+    @classmethod
+    def _get_phi_p(cls, x: np.ndarray) -> float:
+        """Phi_p criterion (lower is better): (sum_ij d_ij^-p)^(1/p)"""
+        if x.shape[0] < 2:
+            return 0.
+        d2 = distance.pdist(x, 'sqeuclidean')
+        d2_ref = cls._get_d2_ref(d2)
+        return np.sum(cls._get_phi_p_terms(d2, d2_ref))**(1/cls._ese_p)/np.sqrt(d2_ref)
+
+    @classmethod
+    def _get_phi_p_terms(cls, d2: np.ndarray, d2_ref: float) -> np.ndarray:
+        """Get (d/d_ref)^-p from squared distances; p should be even (repeated multiplication is much faster than pow)"""
+        ratio = d2_ref/np.maximum(d2, 1e-8*d2_ref)
+        terms = ratio.copy()
+        for _ in range(cls._ese_p//2-1):
+            terms *= ratio
+        return terms
+
+    @staticmethod
+    def _get_d2_ref(d2: np.ndarray) -> float:
+        d2_positive = d2[d2 > 0]
+        return float(np.min(d2_positive)) if len(d2_positive) > 0 else 1.
+
     def __repr__(self):
         return f'{self.__class__.__name__}()'
 
 
+def _optimized_lhs_shard(sampling: HierarchicalLatinHypercubeSampling, problem: Problem, n_samples, x_all, seed):
+    np.random.seed(seed)
+    return sampling._sample_optimized(problem, n_samples, x_all, seed=seed)
+
+
 class HierarchicalRandomSampling(FloatRandomSampling):
     """
     Hierarchical mixed-discrete sampling. There are two ways the random sampling is performed:
@@ -247,27 +505,37 @@ class HierarchicalRandomSampling(FloatRandomSampling):
        2. Repair/impute design vectors
 
     The first way yields better results, as there is an even chance of selecting every valid discrete design vector,
-    however it takes more memory and might be too much for very large design spaces.
+    however it takes more memory and might be too much for very large design spaces. If the problem can generate
+    discrete design vectors from their index (see `ArchOptProblemBase.get_indexed_discrete_x`), the first way is
+    applied without generating all discrete design vectors: indices are sampled per group instead.
+
+    If Sobol sampling is used, the scrambled Sobol engines persist across calls, so subsequent calls continue the
+    sequence. Provide a seed to get reproducible samples; otherwise, the engines are seeded from numpy's global random
+    state.
     """
 
     _n_comb_gen_all_max = 100e3
+    _n_choice_enumerate_max = 100e3
 
-    def __init__(self, repair: Repair = None, sobol=True):
+    def __init__(self, repair: Repair = None, sobol=True, seed=None):
         if repair is None:
             repair = ArchOptRepair()
         self._repair = repair
         self.sobol = sobol
+        self.seed = seed
+        self._rng = None if seed is None else np.random.default_rng(seed)
+        self._sobol_engines = {}
         super().__init__()
 
     def _do(self, problem, n_samples, **kwargs):
         # Get Cartesian product of all discrete design variables (only available if design space is not too large)
-        x, is_active = self.get_hierarchical_cartesian_product(problem, self._repair)
+        x_all = self.get_hierarchical_cartesian_product(problem, self._repair)
 
-        return self.randomly_sample(problem, n_samples, self._repair, x, is_active, sobol=self.sobol)
+        return self.randomly_sample(problem, n_samples, x_all)
 
     @classmethod
     def get_hierarchical_cartesian_product(cls, problem: Problem, repair: Repair) \
-            -> Tuple[Optional[np.ndarray], Optional[np.ndarray]]:
+            -> Optional[Union[CompactDiscreteX, IndexedDiscreteX]]:
         # Get values to be sampled for each discrete design variable
         exhaustive_sampling = HierarchicalExhaustiveSampling(repair=repair, n_cont=1)
         opt_values = exhaustive_sampling.get_exhaustive_sample_values(problem, n_cont=1)
@@ -278,30 +546,31 @@ class HierarchicalRandomSampling(FloatRandomSampling):
         # If less than some threshold, sample all and then select (this gives a better distribution)
         if n_opt_values < cls._n_comb_gen_all_max or exhaustive_sampling.has_cheap_all_x_discrete(problem):
             try:
-                x, is_active = exhaustive_sampling.get_all_x_discrete(problem)
-                return x, is_active
+                return exhaustive_sampling.get_all_x_discrete_compact(problem)
             except MemoryError:
                 pass
 
+        # Otherwise, sample by index if the problem can generate design vectors from their index
+        if isinstance(problem, ArchOptProblemBase):
+            x_indexed = problem.get_indexed_discrete_x()
+            if x_indexed is not None:
+                return x_indexed
+
         warnings.warn(f'Hierarchical sampling is not possible for {problem!r}, falling back to non-hierarchical '
-                      f'sampling! Consider implementing `_gen_all_discrete_x`', TrailRepairWarning)
-        return None, None
+                      f'sampling! Consider implementing `_gen_all_discrete_x` or `_unrank_discrete_x`',
+                      TrailRepairWarning)
 
-    @classmethod
-    def randomly_sample(cls, problem, n_samples, repair: Repair, x_all: Optional[np.ndarray],
-                        is_act_all: Optional[np.ndarray], lhs=False, sobol=False):
+    def randomly_sample(self, problem, n_samples, x_all: Optional[Union[CompactDiscreteX, IndexedDiscreteX]],
+                        lhs=False):
         is_cont_mask = HierarchicalExhaustiveSampling.get_is_cont_mask(problem)
         has_x_cont = np.any(is_cont_mask)
         xl, xu = problem.xl, problem.xu
         needs_repair = False
 
-        def _choice(n_choose, n_from, replace=True):
-            return cls._choice(n_choose, n_from, replace=replace, sobol=sobol)
-
         # If the population of all available discrete design vectors is available, sample from there
-        is_active = is_act_all
+        is_active = None
         if x_all is not None:
-            x, is_active = cls._sample_discrete_x(n_samples, is_cont_mask, x_all, is_act_all, sobol=sobol)
+            x, is_active = self._sample_discrete_x(n_samples, is_cont_mask, x_all)
 
         # Otherwise, sample randomly
         else:
@@ -310,7 +579,7 @@ class HierarchicalRandomSampling(FloatRandomSampling):
             x = np.empty((n_samples, problem.n_var))
             for i_dv in range(problem.n_var):
                 if not is_cont_mask[i_dv]:
-                    i_opt_sampled = _choice(n_samples, len(opt_values[i_dv]))
+                    i_opt_sampled = self._choice(n_samples, len(opt_values[i_dv]))
                     x[:, i_dv] = opt_values[i_dv][i_opt_sampled]
 
         # Randomize continuous variables
@@ -322,10 +591,10 @@ class HierarchicalRandomSampling(FloatRandomSampling):
             nx_cont = len(np.where(is_cont_mask)[0])
             if lhs:
                 x_unit = sampling_lhs_unit(x.shape[0], nx_cont)
-            elif sobol:
-                x_unit = cls._sobol(x.shape[0], nx_cont)
+            elif self.sobol:
+                x_unit = self._sobol(x.shape[0], nx_cont)
             else:
-                x_unit = np.random.random((x.shape[0], nx_cont))
+                x_unit = self._get_random().random((x.shape[0], nx_cont))
 
             x_unit_abs = x_unit*(xu[is_cont_mask]-xl[is_cont_mask])+xl[is_cont_mask]
 
@@ -337,110 +606,126 @@ class HierarchicalRandomSampling(FloatRandomSampling):
 
         # Repair
         if needs_repair:
-            x = repair.do(problem, x)
+            x = self._repair.do(problem, x)
         return x
 
-    @classmethod
-    def _sample_discrete_x(cls, n_samples: int, is_cont_mask, x_all: np.ndarray, is_act_all: np.ndarray, sobol=False):
-
-        def _choice(n_choose, n_from, replace=True):
-            return cls._choice(n_choose, n_from, replace=replace, sobol=sobol)
-
-        # Separate by nr of active discrete variables
-        x_all_grouped, is_act_all_grouped, i_x_groups = cls.split_by_discrete_n_active(x_all, is_act_all, is_cont_mask)
+    def _sample_discrete_x(self, n_samples: int, is_cont_mask, x_all: Union[CompactDiscreteX, IndexedDiscreteX]):
+        # Separate by nr of active discrete variables: groups are consecutive ranges of ranks; only the ranks of the
+        # selected design vectors are determined, and only the selected design vectors are expanded
+        i_sorted, group_offsets, group_sizes = self.get_discrete_x_groups(x_all)
 
         # Uniformly choose from which group to sample
-        i_groups = np.sort(_choice(n_samples, len(x_all_grouped)))
-        x = []
-        is_active = []
-        has_x_cont = np.any(is_cont_mask)
-        i_x_sampled = np.ones((x_all.shape[0],), dtype=bool)
-        for i_group in range(len(x_all_grouped)):
-            i_x_group = np.where(i_groups == i_group)[0]
-            if len(i_x_group) == 0:
+        n_per_group = np.bincount(self._choice(n_samples, len(group_sizes)), minlength=len(group_sizes))
+
+        # If there are more samples requested than points available, only repeat points if there are continuous vars;
+        # otherwise uniformly select from the discrete vectors that are not sampled yet (can happen if some groups are
+        # very small and there are no continuous dimensions)
+        if not np.any(is_cont_mask):
+            n_add = int(np.sum(np.maximum(n_per_group-group_sizes, 0)))
+            n_per_group = np.minimum(n_per_group, group_sizes)
+            if n_add > 0:
+                n_spare = group_sizes-n_per_group
+                n_spare_total = int(np.sum(n_spare))
+                i_spare = self._choice(min(n_add, n_spare_total), n_spare_total, replace=False)
+                i_spare_group = np.searchsorted(np.cumsum(n_spare), i_spare, side='right')
+                n_per_group += np.bincount(i_spare_group, minlength=len(group_sizes))
+
+        # Randomly select values within groups
+        i_selected = []
+        for i_group, n_group in enumerate(n_per_group):
+            if n_group == 0:
                 continue
 
-            # Randomly select values within group
-            x_group = x_all_grouped[i_group]
-            if len(i_x_group) < x_group.shape[0]:
-                i_x = _choice(len(i_x_group), x_group.shape[0], replace=False)
-
-            # If there are more samples requested than points available, only repeat points if there are continuous vars
-            elif has_x_cont:
-                i_x_add = _choice(len(i_x_group)-x_group.shape[0], x_group.shape[0])
-                i_x = np.sort(np.concatenate([np.arange(x_group.shape[0]), i_x_add]))
-            else:
-                i_x = np.arange(x_group.shape[0])
-
-            x.append(x_group[i_x, :])
-            is_active.append(is_act_all_grouped[i_group][i_x, :])
-            i_x_sampled[i_x_groups[i_group][i_x]] = True
-
-        x = np.row_stack(x)
-        is_active = np.row_stack(is_active)
-
-        # Uniformly add discrete vectors if there are not enough (can happen if some groups are very small and there
-        # are no continuous dimensions)
-        if x.shape[0] < n_samples:
-            n_add = n_samples-x.shape[0]
-            x_available = x_all[~i_x_sampled, :]
-            is_act_available = is_act_all[~i_x_sampled, :]
-
-            if n_add < x_available.shape[0]:
-                i_x = _choice(n_add, x_available.shape[0], replace=False)
+            n_available = int(group_sizes[i_group])
+            if n_group < n_available:
+                i_x = self._choice(n_group, n_available, replace=False)
             else:
-                i_x = np.arange(x_available.shape[0])
+                i_x_add = self._choice(n_group-n_available, n_available)
+                i_x = np.sort(np.concatenate([np.arange(n_available), i_x_add]))
 
-            x = np.row_stack([x, x_available[i_x, :]])
-            is_active = np.row_stack([is_active, is_act_available[i_x, :]])
+            i_selected.append(group_offsets[i_group]+i_x)
 
-        return x, is_active
+        i_selected = np.concatenate(i_selected)
+        if i_sorted is not None:
+            i_selected = i_sorted[i_selected]
+        return x_all.get(i_selected)
 
     @staticmethod
-    def split_by_discrete_n_active(x_discrete: np.ndarray, is_act_discrete: np.ndarray, is_cont_mask) \
-            -> Tuple[List[np.ndarray], List[np.ndarray], List[np.ndarray]]:
+    def get_discrete_x_groups(x_all: Union[CompactDiscreteX, IndexedDiscreteX]) \
+            -> Tuple[Optional[np.ndarray], np.ndarray, np.ndarray]:
+        """Get the indices of the discrete design vectors ordered by group (None if the design vectors are already
+        ordered), and the offsets and sizes of the groups of design vectors with equal nr of active discrete variables.
+        The grouping is cached with the design vectors, which themselves are cached by the problem."""
+        if isinstance(x_all, IndexedDiscreteX):
+            return None, x_all.group_offsets, x_all.group_sizes
+        return x_all.get_n_active_groups()
+
+    def _sobol(self, n_samples, n_dims=None) -> np.ndarray:
+        """
+        Sample using a Sobol sequence, which supposedly gives a better distribution of points in a hypercube.
+        More info: https://docs.scipy.org/doc/scipy/reference/generated/scipy.stats.qmc.Sobol.html
+        """
+        n_samples = int(n_samples)
+        engine = self._sobol_engines.get(n_dims or 1)
+
+        # Start at a multiple of the power of 2 for generating samples (generating a power of 2 gives points with the
+        # lowest discrepancy); skipped points are not generated but fast-forwarded
+        n_block = 2**int(np.ceil(np.log2(max(n_samples, 1))))
+        i_start = 0 if engine is None else -(-engine.num_generated // n_block)*n_block
+        if engine is None or i_start+n_block > engine.maxn:
+            engine = self._sobol_engines[n_dims or 1] = Sobol(d=n_dims or 1, scramble=True, seed=self._get_seed())
+            i_start = 0
+        if i_start > engine.num_generated:
+            engine.fast_forward(i_start-engine.num_generated)
 
-        # Calculate nr of active variables for each design vector
-        is_discrete_mask = ~is_cont_mask
-        n_active = np.sum(is_act_discrete[:, is_discrete_mask], axis=1)
+        # Sample points and only return the amount needed
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore', message='The balance properties of Sobol')
+            x = engine.random(n_samples)
+        return x[:, 0] if n_dims is None else x
 
-        # Sort by nr active
-        i_sorted = np.argsort(n_active)
-        x_discrete = x_discrete[i_sorted, :]
-        is_act_discrete = is_act_discrete[i_sorted, :]
+    def _get_seed(self) -> int:
+        if self._rng is None:
+            return np.random.randint(2**31)
+        return int(self._rng.integers(2**31))
 
-        # Split by nr active
-        # https://stackoverflow.com/a/43094244
-        i_split = np.unique(n_active[i_sorted], return_index=True)[1][1:]
-        x_all_grouped = np.split(x_discrete, i_split, axis=0)
-        is_act_all_grouped = np.split(is_act_discrete, i_split, axis=0)
-        i_x_groups = np.split(np.arange(x_discrete.shape[0]), i_split)
+    def _get_random(self):
+        return np.random if self._rng is None else self._rng
 
-        return x_all_grouped, is_act_all_grouped, i_x_groups
+    def _choice(self, n_choose, n_from, replace=True):
+        if self.sobol:
+            return self._sobol_choice(n_choose, n_from, replace=replace)
 
-    @staticmethod
-    def _sobol(n_samples, n_dims=None) -> np.ndarray:
+        # Prevent enumerating (permuting) all values to choose from
+        if not replace and n_from > self._n_choice_enumerate_max:
+            return self._rejection_choice(n_choose, n_from)
+        return self._get_random().choice(n_from, n_choose, replace=replace)
+
+    def _rejection_choice(self, n_choose, n_from) -> np.ndarray:
         """
-        Sample using a Sobol sequence, which supposedly gives a better distribution of points in a hypercube.
-        More info: https://docs.scipy.org/doc/scipy/reference/generated/scipy.stats.qmc.Sobol.html
+        Choose n_choose unique values from n_from values, with the same distribution as choosing without replacement,
+        by drawing random values and rejecting the ones already chosen, so the values to choose from do not have to be
+        enumerated. Only efficient if n_choose is (much) smaller than n_from.
         """
+        if n_choose > n_from:
+            raise ValueError(f'Nr of values to choose should be lower than available values: {n_choose} > {n_from}')
 
-        # Get the power of 2 for generating samples (generating a power of 2 gives points with the lowest discrepancy)
-        pow2 = int(np.ceil(np.log2(n_samples)))
+        i_chosen = np.zeros((0,), dtype=np.int64)
+        while len(i_chosen) < n_choose:
+            n_draw = n_choose-len(i_chosen)
+            if self._rng is None:
+                i_drawn = np.random.randint(0, n_from, size=n_draw, dtype=np.int64)
+            else:
+                i_drawn = self._rng.integers(n_from, size=n_draw, dtype=np.int64)
 
-        # Sample points and only return the amount needed
-        x = Sobol(d=n_dims or 1).random_base2(m=pow2)
-        x = x[:n_samples, :]
-        return x[:, 0] if n_dims is None else x
+            # Keep the first occurrence of each value, in the order they were drawn
+            i_candidates = np.concatenate([i_chosen, i_drawn])
+            _, i_first = np.unique(i_candidates, return_index=True)
+            i_chosen = i_candidates[np.sort(i_first)]
 
-    @classmethod
-    def _choice(cls, n_choose, n_from, replace=True, sobol=False):
-        if sobol:
-            return cls._sobol_choice(n_choose, n_from, replace=replace)
-        return np.random.choice(n_from, n_choose, replace=replace)
+        return i_chosen
 
-    @classmethod
-    def _sobol_choice(cls, n_choose, n_from, replace=True):
+    def _sobol_choice(self, n_choose, n_from, replace=True):
         """
         Randomly choose n_choose from n_from values, optionally replacing (i.e. allow choosing values multiple times).
         If n_choose > n_from
@@ -451,23 +736,34 @@ class HierarchicalRandomSampling(FloatRandomSampling):
         # If replace (i.e. values can be chosen multiple times)
         if replace:
             # Generate unit samples
-            x_unit = cls._sobol(n_choose)
+            x_unit = self._sobol(n_choose)
 
             # Scale to nr of possible values and round
-            return np.round(x_unit*(n_from-.01)-.5).astype(np.int)
+            return np.round(x_unit*(n_from-.01)-.5).astype(np.int64)
 
-        # If we cannot replace, we cannot choose more values than available
+        return self._stratified_choice(self._sobol(n_choose), n_from)
+
+    def _stratified_choice(self, x_unit: np.ndarray, n_from) -> np.ndarray:
+        """
+        Choose len(x_unit) unique values from n_from values: one value (determined by x_unit) is chosen from each of
+        len(x_unit) equally-sized intervals, so the values to choose from do not have to be enumerated. The intervals
+        are shifted by a random offset so that each value has the same probability of being chosen.
+        """
+        n_choose = len(x_unit)
+        if n_choose == 0:
+            return np.zeros((0,), dtype=np.int64)
+
+        # We cannot choose more values than available
         if n_choose > n_from:
             raise ValueError(f'Nr of values to choose should be lower than available values: {n_choose} > {n_from}')
 
-        # Generate unit samples from total nr available
-        x_unit = cls._sobol(n_from)
+        i_bounds = np.floor(np.arange(n_choose+1)*(n_from/n_choose)).astype(np.int64)
+        i_bounds[-1] = n_from
+        n_interval = i_bounds[1:]-i_bounds[:-1]
+        i_x = i_bounds[:-1]+np.minimum(np.floor(x_unit*n_interval).astype(np.int64), n_interval-1)
 
-        # Get sorting arguments: this places each float value on an increasing integer scale
-        x_unit = x_unit.argsort()
-
-        # Only return the amount that we actually want to choose
-        return x_unit[:n_choose]
+        offset = int(self._get_random().random()*n_from)
+        return (i_x+offset) % n_from
 
     def __repr__(self):
         return f'{self.__class__.__name__}()'
@@ -477,6 +773,10 @@ class LargeDuplicateElimination(DefaultDuplicateElimination):
     """
     Duplicate elimination that can deal with a large amount of individuals in a population: instead of creating one big
     n_pop x n_pop cdist matrix, it does so in batches, thereby staying fast and saving in memory at the same time.
+
+    Columns that only contain integer values (i.e. discrete variables) are hashed, so that exact duplicates are found by
+    sorting: distances (of the remaining continuous columns) are then only computed between rows with the same discrete
+    values.
     """
     _n_per_batch = 200
 
@@ -487,6 +787,68 @@ class LargeDuplicateElimination(DefaultDuplicateElimination):
 
     @classmethod
     def eliminate(cls, x, other=None, is_duplicate=None, epsilon=1e-16):
+        x = np.asarray(x, dtype=float)
+        if is_duplicate is None:
+            is_duplicate = np.zeros((x.shape[0],), dtype=bool)
+        x_other = None if other is None else np.asarray(other, dtype=float)
+        if x.shape[0] == 0 or (x_other is not None and x_other.shape[0] == 0):
+            return is_duplicate
+
+        # Integer values differ by at least 1, so hashing only gives the same result if epsilon is not larger than 1
+        if epsilon > 1:
+            return cls.eliminate_by_distance(x, other=x_other, is_duplicate=is_duplicate, epsilon=epsilon)
+
+        # Get the discrete (integer) and continuous columns
+        x_all = x if x_other is None else np.row_stack([x, x_other])
+        is_int_col = np.all((x_all == np.round(x_all)) & (np.abs(x_all) < 2**53), axis=0)
+        x_cont = x_all[:, ~is_int_col]
+
+        # Group rows by their discrete values (sorted, so that groups keep the original row order)
+        i_group = cls._get_row_groups(x_all[:, is_int_col])
+        i_sorted = np.argsort(i_group, kind='stable')
+        is_first = np.ones((len(i_sorted),), dtype=bool)
+        is_first[1:] = i_group[i_sorted[1:]] != i_group[i_sorted[:-1]]
+
+        n_x = x.shape[0]
+        if x_cont.shape[1] == 0:
+            # Compare to itself: all but the first row of each group are duplicates
+            if x_other is None:
+                is_duplicate[i_sorted[~is_first]] = True
+
+            # Compare to other: all rows in groups that contain other rows are duplicates
+            else:
+                is_other_group = np.bincount(i_group[n_x:], minlength=np.max(i_group)+1) > 0
+                is_duplicate[is_other_group[i_group[:n_x]]] = True
+            return is_duplicate
+
+        # Compare continuous values within groups
+        for i_rows in np.split(i_sorted, np.where(is_first)[0][1:]):
+            if len(i_rows) < 2:
+                continue
+
+            if x_other is None:
+                is_duplicate[i_rows] = cls.eliminate_by_distance(
+                    x_cont[i_rows, :], is_duplicate=is_duplicate[i_rows], epsilon=epsilon)
+            else:
+                i_x, i_other = i_rows[i_rows < n_x], i_rows[i_rows >= n_x]
+                if len(i_x) > 0 and len(i_other) > 0:
+                    is_duplicate[i_x] = cls.eliminate_by_distance(
+                        x_cont[i_x, :], other=x_cont[i_other, :], is_duplicate=is_duplicate[i_x], epsilon=epsilon)
+
+        return is_duplicate
+
+    @staticmethod
+    def _get_row_groups(x_int: np.ndarray) -> np.ndarray:
+        """Get for each row the index of the group of rows with exactly the same values"""
+        if x_int.shape[1] == 0:
+            return np.zeros((x_int.shape[0],), dtype=int)
+
+        x_int = np.ascontiguousarray(x_int.astype(np.int64))
+        row_keys = x_int.view(np.dtype((np.void, x_int.dtype.itemsize*x_int.shape[1]))).ravel()
+        return np.unique(row_keys, return_inverse=True)[1].ravel()
+
+    @classmethod
+    def eliminate_by_distance(cls, x, other=None, is_duplicate=None, epsilon=1e-16):
         # Either compare x to itself or to another x
         x = x.copy().astype(float)
         if is_duplicate is None:
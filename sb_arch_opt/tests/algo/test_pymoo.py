@@ -1,7 +1,12 @@
 import os
+import copy
+import time
 import pickle
+import pytest
 import tempfile
+import concurrent.futures
 import numpy as np
+import pandas as pd
 from typing import Optional
 from sb_arch_opt.problem import *
 from sb_arch_opt.sampling import *
@@ -152,3 +157,146 @@ def test_doe_algo(problem: ArchOptProblemBase):
         pop_loaded = load_from_previous_results(problem, tmp_folder)
         assert np.all(pop_loaded.get('X') == pop.get('X'))
         assert np.all(pop_loaded.get('F') == pop.get('F'))
+
+
+def test_append_storage_evaluator(problem: ArchOptProblemBase):
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        pop = HierarchicalRandomSampling().do(problem, 110)
+
+        evaluator = ArchOptEvaluator(results_folder=tmp_folder, n_batch=20, append=True)
+        evaluator._get_storage_callback().n_chunks_compact = 4
+        pop = evaluator.eval(problem, pop)
+        assert len(pop) == 110
+        assert not os.path.exists(os.path.join(tmp_folder, 'pymoo_population.pkl'))
+        assert len(ResultsStorageCallback._get_chunk_paths(tmp_folder)) == 3  # 6 batches, compacted after 4
+
+        pop_loaded = load_from_previous_results(problem, tmp_folder)
+        assert np.all(pop_loaded.get('X') == pop.get('X'))
+        assert np.all(pop_loaded.get('F') == pop.get('F'))
+
+        df = pd.read_csv(os.path.join(tmp_folder, 'pymoo_population.csv'), index_col=0)
+        assert np.all(df.index == np.arange(110))
+        assert np.all(np.isclose(df.values, ResultsStorageCallback.get_pop_as_df(pop).values))
+
+        pop2 = HierarchicalRandomSampling().do(problem, 10)
+        pop2 = ArchOptEvaluator(results_folder=tmp_folder, append=True).eval(problem, pop2)
+        ResultsStorageCallback(tmp_folder, append=True).compact_chunks()
+        assert len(ResultsStorageCallback._get_chunk_paths(tmp_folder)) == 1
+
+        pop_loaded = load_from_previous_results(problem, tmp_folder)
+        assert len(pop_loaded) == 120
+        assert np.all(pop_loaded.get('X') == np.row_stack([pop.get('X'), pop2.get('X')]))
+
+        df = pd.read_csv(os.path.join(tmp_folder, 'pymoo_population.csv'), index_col=0)
+        assert np.all(df.index == np.arange(120))
+
+
+def test_append_storage_tiered_compaction(problem: ArchOptProblemBase):
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        pop = ArchOptEvaluator().eval(problem, HierarchicalRandomSampling().do(problem, 64))
+        callback = ResultsStorageCallback(tmp_folder, append=True, n_chunks_compact=4)
+        n_chunks = []
+        for i in range(len(pop)):
+            callback.append_pop(pop[[i]])
+            n_chunks.append(len(ResultsStorageCallback._get_chunk_paths(tmp_folder)))
+
+        # Chunks of similar size are merged in tiers
+        assert max(n_chunks) <= 9  # At most 3 chunks in each of the tiers of 1, 4 and 16 points
+        assert n_chunks[-1] == 1
+        assert np.all(ResultsStorageCallback.load_pop(tmp_folder).get('X') == pop.get('X'))
+
+        # Chunks are loaded in the order of their index
+        chunks_folder = callback._get_chunks_folder(tmp_folder)
+        callback._write_chunk(pop[[0]], os.path.join(chunks_folder, callback._get_chunk_filename(99999999, 1)))
+        callback._write_chunk(pop[[1]], os.path.join(chunks_folder, 'chunk_100000000.pkl'))
+        x_loaded = ResultsStorageCallback.load_pop(tmp_folder).get('X')
+        assert np.all(x_loaded == np.row_stack([pop.get('X'), pop.get('X')[:2]]))
+
+        # Chunks covered by a merged chunk (left behind by an interrupted merge) are skipped
+        chunk_paths = ResultsStorageCallback._get_chunk_paths(tmp_folder)
+        assert len(chunk_paths) == 3
+        merged_path = os.path.join(chunks_folder, callback._get_chunk_filename(100000000, 66, i_first=0))
+        callback._write_chunk(ResultsStorageCallback.load_pop(tmp_folder), merged_path)
+        assert ResultsStorageCallback._get_chunk_paths(tmp_folder) == [merged_path]
+        assert np.all(ResultsStorageCallback.load_pop(tmp_folder).get('X') == x_loaded)
+
+        callback.append_pop(pop[[2]])
+        assert len(os.listdir(chunks_folder)) == 2
+        assert np.all(ResultsStorageCallback.load_pop(tmp_folder).get('X') == np.row_stack([x_loaded, pop.get('X')[2]]))
+
+        # Storing a complete population supersedes the appended chunks
+        callback.store_pop(pop[:10])
+        assert len(ResultsStorageCallback._get_chunk_paths(tmp_folder)) == 0
+        assert len(ResultsStorageCallback.load_pop(tmp_folder)) == 10
+
+        # Appending continues from the stored complete population
+        callback = ResultsStorageCallback(tmp_folder, append=True)
+        callback.append_pop(pop[10:15])
+        assert np.all(ResultsStorageCallback.load_pop(tmp_folder).get('X') == pop.get('X')[:15])
+        df = pd.read_csv(os.path.join(tmp_folder, 'pymoo_population.csv'), index_col=0)
+        assert np.all(df.index == np.arange(15))
+
+
+def test_append_storage_restart():
+    problem = DummyResultSavingProblem()
+    problem.provide_previous_results = False
+
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        for i in range(3):
+            nsga2 = get_nsga2(pop_size=50, results_folder=tmp_folder, append_storage=True)
+            assert initialize_from_previous_results(nsga2, problem, tmp_folder) == (i > 0)
+            if i > 0:
+                assert len(nsga2.initialization.sampling) == 50+100*i  # Loaded points are not evaluated again
+
+            minimize(problem, nsga2, termination=('n_gen', 3), copy_algorithm=False)
+            assert os.path.exists(os.path.join(tmp_folder, 'pymoo_population.csv'))
+            assert len(ResultsStorageCallback._get_chunk_paths(tmp_folder)) == 1
+
+
+def test_async_evaluator(problem: ArchOptProblemBase):
+    pop_ref = HierarchicalRandomSampling().do(problem, 50)
+    pop_ref_eval = ArchOptEvaluator().eval(problem, copy.deepcopy(pop_ref))
+
+    for executor_cls in [concurrent.futures.ThreadPoolExecutor, concurrent.futures.ProcessPoolExecutor]:
+        with tempfile.TemporaryDirectory() as tmp_folder, executor_cls(max_workers=2) as executor:
+            evaluator = ArchOptEvaluator(results_folder=tmp_folder, append=True, executor=executor, n_parallel=3)
+            pop = evaluator.eval(problem, copy.deepcopy(pop_ref))
+            assert evaluator.n_eval == 50
+            assert np.all(pop.get('X') == pop_ref_eval.get('X'))
+            assert np.all(pop.get('F') == pop_ref_eval.get('F'))
+
+            pop_loaded = load_from_previous_results(problem, tmp_folder)
+            assert len(pop_loaded) == 50
+            i_sorted = np.lexsort(pop_loaded.get('X').T)
+            assert np.all(pop_loaded.get('X')[i_sorted, :] == pop.get('X')[np.lexsort(pop.get('X').T), :])
+
+            nsga2 = get_nsga2(pop_size=20)
+            nsga2.evaluator.executor = executor
+            result = minimize(problem, nsga2, termination=('n_gen', 2))  # Algorithm (incl. evaluator) is copied
+            assert len(result.pop) == 20
+
+
+def test_async_evaluator_kwargs_failure(problem: ArchOptProblemBase):
+    eval_kwargs = []
+    arch_evaluate = problem._arch_evaluate
+
+    def _failing_arch_evaluate(x_, *args, **kwargs):
+        eval_kwargs.append(kwargs)
+        time.sleep(.05)
+        if kwargs.get('fail'):
+            raise RuntimeError('Evaluation failed')
+        return arch_evaluate(x_, *args, **kwargs)
+
+    problem._arch_evaluate = _failing_arch_evaluate
+    pop = HierarchicalRandomSampling().do(problem, 50)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        evaluator = ArchOptEvaluator(n_batch=5, executor=executor)
+        evaluator.eval(problem, copy.deepcopy(pop), test_kwarg=True)
+        assert len(eval_kwargs) == 10
+        assert all(kwargs.get('test_kwarg') for kwargs in eval_kwargs)
+
+        # Pending evaluations are cancelled if one of the evaluations fails
+        eval_kwargs.clear()
+        with pytest.raises(RuntimeError):
+            evaluator.eval(problem, copy.deepcopy(pop), fail=True)
+        assert len(eval_kwargs) < 10
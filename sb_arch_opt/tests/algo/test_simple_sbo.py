@@ -1,8 +1,11 @@
 import pytest
 import tempfile
+import numpy as np
 from sb_arch_opt.problem import *
 from sb_arch_opt.algo.simple_sbo import *
+from sb_arch_opt.sampling import *
 from pymoo.optimize import minimize
+from pymoo.core.population import Population
 
 check_dependency = lambda: pytest.mark.skipif(not HAS_SIMPLE_SBO, reason='Simple SBO dependencies not installed')
 
@@ -74,3 +77,166 @@ def test_store_results_restart(problem: ArchOptProblemBase):
             n_eval = 11 if i == 0 else 1
             result = minimize(problem, sbo, termination=('n_eval', n_eval))
             assert len(result.pop) == 10+(i+1)
+
+
+
+@check_dependency()
+def test_infill_problem_force_new_points(problem: ArchOptProblemBase, discrete_problem: ArchOptProblemBase):
+    from sb_arch_opt.algo.simple_sbo.algo import SurrogateInfillOptimizationProblem
+    from sb_arch_opt.algo.simple_sbo.infill import FunctionEstimateInfill, normalize
+
+    for prob in [problem, discrete_problem]:
+        x_exist_norm = normalize(HierarchicalRandomSampling().do(prob, 50).get('X'), prob.xl, prob.xu)
+        x_new_norm = normalize(HierarchicalRandomSampling().do(prob, 50).get('X'), prob.xl, prob.xu)
+        x = np.row_stack([x_exist_norm[::2, :], x_new_norm, x_new_norm[:5, :]])
+
+        infill = FunctionEstimateInfill()
+        infill.initialize(prob, None)
+        infill_problem = SurrogateInfillOptimizationProblem(infill, prob, x_exist_norm=x_exist_norm)
+        is_dup = infill_problem._get_is_duplicate(x)
+        assert np.all(is_dup[:25])
+        assert np.all(is_dup[-5:])
+
+        _, _, i_dup = LargeDuplicateElimination().do(
+            Population.new(X=x), Population.new(X=x_exist_norm), return_indices=True)
+        assert np.all(np.where(is_dup)[0] == i_dup)
+
+
+@check_dependency()
+def test_infill_predict_mean_variance(problem: ArchOptProblemBase):
+    from smt.surrogate_models.krg import KRG
+    from sb_arch_opt.algo.simple_sbo.infill import FunctionEstimatePoFInfill
+
+    x_train = HierarchicalRandomSampling().do(problem, 50).get('X')
+    y_train = problem.evaluate(x_train, return_as_dictionary=True)['F']
+    model = KRG(print_global=False)
+    model.set_training_values(x_train, y_train)
+    model.train()
+
+    infill = FunctionEstimatePoFInfill()
+    infill.initialize(problem, model)
+    infill.set_samples(x_train, y_train)
+
+    x = HierarchicalRandomSampling().do(problem, 20).get('X')
+    f_ref = model.predict_values(x)
+    f_var_ref = np.row_stack([model.predict_variances(x[[i], :]) for i in range(x.shape[0])])
+
+    for chunk_size in [None, 1, 7]:
+        infill.predict_chunk_size = chunk_size
+        infill.reset_prediction_cache()
+        f, _, f_var, _ = infill.predict_mean_variance(x)
+        assert np.all(np.isclose(f, f_ref))
+        assert np.all(np.isclose(f_var, f_var_ref))
+
+        assert np.all(np.isclose(infill.predict(x)[0], f_ref))
+        assert np.all(np.isclose(infill.predict_variance(x)[0], f_var_ref))
+
+    # Repeated and overlapping queries should be taken from the cache
+    n_predicted = []
+    predict_y_chunked = infill._predict_y_chunked
+    infill._predict_y_chunked = lambda x_, **kwargs: n_predicted.append(x_.shape[0]) or predict_y_chunked(x_, **kwargs)
+
+    infill.reset_prediction_cache()
+    infill.predict(x[:10, :])
+    assert np.all(np.isclose(infill.predict_variance(x)[0], f_var_ref))
+    f, _, f_var, _ = infill.predict_mean_variance(x[5:, :])
+    assert np.all(np.isclose(f, f_ref[5:, :]))
+    assert np.all(np.isclose(f_var, f_var_ref[5:, :]))
+    assert n_predicted == [10, 10]
+
+    infill.set_samples(x_train, y_train)
+    infill.predict(x)
+    assert n_predicted == [10, 10, 20]
+
+
+@check_dependency()
+def test_ei_vectorized():
+    from sb_arch_opt.algo.simple_sbo.infill import ExpectedImprovementInfill, normalize
+
+    def _evaluate_f_ei_loop(f_, f_var_, f_current_):
+        f_pareto = ExpectedImprovementInfill.get_pareto_front(f_current_)
+        nadir_point, ideal_point = np.max(f_pareto, axis=0), np.min(f_pareto, axis=0)
+        f_pareto_norm = normalize(f_pareto, xu=nadir_point, xl=ideal_point)
+        f_norm, f_var_norm = ExpectedImprovementInfill._normalize_f_var(f_, f_var_, nadir_point, ideal_point)
+
+        f_ei_ = np.empty(f_.shape)
+        for i in range(f_.shape[0]):
+            i_par_closest = np.argmin(np.sum((f_pareto_norm-f_norm[i, :])**2, axis=1))
+            ei = ExpectedImprovementInfill._ei(f_pareto_norm[i_par_closest, :], f_norm[i, :], f_var_norm[i, :])
+            ei[ei < 0.] = 0.
+            f_ei_[i, :] = 1.-ei
+        return f_ei_
+
+    rng = np.random.default_rng(42)
+    for n_obj in [1, 2, 3]:
+        f_current = rng.random((200, n_obj))
+        f, f_var = rng.random((500, n_obj)), rng.random((500, n_obj))*.1
+        f_var[::10, :] = 0.
+
+        f_ei = ExpectedImprovementInfill._evaluate_f_ei(f, f_var, f_current)
+        assert np.array_equal(f_ei, _evaluate_f_ei_loop(f, f_var, f_current), equal_nan=True)
+
+
+@check_dependency()
+def test_simple_sbo_krg_incremental(problem: ArchOptProblemBase):
+    import copy
+    from sb_arch_opt.algo.simple_sbo.krg_update import supports_krg_update, update_krg
+
+    sbo = get_simple_sbo_krg(init_size=10, full_retrain_interval=3)
+    result = minimize(problem, sbo, termination=('n_eval', 15))
+    assert len(result.pop) == 15
+
+    sbo_infill = result.algorithm.infill_obj
+    assert sbo_infill.n_train == 5
+    assert sbo_infill.n_train_update == 3  # Full retrain, 2 incremental updates, full retrain, incremental update
+    model = sbo_infill.surrogate_model
+    assert supports_krg_update(model)
+    assert model.nt == sbo_infill.x_train.shape[0]
+
+    # Adding points should give the same model as training with the same hyperparameters
+    x_add = HierarchicalRandomSampling().do(problem, 5).get('X')
+    x_add_norm = (x_add-problem.xl)/(problem.xu-problem.xl)
+    y_add = model.predict_values(x_add_norm)+.1
+    model_updated = copy.deepcopy(model)
+    assert update_krg(model_updated, x_add_norm, y_add)
+    assert model_updated.nt == model.nt+5
+    assert np.all(np.isclose(model_updated.predict_values(x_add_norm), y_add))
+    assert np.all(model_updated.predict_variances(x_add_norm) < 1e-6)
+
+
+@check_dependency()
+def test_simple_sbo_krg_batch(problem: ArchOptProblemBase, monkeypatch):
+    from sb_arch_opt.algo.simple_sbo.algo import SBOInfill
+
+    # Record the model used by the infill criterion for each selected point of a batch
+    infill_model_nt = []
+    infill_var_prev = []
+    search_infill_points = SBOInfill._search_infill_points
+
+    def _search_infill_points(self, n_infill, x_pending_norm=None):
+        infill_model_nt.append(self.infill.surrogate_model.nt)
+        if x_pending_norm is not None:
+            infill_var_prev.append(np.max(self.infill.surrogate_model.predict_variances(x_pending_norm)))
+        return search_infill_points(self, n_infill, x_pending_norm=x_pending_norm)
+
+    monkeypatch.setattr(SBOInfill, '_search_infill_points', _search_infill_points)
+
+    with pytest.raises(ValueError):
+        get_simple_sbo_krg(batch_strategy='unknown')
+
+    for batch_strategy in ['kriging_believer', 'constant_liar']:
+        sbo = get_simple_sbo_krg(init_size=10, infill_size=4, batch_strategy=batch_strategy, infill_gens=20)
+        result = minimize(problem, sbo, termination=('n_eval', 18))
+        assert len(result.pop) == 18
+        assert np.all(~LargeDuplicateElimination.eliminate(result.pop.get('X')))
+
+        sbo_infill = result.algorithm.infill_obj
+        assert sbo_infill.n_train == 2
+        assert sbo_infill.surrogate_model.nt == 14
+        assert sbo_infill.infill.surrogate_model is sbo_infill.surrogate_model
+
+        # The infill criterion should see the fantasized points: the model grows and has no variance at these points
+        assert infill_model_nt == [10, 11, 12, 13, 14, 15, 16, 17]
+        assert np.all(np.array(infill_var_prev) < 1e-6)
+        infill_model_nt.clear()
+        infill_var_prev.clear()
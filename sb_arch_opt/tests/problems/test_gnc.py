@@ -1,3 +1,8 @@
+import itertools
+import pytest
+import warnings
+import numpy as np
+from sb_arch_opt.sampling import *
 from sb_arch_opt.problems.gnc import *
 from sb_arch_opt.tests.problems.test_hierarchical import run_test_hierarchy
 
@@ -16,3 +21,116 @@ def test_gnc():
     ]:
         run_test_hierarchy(problem, imp_ratio, check_n_valid=False)
         assert problem.get_n_valid_discrete() == n_valid
+
+
+def test_gnc_batch_evaluation():
+    problem = GNC()
+    x = HierarchicalRandomSampling().do(problem, 200).get('X')
+    x_corr, is_active = problem.correct_x(x)
+    for i in range(5):
+        x_corr_i, is_active_i = problem.correct_x(x[[i], :])
+        assert np.all(x_corr_i[0, :] == x_corr[i, :])
+        assert np.all(is_active_i[0, :] == is_active[i, :])
+
+    f = problem.evaluate(x, return_as_dictionary=True)['F']
+    for i in range(5):
+        n_inst = x_corr[i, :3].astype(int)
+        types = [[problem.get_categorical_values(x_corr[[i], :], 3+i_obj*3+j)[0] for j in range(n)]
+                 for i_obj, n in enumerate(n_inst)]
+        conns = [[(i_src, i_tgt) for i_src in range(n_inst[i_conn]) for i_tgt in range(n_inst[i_conn+1])
+                  if x_corr[i, 12+i_conn*9+i_src*3+i_tgt]] for i_conn in range(2)]
+
+        failure_rate = problem._calc_failure_rate(types[0], types[1], conns[0], types[2], conns[1])
+        assert f[i, 0] == pytest.approx(failure_rate, rel=1e-12)
+        assert f[i, 1] == pytest.approx(problem._calc_mass(*types))
+
+    assert np.all(problem.evaluate(x, return_as_dictionary=True)['F'] == f)
+
+
+def test_gnc_n_valid_discrete():
+    n_comb_conn = GNCProblemBase._get_n_comb_conn(4)
+    assert n_comb_conn[1, 3] == 1
+    assert n_comb_conn[2, 2] == 7
+    assert n_comb_conn[2, 3] == n_comb_conn[3, 2] == 25
+    assert n_comb_conn[3, 3] == 265
+    assert n_comb_conn[4, 4] == 41503
+
+    assert GNCProblemBase(n_max=4, actuators=False).get_n_valid_discrete() == 10030642
+
+
+def test_gnc_gen_all_discrete_x():
+    problem = GNCNoAct()
+    x_all, is_act_all = problem.all_discrete_x
+    assert x_all.shape[0] == problem.get_n_valid_discrete()
+
+    x_corr, is_act_corr = problem.correct_x(x_all)
+    assert np.all(x_corr == x_all)
+    assert np.all(is_act_corr == is_act_all)
+
+    chunks = list(problem.iter_all_discrete_x(n_chunk=1000))
+    assert all(x.shape[0] <= 1000 for x, _ in chunks)
+    assert np.all(np.row_stack([x for x, _ in chunks]) == x_all)
+
+    problem = GNC()
+    assert problem.all_discrete_x == (None, None)
+    for x, is_active in itertools.islice(problem.iter_all_discrete_x(n_chunk=500), 5):
+        assert x.shape[0] <= 500
+        assert np.all(problem.correct_x(x)[0] == x)
+
+
+def test_gnc_indexed_discrete_x():
+    problem = GNCNoAct()
+    x_indexed = problem.get_indexed_discrete_x()
+    assert len(x_indexed) == problem._get_n_valid_discrete()
+
+    x, is_active = x_indexed.get(np.arange(len(x_indexed)))
+    x_corr, is_act_corr = problem.correct_x(x)
+    assert np.all(x_corr == x)
+    assert np.all(is_act_corr == is_active)
+    assert np.unique(x, axis=0).shape[0] == len(x_indexed)
+
+    n_active = np.sum(is_active, axis=1)
+    assert np.all(np.diff(n_active) >= 0)
+    assert np.all(np.unique(n_active, return_counts=True)[1] == x_indexed.group_sizes)
+
+    problem = GNC()
+    assert problem.get_n_valid_discrete() == 79091323
+    x_indexed = problem.get_indexed_discrete_x()
+    x, is_active = x_indexed.get(np.array([0, 1000, len(x_indexed)-1]))
+    assert np.all(problem.correct_x(x)[0] == x)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', TrailRepairWarning)
+        x = HierarchicalRandomSampling().do(problem, 500).get('X')
+    assert np.unique(x, axis=0).shape[0] == 500
+    assert np.all(problem.correct_x(x)[0] == x)
+
+
+def test_gnc_conn_matrices():
+    for n_src, n_tgt in itertools.product(range(1, 4), range(1, 4)):
+        matrices = np.array(list(itertools.product([0, 1], repeat=n_src*n_tgt))).reshape((-1, n_src, n_tgt))
+        is_valid = np.all(np.any(matrices, axis=2), axis=1) & np.all(np.any(matrices, axis=1), axis=1)
+        assert np.all(GNCProblemBase._get_conn_matrices(n_src, n_tgt) == matrices[is_valid])
+
+    n_comb_conn = GNCProblemBase._get_n_comb_conn(5)
+    i_matrix = np.array([0, 1, 1000, n_comb_conn[5, 5]-1])
+    matrices = GNCProblemBase._get_conn_matrices(5, 5, i_matrix)
+    assert (5, 5) not in GNCProblemBase._conn_matrices
+    assert matrices.shape == (4, 5, 5)
+    assert np.all(np.any(matrices, axis=2)) and np.all(np.any(matrices, axis=1))
+    assert np.all(matrices[-1] == 1)
+    assert np.unique(matrices.reshape(4, -1), axis=0).shape[0] == 4
+
+
+def test_gnc_indexed_discrete_x_large():
+    for actuators in [False, True]:
+        problem = GNCProblemBase(n_max=5, actuators=actuators)
+        x_indexed = problem.get_indexed_discrete_x()
+        assert len(x_indexed) == problem.get_n_valid_discrete()
+
+        i_x = np.array([0, 1, 123456789, len(x_indexed)//2, len(x_indexed)-1])
+        x, is_active = x_indexed.get(i_x)
+        x_corr, is_act_corr = problem.correct_x(x)
+        assert np.all(x_corr == x)
+        assert np.all(is_act_corr == is_active)
+        assert np.unique(x, axis=0).shape[0] == len(i_x)
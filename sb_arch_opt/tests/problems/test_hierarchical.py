@@ -69,3 +69,17 @@ def test_comb_hier_mo():
 
 def test_comb_hier_discr_mo():
     run_test_hierarchy(CombHierDMO(), 13.69)
+
+
+def test_comb_hier_correct_x_batch():
+    problem = CombHierMO()
+    x = HierarchicalRandomSampling().do(problem, 1000).get('X')
+    x[:, :problem._x_sel.shape[1]] = np.random.randint(0, 10, (x.shape[0], problem._x_sel.shape[1]))
+
+    x_corr, is_active = problem.correct_x(x)
+    x_corr2, is_active2 = problem.correct_x(x_corr)
+    assert np.all(x_corr == x_corr2)
+    assert np.all(is_active == is_active2)
+
+    out = problem.evaluate(x, return_as_dictionary=True)
+    assert np.all(np.isfinite(out['F']))
@@ -43,6 +43,7 @@ def test_simple_problem_eval():
         assert np.all(np.abs(g[0, :]-np.array([0.85551435, -0.9, 40.64333408, -14., -14.])) < 1e-2)
         assert np.isinf(f[1, 0])
         assert np.all(np.isinf(g[1, :]))
+        problem.shutdown()
 
 
 @check_dependency()
@@ -1,11 +1,18 @@
 import os
+import warnings
+import pickle
+import tempfile
 import pytest
+import timeit
 import itertools
+import concurrent.futures
 import numpy as np
 from sb_arch_opt.problem import *
 from sb_arch_opt.sampling import *
+from sb_arch_opt.discrete_x import *
 from pymoo.core.evaluator import Evaluator
 from pymoo.core.population import Population
+from pymoo.operators.sampling.lhs import sampling_lhs_unit
 from sb_arch_opt.problems.problems_base import *
 from pymoo.core.variable import Real, Integer, Binary, Choice
 
@@ -69,6 +76,67 @@ def test_rounding():
     assert np.all(np.max(x_out_of_bounds, axis=0) == [5, 0, 2])
 
 
+def _get_correct_impute_x_loop_problem():
+    n_var = 400
+    des_vars = [Real(bounds=(-1, 2)) if i % 3 == 0 else (Choice(options=['A', 'B', 'C']) if i % 3 == 1 else
+                Integer(bounds=(-2, 5))) for i in range(n_var)]
+    problem = ArchOptProblemBase(des_vars)
+
+    def _correct_impute_x_loop(x_, is_active_):
+        mask = problem.is_discrete_mask
+        x_discrete = x_[:, mask].astype(np.float64)
+        xl, xu = problem.xl[mask], problem.xu[mask]
+        diff = xu-xl
+        for ix in range(x_discrete.shape[1]):
+            x_discrete[x_discrete[:, ix] < xl[ix], ix] = xl[ix]
+            x_discrete[x_discrete[:, ix] > xu[ix], ix] = xu[ix]
+        x_stretched = (x_discrete-xl)*((diff+.99)/diff)-.5
+        x_[:, mask] = (np.round(x_stretched)+xl).astype(int)
+
+        for i_dv in np.where(problem.is_discrete_mask)[0]:
+            x_[~is_active_[:, i_dv], i_dv] = problem.xl[i_dv]
+        for i_cont, i_dv in enumerate(np.where(problem.is_cont_mask)[0]):
+            x_[~is_active_[:, i_dv], i_dv] = .5*(problem.xl[i_dv]+problem.xu[i_dv])
+
+    def _correct_impute_x_vec(x_, is_active_):
+        problem._correct_x_discrete(x_)
+        problem.impute_x(x_, is_active_)
+
+    def _get_x(n):
+        x_ = np.random.random((n, problem.n_var))*(problem.xu-problem.xl+2)+problem.xl-1
+        return x_, np.random.random(x_.shape) > .5
+
+    return _correct_impute_x_loop, _correct_impute_x_vec, _get_x
+
+
+def test_correct_impute_x_vectorized():
+    correct_impute_loop, correct_impute_vec, get_x = _get_correct_impute_x_loop_problem()
+    x, is_active = get_x(200)
+
+    x_loop, x_vec = x.copy(), x.copy()
+    correct_impute_loop(x_loop, is_active)
+    correct_impute_vec(x_vec, is_active)
+    assert np.all(x_vec == x_loop)
+
+
+@pytest.mark.skip('Timing benchmark')
+def test_correct_impute_x_vectorized_timing():
+    correct_impute_loop, correct_impute_vec, get_x = _get_correct_impute_x_loop_problem()
+    x, is_active = get_x(10000)
+
+    x_loop, x_vec = x.copy(), x.copy()
+    t = timeit.default_timer()
+    correct_impute_loop(x_loop, is_active)
+    t_loop = timeit.default_timer()-t
+
+    t = timeit.default_timer()
+    correct_impute_vec(x_vec, is_active)
+    t_vec = timeit.default_timer()-t
+
+    assert np.all(x_vec == x_loop)
+    assert t_vec < t_loop
+
+
 def test_correct_x(problem: ArchOptProblemBase):
     assert problem.n_var == 5
     assert np.all(problem.is_discrete_mask == [False, True, False, True, False])
@@ -180,6 +248,150 @@ def test_evaluate(problem: ArchOptProblemBase):
         ])
 
 
+def test_eval_cache(problem: ArchOptProblemBase):
+    x = np.array([
+        [0, 0.1, 0, 0, 0],
+        [0, 0, 0, 0, 1],
+        [0, 6.9, 0, 0, 1],
+        [0, 7.1, 0, 0, .2],  # Same as previous after imputation
+    ])
+    out_ref = problem.evaluate(x, return_as_dictionary=True)
+    assert problem.eval_cache_size == 0
+
+    n_eval = []
+    arch_evaluate = problem._arch_evaluate
+
+    def _counted_arch_evaluate(x_, *args, **kwargs):
+        n_eval.append(x_.shape[0])
+        return arch_evaluate(x_, *args, **kwargs)
+
+    problem._arch_evaluate = _counted_arch_evaluate
+    problem.set_eval_cache(max_size=5)
+    for i in range(2):
+        out = problem.evaluate(x, return_as_dictionary=True)
+        for key in ['X', 'is_active', 'F']:
+            assert np.all(out[key] == out_ref[key])
+    assert n_eval == [3]
+    assert problem.eval_cache_hits == 4  # Duplicates within a batch are not cache hits
+    assert problem.eval_cache_misses == 3
+    assert problem.eval_cache_size == 3
+
+    x_new = x.copy()
+    x_new[:, 0] = .5
+    out = problem.evaluate(np.row_stack([x_new, x[:1, :]]), return_as_dictionary=True)
+    assert np.all(out['F'][-1, :] == out_ref['F'][0, :])
+    assert n_eval == [3, 3]
+    assert problem.eval_cache_size == 5
+
+    problem.reset_eval_cache()
+    assert problem.eval_cache_size == 0
+    assert problem.eval_cache_hits == 0
+
+    problem.set_eval_cache(enabled=False)
+    problem.evaluate(x)
+    assert n_eval == [3, 3, 4]
+    assert problem.eval_cache_size == 0
+
+
+def test_eval_database(problem: ArchOptProblemBase, discrete_problem: ArchOptProblemBase):
+    x = np.array([
+        [0, 0.1, 0, 0, 0],
+        [0, 0, 0, 0, 1],
+        [0, 6.9, 0, 0, 1],
+        [0, 7.1, 0, 0, .2],
+    ])
+
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        db_path = os.path.join(tmp_folder, 'eval.db')
+        out_ref = problem.evaluate(x, return_as_dictionary=True)
+
+        n_evaluated = []
+        for i in range(2):
+            problem = type(problem)()
+            arch_evaluate = problem._arch_evaluate
+
+            def _counted_arch_evaluate(x_, *args, **kwargs):
+                n_evaluated.append(x_.shape[0])
+                return arch_evaluate(x_, *args, **kwargs)
+
+            problem._arch_evaluate = _counted_arch_evaluate
+            problem.set_eval_database(db_path)
+            assert len(problem.eval_db) == (0 if i == 0 else 3)
+
+            out = problem.evaluate(x, return_as_dictionary=True)
+            for key in ['X', 'is_active', 'F']:
+                assert np.all(out[key] == out_ref[key])
+            assert problem.eval_db_hits == (0 if i == 0 else 3)
+            assert problem.eval_cache_hits == 0
+
+            problem.set_eval_cache()
+            n_db_hits = problem.eval_db_hits
+            for _ in range(2):
+                problem.evaluate(x)
+            assert problem.eval_db_hits == (3 if i == 0 else 6)
+            assert problem.eval_cache_hits == 4
+            assert problem.eval_cache_misses == 0
+
+            # Each row is a cache hit, or (if not a duplicate within the batch) a DB hit or a miss
+            assert problem.eval_cache_hits + problem.eval_cache_misses + (problem.eval_db_hits-n_db_hits) == 4+3
+            problem.set_eval_database(None)
+
+        assert n_evaluated == [3]
+
+        problem = type(problem)()
+        problem.set_eval_database(db_path)
+        assert pickle.loads(pickle.dumps(problem)).eval_db is not None
+        pop = problem.eval_db.get_population()
+        assert len(pop) == 3
+        assert np.all(pop.get('F') == out_ref['F'][:3, :])
+        assert pop.get('G').shape == (3, 0)
+
+        with pytest.raises(ValueError):
+            discrete_problem.set_eval_database(db_path)
+
+
+def test_eval_database_failed(problem: ArchOptProblemBase):
+    x = np.array([
+        [0, 0.1, 0, 0, 0],
+        [0, 0, 0, 0, 1],
+        [0, 6.9, 0, 0, 1],
+    ])
+
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        for store_failed in [False, True]:
+            db_path = os.path.join(tmp_folder, f'eval_{store_failed}.db')
+
+            n_evaluated = []
+            for i in range(2):
+                problem = type(problem)()
+                arch_evaluate = problem._arch_evaluate
+
+                def _failing_arch_evaluate(x_, is_active_out, f_out, *args, **kwargs):
+                    n_evaluated.append(x_.shape[0])
+                    arch_evaluate(x_, is_active_out, f_out, *args, **kwargs)
+                    f_out[x_[:, 1] > 5, :] = np.nan
+
+                problem._arch_evaluate = _failing_arch_evaluate
+                problem.set_eval_database(db_path, store_failed=store_failed)
+                out = problem.evaluate(x, return_as_dictionary=True)
+                assert np.all(np.isnan(out['F'][2, :]))
+                assert len(problem.eval_db) == (3 if store_failed else 2)
+                problem.set_eval_database(None)
+
+            assert n_evaluated == ([3] if store_failed else [3, 1])
+
+        # Another problem with the same nr of variables and outputs
+        class _OtherProblem(type(problem)):
+            pass
+
+        other_problem = _OtherProblem()
+        assert other_problem.n_var == problem.n_var
+        assert other_problem.get_problem_id() != problem.get_problem_id()
+        assert type(problem)().get_problem_id() == problem.get_problem_id()
+        with pytest.raises(ValueError):
+            other_problem.set_eval_database(db_path)
+
+
 def test_large_duplicate_elimination():
     x = np.array([
         [0, 0, 0],
@@ -208,6 +420,23 @@ def test_large_duplicate_elimination():
     pop = LargeDuplicateElimination().do(Population.new(X=x))
     assert len(pop) == n**m
 
+    # Hash-based elimination should give the same results as distance-based elimination
+    rng = np.random.default_rng(42)
+    for n_cont in [0, 1, 3]:
+        x = np.column_stack([rng.integers(0, 3, (300, 3)), rng.choice([0., .5, .25], (300, n_cont))])
+        x[200:, :] = x[:100, :]+1e-20
+        x_other = x[rng.choice(x.shape[0], 50), :]
+        is_dup_init = rng.random(x.shape[0]) < .1
+
+        for other in [None, x_other]:
+            for is_dup in [None, is_dup_init]:
+                is_dup_hash = LargeDuplicateElimination.eliminate(
+                    x, other, is_duplicate=None if is_dup is None else is_dup.copy())
+                is_dup_dist = LargeDuplicateElimination.eliminate_by_distance(
+                    x, other, is_duplicate=None if is_dup is None else is_dup.copy())
+                assert np.any(is_dup_hash)
+                assert np.all(is_dup_hash == is_dup_dist)
+
 
 def test_repaired_exhaustive_sampling(problem: ArchOptProblemBase):
     for has_cheap in [True, False]:
@@ -263,6 +492,11 @@ def test_repaired_exhaustive_sampling_hierarchical():
     x_imp, _ = problem.correct_x(x)
     assert np.all(x_imp == x)
 
+    # Discrete design vectors are expanded along the continuous dimensions in chunks
+    sampling = HierarchicalExhaustiveSampling(n_cont=2)
+    sampling._n_chunk_expand = 2
+    assert np.all(sampling.do(problem, 0).get('X') == x)
+
 
 def test_repaired_exhaustive_sampling_hierarchical_large():
     n = 12
@@ -274,6 +508,120 @@ def test_repaired_exhaustive_sampling_hierarchical_large():
     assert np.all(x_imp == x)
 
 
+def test_trial_and_repair_chunks(monkeypatch):
+    opt_values = [np.arange(3), np.arange(2)+1, np.array([.5, 1.5, 2.5, 3.5])]
+    x_product = np.array(list(itertools.product(*opt_values)))
+    assert np.all(HierarchicalExhaustiveSampling.get_cartesian_product_chunk(opt_values, 0, 24) == x_product)
+    assert np.all(HierarchicalExhaustiveSampling.get_cartesian_product_chunk(opt_values, 5, 17) == x_product[5:17])
+
+    problem = HierarchicalDummyProblem(n=8)
+    sampling = HierarchicalExhaustiveSampling(n_cont=1)
+    x_ref, is_act_ref = sampling.get_all_x_discrete_by_trial_and_repair(problem)
+    assert x_ref.shape == (9, 16)
+    for n_batch in [1, 7, 100, 10000]:
+        x, is_active = sampling.get_all_x_discrete_by_trial_and_repair(problem, n_batch=n_batch)
+        assert np.all(x == x_ref)
+        assert np.all(is_active == is_act_ref)
+
+    sampling_parallel = HierarchicalExhaustiveSampling(n_cont=1, n_parallel=2)
+    x, is_active = sampling_parallel.get_all_x_discrete_by_trial_and_repair(problem, n_batch=10)
+    assert np.all(x == x_ref)
+    assert np.all(is_active == is_act_ref)
+
+    # The nr of processes can also be set on the problem, to be used by all samplers
+    n_workers = []
+    process_pool_executor = concurrent.futures.ProcessPoolExecutor
+
+    def _get_executor(max_workers=None, **kwargs):
+        n_workers.append(max_workers)
+        return process_pool_executor(max_workers=max_workers, **kwargs)
+
+    monkeypatch.setattr(concurrent.futures, 'ProcessPoolExecutor', _get_executor)
+    problem = HierarchicalDummyProblem(n=14)  # Cartesian product larger than one batch
+    x_ref, _ = sampling.get_all_x_discrete_by_trial_and_repair(problem)
+    assert n_workers == []
+
+    problem.all_discrete_x_n_parallel = 2
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', TrailRepairWarning)
+        x_all = HierarchicalRandomSampling.get_hierarchical_cartesian_product(problem, ArchOptRepair())
+    assert n_workers == [2]
+    assert np.all(x_all.get()[0] == x_ref)
+
+
+def test_all_discrete_x_cache(problem: ArchOptProblemBase):
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        def _get_problem(problem_cls):
+            problem_ = problem_cls()
+            problem_.cache_all_discrete_x = True
+            problem_.all_discrete_x_cache_folder = tmp_folder
+            return problem_
+
+        problem = _get_problem(type(problem))
+        x_all, is_act_all = problem.all_discrete_x
+        assert len(os.listdir(os.path.join(tmp_folder, 'v2'))) == 1
+
+        problem2 = _get_problem(type(problem))
+        problem2.set_provide_all_x(False)
+        assert isinstance(problem2.all_discrete_x_compact.x_discrete, np.memmap)
+        x_all2, is_act_all2 = problem2.all_discrete_x
+        assert np.all(x_all2 == x_all)
+        assert np.all(is_act_all2 == is_act_all)
+
+        problem_unpickled = pickle.loads(pickle.dumps(problem2))
+        assert 'all_discrete_x' not in problem_unpickled.__dict__
+        assert 'all_discrete_x_compact' not in problem_unpickled.__dict__
+        assert np.all(problem_unpickled.all_discrete_x[0] == x_all)
+
+        # A problem with the same representation but another configuration should not use the same cache
+        problem_other = _get_problem(type(problem))
+        problem_other.xu = problem_other.xu+1
+        assert repr(problem_other) == repr(problem)
+        assert problem_other._all_discrete_x_cache_folder() != problem._all_discrete_x_cache_folder()
+        assert problem_other.load_all_discrete_x_cache() is None
+
+        # Problems without generation function are cached after trial-and-repair
+        problem = _get_problem(HierarchicalDummyProblem)
+        assert problem.all_discrete_x == (None, None)
+        x_all, _ = HierarchicalExhaustiveSampling(n_cont=1).get_all_x_discrete(problem)
+        assert x_all.shape[0] == 5
+        assert HierarchicalExhaustiveSampling.has_cheap_all_x_discrete(problem)
+        assert np.all(_get_problem(HierarchicalDummyProblem).all_discrete_x[0] == x_all)
+
+
+def test_compact_discrete_x(problem: ArchOptProblemBase):
+    x_all, is_act_all = problem._gen_all_discrete_x()
+    x_compact = CompactDiscreteX.from_x(x_all, is_act_all, problem.is_cont_mask)
+    assert len(x_compact) == x_all.shape[0]
+    assert x_compact.x_discrete.dtype == np.uint8
+    assert x_compact.x_cont is None
+    assert x_compact.nbytes < (x_all.nbytes + is_act_all.nbytes)/8
+
+    x, is_active = x_compact.get()
+    assert np.all(x == x_all)
+    assert np.all(is_active == is_act_all)
+    n_active = np.sum(is_act_all[:, ~problem.is_cont_mask], axis=1)
+    assert np.all(x_compact.get_n_active_discrete() == n_active)
+
+    i_sorted, group_offsets, group_sizes = x_compact.get_n_active_groups()
+    assert x_compact.get_n_active_groups()[0] is i_sorted
+    assert np.all(np.diff(n_active[i_sorted]) >= 0)
+    assert np.all(group_sizes == np.unique(n_active, return_counts=True)[1])
+    assert np.all(group_offsets == np.cumsum(group_sizes)-group_sizes)
+
+    x, is_active = x_compact.get(np.array([3, 1]))
+    assert np.all(x == x_all[[3, 1], :])
+    assert np.all(is_active == is_act_all[[3, 1], :])
+    assert np.all(np.row_stack([x_ for x_, _ in x_compact.iter_chunks(n_chunk=7)]) == x_all)
+
+    x_all_cont = x_all.copy()
+    x_all_cont[:, problem.is_cont_mask] = np.random.random((x_all.shape[0], np.sum(problem.is_cont_mask)))
+    x_compact = CompactDiscreteX.from_arrays(CompactDiscreteX.from_x(x_all_cont, is_act_all, problem.is_cont_mask)
+                                             .get_arrays())
+    assert x_compact.x_cont is not None
+    assert np.all(x_compact.get()[0] == x_all_cont)
+
+
 def test_repaired_lhs_sampling(problem: ArchOptProblemBase):
 
     sampling = HierarchicalLatinHypercubeSampling()
@@ -290,26 +638,72 @@ def test_repaired_lhs_sampling(problem: ArchOptProblemBase):
     x = init.do(problem, 1000).get('X')
     assert x.shape == (1000, 5)
 
+    for n_parallel in [None, 2]:
+        x = HierarchicalLatinHypercubeSampling(ese=True, n_parallel=n_parallel).do(problem, 50).get('X')
+        assert x.shape == (50, 5)
+        assert np.all(problem.correct_x(x)[0] == x)
+
+
+def test_lhs_ese():
+    x = sampling_lhs_unit(50, 4)
+    is_swappable = np.ones(x.shape, dtype=bool)
+    is_swappable[:10, 1] = False
+    is_swappable[:, 3] = False
+
+    phi_p_init = HierarchicalLatinHypercubeSampling._get_phi_p(x)
+    x_opt, phi_p = HierarchicalLatinHypercubeSampling._optimize_ese(
+        x, is_swappable, n_outer=10, rng=np.random.default_rng(42))
+    assert phi_p < phi_p_init
+    assert phi_p == pytest.approx(HierarchicalLatinHypercubeSampling._get_phi_p(x_opt))
+
+    for i_col in range(x.shape[1]):  # Values are only exchanged within columns
+        assert np.all(np.sort(x_opt[:, i_col]) == np.sort(x[:, i_col]))
+    assert np.all(x_opt[:10, 1] == x[:10, 1])
+    assert np.all(x_opt[:, 3] == x[:, 3])
+
 
 def test_sobol_sampling():
     for _ in range(100):
-        i = HierarchicalRandomSampling._sobol_choice(5, 10, replace=True)
+        i = HierarchicalRandomSampling()._sobol_choice(5, 10, replace=True)
         assert len(i) == 5
         assert 0 <= np.min(i) <= np.max(i) < 10
         assert len(np.unique(i)) <= 10
 
-        i = HierarchicalRandomSampling._sobol_choice(10, 5, replace=True)
+        i = HierarchicalRandomSampling()._sobol_choice(10, 5, replace=True)
         assert len(i) == 10
         assert 0 <= np.min(i) <= np.max(i) < 5
         assert len(np.unique(i)) <= 5
 
-        i = HierarchicalRandomSampling._sobol_choice(5, 10, replace=False)
+        i = HierarchicalRandomSampling()._sobol_choice(5, 10, replace=False)
         assert len(i) == 5
         assert 0 <= np.min(i) <= np.max(i) < 10
         assert len(np.unique(i)) == len(i)
 
     with pytest.raises(ValueError):
-        HierarchicalRandomSampling._sobol_choice(10, 5, replace=False)
+        HierarchicalRandomSampling()._sobol_choice(10, 5, replace=False)
+
+    for sobol in [False, True]:
+        for seed in [None, 42]:
+            i = HierarchicalRandomSampling(sobol=sobol, seed=seed)._choice(1000, int(1e12), replace=False)
+            assert len(i) == 1000
+            assert 0 <= np.min(i) <= np.max(i) < 1e12
+            assert len(np.unique(i)) == len(i)
+
+    # Without Sobol sampling, values are chosen uniformly (not stratified) also if there are many values to choose from
+    i = HierarchicalRandomSampling(sobol=False, seed=42)._choice(150000, 200000, replace=False)
+    assert len(np.unique(i)) == 150000
+    i = HierarchicalRandomSampling(sobol=False, seed=42)._choice(1000, 200000, replace=False)
+    assert np.max(np.diff(np.sort(i))) > 2*200
+
+    sampling = HierarchicalRandomSampling()
+    n = 2000
+    counts = np.bincount(np.concatenate([sampling._sobol_choice(4, 10, replace=False) for _ in range(n)]))
+    assert np.all(np.abs(counts/n - .4) < .05)
+
+    sampling = HierarchicalRandomSampling(seed=42)
+    i = sampling._sobol_choice(5, 100)
+    assert np.any(sampling._sobol_choice(5, 100) != i)
+    assert np.all(HierarchicalRandomSampling(seed=42)._sobol_choice(5, 100) == i)
 
 
 def test_repaired_random_sampling(problem: ArchOptProblemBase):